@@ -0,0 +1,70 @@
+"""
+Benchmarks for PonyExpress
+
+Each module in here can be run as a script, e.g.::
+
+    python -m benchmarks.store
+
+from the top of the source tree. Results are printed to stdout.
+"""
+
+import time
+
+import sqlalchemy
+
+from ponyexpress import model
+from ponyexpress.model import meta, Message, MessageTag, Tag
+
+def setup(url='sqlite://'):
+    """
+    Create a fresh database to benchmark against.
+    """
+    e = sqlalchemy.create_engine(url)
+    model.init_model(e)
+    model.Base.metadata.create_all(bind=e)
+    return e
+
+def populate(count, tags=[u'INBOX'], body=u'x' * 1024):
+    """
+    Quickly insert count messages, each tagged with all of tags.
+
+    Returns the Tag objects, in the same order as tags.
+    """
+    tag_objs = [Tag(name=name) for name in tags]
+    meta.Session.add_all(tag_objs)
+    meta.Session.commit()
+
+    messages = Message.__table__
+    first = (meta.Session.query(sqlalchemy.func.max(Message.id)).scalar() or 0) + 1
+    meta.Session.execute(messages.insert(),
+                         [{'id': i, 'body': body, 'length': len(body),
+                           'deleted': False}
+                          for i in xrange(first, first + count)])
+    for t in tag_objs:
+        meta.Session.execute(MessageTag.__table__.insert(),
+                             [{'message_id': i, 'tag_id': t.id,
+                               'deleted': False}
+                              for i in xrange(first, first + count)])
+    meta.Session.commit()
+    return tag_objs
+
+class Timer(object):
+    """
+    A context manager that prints how long its body took to run.
+    """
+
+    def __init__(self, label, count=None):
+        self.label = label
+        self.count = count
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.time() - self.start
+        if self.count:
+            print '%-40s %8.3fs %10.0f/s' % (self.label, self.elapsed,
+                                             self.count / self.elapsed)
+        else:
+            print '%-40s %8.3fs' % (self.label, self.elapsed)
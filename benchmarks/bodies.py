@@ -0,0 +1,62 @@
+"""
+Benchmark compressed body storage: how much space each codec saves,
+and what it costs to compress and decompress
+"""
+
+import random
+
+from ponyexpress.model import meta, bodies
+from benchmarks import setup, Timer
+
+WORDS = ('the of and to a in is you that it he was for on are as with '
+         'his they at be this have from or one had by word but not what '
+         'all were we when your can said there use an each which she do '
+         'how their if will up other about out many then them these so '
+         'server mail folder message patch review build release').split()
+
+FOOTER = (u'\n-- \nThis message was sent to the ponyexpress-dev mailing '
+          u'list.\nTo unsubscribe, visit http://example.com/lists/\n')
+
+def make_bodies(count, rng):
+    """
+    Make up some plausible message bodies: mostly short list traffic,
+    with the occasional long one.
+    """
+    result = []
+    for i in xrange(count):
+        words = rng.randint(5000, 20000) if rng.random() < 0.05 else \
+            rng.randint(30, 300)
+        text = u' '.join(rng.choice(WORDS) for j in xrange(words))
+        result.append(text + FOOTER)
+    return result
+
+def main(count=10000):
+    setup()
+    rng = random.Random(0)
+    samples = make_bodies(count, rng)
+    raw = sum(len(bodies._bytes(b)) for b in samples)
+    mb = raw / 1048576.0
+    # Rates are in MB of uncompressed body per second
+    print '%d bodies, %.1f MB' % (count, mb)
+
+    dictionary_id = bodies.create_dictionary(make_bodies(200, rng))
+    meta.Session.commit()
+
+    codecs = [('zlib level 1', bodies.Zlib(1)),
+              ('zlib level 6', bodies.Zlib(6)),
+              ('zlib level 9', bodies.Zlib(9)),
+              ('zlib level 6 + dictionary',
+               bodies.ZlibDictionary(dictionary_id, 6))]
+    for label, codec in codecs:
+        meta.compression = codec
+        with Timer('compress, %s' % label, mb) as t:
+            blobs = [bodies.encode(b)[1] for b in samples]
+        stored = sum(len(b) for b in blobs)
+        with Timer('decompress, %s' % label, mb):
+            for b in blobs:
+                bodies.decode(None, b)
+        print '  ratio %.2f, %.1f MB stored' % (float(raw) / stored,
+                                                stored / 1048576.0)
+
+if __name__ == '__main__':
+    main()
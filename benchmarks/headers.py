@@ -0,0 +1,108 @@
+"""
+Benchmark header lookups in util.headers.Headers against the old
+list-scanning implementation, on header blocks of 30-80 fields like
+the ones on real mailing list traffic
+"""
+
+import random
+
+from ponyexpress.util.headers import Headers
+from benchmarks import Timer
+
+class ListHeaders(object):
+    """
+    The old Headers: a list of tuples, lowercasing every key on every
+    lookup.
+    """
+
+    def __init__(self, headers=[]):
+        if hasattr(headers, 'items'):
+            self._headers = list(headers.items())
+        else:
+            self._headers = list(headers)
+
+    def items(self):
+        return list(self._headers)
+
+    def __contains__(self, header):
+        header = header.lower()
+        return any((header == k.lower()) for k, v in self._headers)
+
+    def __getitem__(self, name):
+        name = name.lower()
+        for k, v in self._headers:
+            if k.lower() == name:
+                return v
+        else:
+            raise KeyError, name
+
+    def __setitem__(self, name, val):
+        self._headers.append((name, val))
+
+    def get_all(self, name):
+        name = name.lower()
+        return [v for k, v in self._headers if k.lower() == name]
+
+    def select(self, names, negate=False):
+        # What MPart.getHeaders used to do
+        headers = ListHeaders()
+        for k, v in self._headers:
+            if (k in names) is not negate:
+                headers[k] = v
+        return headers
+
+# Fields that show up once on a typical list message, roughly in the
+# order they appear
+SINGLE = ['Return-Path', 'Delivered-To', 'X-Original-To',
+          'Authentication-Results', 'ARC-Seal', 'ARC-Message-Signature',
+          'ARC-Authentication-Results', 'DKIM-Signature', 'X-Google-DKIM-Signature',
+          'X-Gm-Message-State', 'X-Google-Smtp-Source', 'X-Received',
+          'MIME-Version', 'References', 'In-Reply-To', 'From', 'Date',
+          'Message-ID', 'Subject', 'To', 'Cc', 'Content-Type',
+          'Content-Transfer-Encoding', 'X-BeenThere', 'X-Mailman-Version',
+          'Precedence', 'List-Id', 'List-Unsubscribe', 'List-Archive',
+          'List-Post', 'List-Help', 'List-Subscribe', 'Errors-To',
+          'Sender', 'X-Spam-Status', 'X-Spam-Score', 'X-Virus-Scanned',
+          'Thread-Topic', 'Thread-Index', 'Accept-Language']
+# Fields that get repeated once per hop
+REPEATED = ['Received', 'Received-SPF', 'X-Received', 'ARC-Seal']
+
+# What a client typically asks for in BODY.PEEK[HEADER.FIELDS (...)]
+FETCHED = ['From', 'To', 'Cc', 'Bcc', 'Subject', 'Date', 'Message-ID',
+           'Priority', 'X-Priority', 'References', 'Newsgroups',
+           'In-Reply-To', 'Content-Type', 'Reply-To']
+
+def make_blocks(count, rng):
+    blocks = []
+    for i in xrange(count):
+        size = rng.randint(30, 80)
+        fields = [rng.choice(REPEATED) for j in xrange(size - len(SINGLE))]
+        fields += SINGLE[:size - len(fields)]
+        rng.shuffle(fields)
+        blocks.append([(f, 'value %d of %s' % (j, f))
+                       for j, f in enumerate(fields)])
+    return blocks
+
+def run(cls, blocks):
+    for block in blocks:
+        h = cls(block)
+        for name in FETCHED:
+            if name in h:
+                h[name]
+        h.get_all('received')
+        h.select(FETCHED)
+
+def main(count=20000):
+    rng = random.Random(0)
+    blocks = make_blocks(count, rng)
+    print '%d header blocks, %.1f fields each' % \
+        (count, sum(len(b) for b in blocks) / float(count))
+    # Rates are in lookups per second
+    lookups = count * (len(FETCHED) + 2)
+    for label, cls in [('list of tuples (old)', ListHeaders),
+                       ('lazy lowercase index', Headers)]:
+        with Timer(label, lookups):
+            run(cls, blocks)
+
+if __name__ == '__main__':
+    main()
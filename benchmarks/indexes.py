@@ -0,0 +1,82 @@
+"""
+Benchmark the queries that messages_tags and headers indexes serve,
+on a database from before the migrations that add them and again
+after upgrading it
+"""
+
+import sqlalchemy
+from twisted.mail.imap4 import MessageSet
+
+from ponyexpress.model import meta, migrations, Header, MessageTag, Tag
+from benchmarks import setup, populate, Timer
+
+INDEXES = ['ix_headers_field_lower_value', 'ix_messages_tags_message_id_tag_id',
+           'ix_messages_tags_tag_id_id']
+
+def add_headers(count):
+    headers = Header.__table__
+    meta.Session.execute(headers.insert(),
+                         [{'message_id': i, 'position': p, 'field': f,
+                           'field_lower': f.lower(), 'value': v % i}
+                          for i in xrange(1, count + 1)
+                          for p, (f, v) in enumerate(
+                [(u'Message-ID', u'<%d@example.com>'),
+                 (u'Subject', u'Message number %d'),
+                 (u'From', u'sender%d@example.com')])])
+    meta.Session.commit()
+
+def queries(folders, count, repeat):
+    inbox, lists, seen = folders
+    with Timer('sequence map (small folder)', repeat):
+        for i in xrange(repeat):
+            lists._sequence = None
+            lists.getMessageCount()
+    with Timer('UIDNEXT (small folder)', repeat):
+        for i in xrange(repeat):
+            lists.getUIDNext()
+    with Timer('UNSEEN (small folder)', repeat):
+        for i in xrange(repeat):
+            lists.getUnseenCount()
+    with Timer('STORE +FLAGS \\Seen (small folder)', repeat):
+        for i in xrange(repeat):
+            lists.store(MessageSet(1, 20), [ur'\Seen'], i % 2 and -1 or 1,
+                        False)
+    with Timer('Message-ID lookup', repeat):
+        for i in xrange(repeat):
+            meta.Session.query(Header.message_id).\
+                filter(Header.field_lower==u'message-id').\
+                filter(Header.value==u'<%d@example.com>' % (i * 7 % count)).\
+                all()
+
+def main(count=5000, repeat=20):
+    # Without the indexes, UNSEEN and STORE scan messages_tags once per
+    # message, so anything much bigger takes far too long
+    setup()
+    inbox, lists, seen = populate(count, [u'INBOX', u'Lists/dev', ur'\Seen'])
+    # Only every 50th message is on the list, and half have been read
+    table = MessageTag.__table__
+    meta.Session.execute(table.delete(
+            sqlalchemy.and_(table.c.tag_id==lists.id,
+                            table.c.message_id % 50 != 0)))
+    meta.Session.execute(table.delete(
+            sqlalchemy.and_(table.c.tag_id==seen.id,
+                            table.c.message_id % 2 == 0)))
+    meta.Session.commit()
+    add_headers(count)
+
+    # Make it look like a database from before the migrations
+    migrations.version()
+    for name in INDEXES:
+        meta.Session.execute('DROP INDEX %s' % name)
+    meta.Session.commit()
+
+    folders = [meta.Session.query(Tag).get(t.id) for t in (inbox, lists, seen)]
+    print 'Before'
+    queries(folders, count, repeat)
+    with Timer('migrations.upgrade()'):
+        migrations.upgrade()
+    print 'After'
+    queries(folders, count, repeat)
+
+if __name__ == '__main__':
+    main()
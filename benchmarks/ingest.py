@@ -0,0 +1,61 @@
+"""
+Benchmark bulk imports from an mbox file, with and without a pool of
+parsing processes
+"""
+
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+
+from ponyexpress.model import meta, ingest
+from benchmarks import setup, Timer
+from benchmarks.bodies import make_bodies
+
+HEADERS = ('From sender@example.com Sat Jan  3 01:05:34 2009\n'
+           'Received: from mx.example.com by mail.example.com\n'
+           'Received: from list.example.com by mx.example.com\n'
+           'From: "Sender %(i)d" <sender%(i)d@example.com>\n'
+           'To: ponyexpress-dev@example.com\n'
+           'Date: Sat, 3 Jan 2009 01:05:34 -0500\n'
+           'Message-ID: <%(i)d@example.com>\n'
+           'Subject: Message number %(i)d\n'
+           'MIME-Version: 1.0\n'
+           'Content-Type: text/plain; charset=utf-8\n'
+           'List-Id: <ponyexpress-dev.example.com>\n'
+           '\n')
+
+def make_mbox(path, count, rng):
+    f = open(path, 'wb')
+    try:
+        for i, body in enumerate(make_bodies(count, rng)):
+            f.write(HEADERS % {'i': i})
+            f.write(body.encode('utf-8'))
+            f.write('\n\n')
+    finally:
+        f.close()
+
+def main(count=20000):
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'mbox')
+        make_mbox(path, count, random.Random(0))
+        mb = os.path.getsize(path) / 1048576.0
+        print '%d messages, %.1f MB, %d CPUs' % (count, mb,
+                                                 multiprocessing.cpu_count())
+
+        for label, processes in [('import, 1 process', 0),
+                                 ('import, process pool', None)]:
+            setup()
+            importer = ingest.Importer(processes=processes)
+            with Timer(label, count) as t:
+                importer.run(ingest.Mbox(path))
+            print '  %.1f MB/s, %.0f minutes for 10 GB' % \
+                (mb / t.elapsed, 10240 / (mb / t.elapsed) / 60)
+            meta.Session.remove()
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
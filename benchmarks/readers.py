@@ -0,0 +1,88 @@
+"""
+Benchmark how long IMAP readers wait while mail is being delivered,
+with SQLite's default rollback journal and with the settings from
+ponyexpress.model.tuning
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import sqlalchemy
+from twisted.mail.imap4 import MessageSet
+
+from ponyexpress import model
+from ponyexpress.model import meta, tuning, Message, Tag
+from benchmarks import populate
+
+MESSAGE = 'From: sender@example.com\r\nSubject: Delivery %d\r\n\r\n' + \
+    'x' * 2048 + '\r\n'
+
+def deliver(stop, batch, delivered):
+    """
+    Deliver messages batch at a time until stop is set, like
+    ponyexpress.delivery.GroupCommitter does.
+    """
+    inbox = meta.Session.query(Tag).filter_by(name=u'INBOX').one()
+    i = 0
+    while not stop.isSet():
+        for j in xrange(batch):
+            meta.Session.add(Message.fromString(MESSAGE % i, tags=[inbox]))
+            i += 1
+        meta.Session.commit()
+        delivered.append(batch)
+    meta.Session.remove()
+
+def percentile(times, p):
+    times = sorted(times)
+    return times[min(len(times) - 1, int(len(times) * p))]
+
+def run(label, url, profile, count, reads, batch):
+    if profile:
+        engine = tuning.create_engine(url)
+        read_engine = tuning.read_engine(engine)
+    else:
+        engine = sqlalchemy.create_engine(url)
+        read_engine = None
+    model.init_model(engine, profile=profile, read_engine=read_engine)
+    model.Base.metadata.create_all(bind=engine)
+    inbox, = populate(count)
+    inbox.requestStatus(['MESSAGES'])
+    meta.Session.commit()
+
+    stop = threading.Event()
+    delivered = []
+    writer = threading.Thread(target=deliver, args=(stop, batch, delivered))
+    writer.start()
+    times = []
+    try:
+        for i in xrange(reads):
+            start = time.time()
+            inbox.requestStatus(['MESSAGES', 'UNSEEN', 'UIDNEXT'])
+            list(inbox.fetchSummaries(MessageSet(1, 50), False))
+            meta.Session.commit()
+            times.append(time.time() - start)
+    finally:
+        stop.set()
+        writer.join()
+    meta.Session.remove()
+    meta.ReadSession.remove()
+
+    print '%-40s p50 %6.2fms  p99 %7.2fms  max %7.2fms  %5d delivered' % \
+        (label, percentile(times, 0.5) * 1000, percentile(times, 0.99) * 1000,
+         max(times) * 1000, sum(delivered))
+
+def main(count=20000, reads=2000, batch=50):
+    for label, profile in [('STATUS+FETCH, rollback journal', False),
+                           ('STATUS+FETCH, WAL and read session', True)]:
+        directory = tempfile.mkdtemp()
+        try:
+            run(label, 'sqlite:///' + os.path.join(directory, 'mail.db'),
+                profile, count, reads, batch)
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+Benchmark SEARCH BODY with and without the full-text index
+"""
+
+import random
+
+from twisted.mail.imap4 import parseNestedParens
+
+from ponyexpress.model import meta, Message
+from benchmarks import setup, populate, Timer
+
+WORDS = [u'pony', u'express', u'mail', u'server', u'folder', u'message',
+         u'search', u'index', u'trigram', u'query', u'flag', u'tag']
+
+def main(count=100000):
+    setup()
+    inbox, = populate(count)
+
+    # Give every message a different body, so that the search has
+    # something to find
+    rng = random.Random(0)
+    bodies = dict((i, u' '.join(rng.choice(WORDS) for j in xrange(150)))
+                  for i in xrange(1, count + 1))
+    bodies[count // 2] += u' needle'
+    messages = Message.__table__
+    for i, body in bodies.iteritems():
+        meta.Session.execute(messages.update(messages.c.id==i),
+                             {'body': body})
+    meta.Session.commit()
+
+    index = meta.fulltext
+    with Timer('index %s' % index.__class__.__name__, count):
+        index.rebuild()
+        meta.Session.commit()
+
+    for query in ['BODY needle', 'BODY "trigram query"', 'TEXT needle']:
+        meta.fulltext = None
+        with Timer('SEARCH %s (LIKE)' % query):
+            slow = inbox.search(parseNestedParens(query), False)
+        meta.fulltext = index
+        with Timer('SEARCH %s (index)' % query):
+            fast = inbox.search(parseNestedParens(query), False)
+        assert slow == fast
+
+if __name__ == '__main__':
+    main()
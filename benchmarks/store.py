@@ -0,0 +1,30 @@
+"""
+Benchmark STORE on a large folder
+"""
+
+from twisted.mail.imap4 import MessageSet
+
+from ponyexpress.model import meta, Tag, MessageTag
+from benchmarks import setup, populate, Timer
+
+def main(count=100000):
+    setup()
+    inbox, = populate(count)
+    meta.Session.add(Tag(name=ur'\Seen'))
+    meta.Session.commit()
+
+    with Timer('STORE 1:* +FLAGS (\\Seen)', count):
+        inbox.store(MessageSet(1, None), [ur'\Seen'], 1, False)
+    with Timer('STORE 1:* +FLAGS (\\Seen) again', count):
+        inbox.store(MessageSet(1, None), [ur'\Seen'], 1, False)
+    with Timer('STORE 1:* -FLAGS (\\Seen)', count):
+        inbox.store(MessageSet(1, None), [ur'\Seen'], -1, False)
+    with Timer('STORE 1:* FLAGS (\\Seen \\Deleted)', count):
+        inbox.store(MessageSet(1, None), [ur'\Seen', r'\Deleted'], 0, False)
+
+    seen = meta.Session.query(Tag).filter_by(name=ur'\Seen').one()
+    assert meta.Session.query(MessageTag).\
+        filter_by(tag_id=seen.id).count() == count
+
+if __name__ == '__main__':
+    main()
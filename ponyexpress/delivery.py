@@ -0,0 +1,275 @@
+"""
+A local delivery service
+
+Delivering each message from procmail by running a fresh Python
+process means paying for importing SQLAlchemy, setting up the model
+and compiling the mappers every single time, and during a burst of
+mail the processes all fight over the database's write lock.
+
+Instead, a long-running DeliveryFactory listens on a Unix socket (see
+ponyexpress.scripts.deliverd), and procmail pipes each message to the
+tiny client in ponyexpress.scripts.deliver. The service tags each
+message according to its Rules and hands it to a GroupCommitter,
+which saves up deliveries until it has max_batch of them or the
+oldest has waited max_delay seconds, and then commits them all in a
+single transaction. A client isn't told its message was delivered
+until that transaction has committed.
+
+The protocol is line-based:
+
+    DELIVER <size> [<tag> ...]   followed by size bytes of message;
+                                 answered with OK <message id> or
+                                 NO <reason>. Tags are URL-quoted
+    STATS                        answered with STATS and a JSON object
+                                 of the Metrics
+
+Deliveries are committed in the reactor thread, so the service does
+nothing else while a batch commits; that's what the batching is for.
+"""
+
+import json
+import re
+import urllib
+from collections import deque
+
+from twisted.internet import defer, protocol, reactor
+from twisted.protocols import basic
+from twisted.python import log
+
+from ponyexpress.model import meta, Message, Tag
+
+class Rule(object):
+    """
+    Tag messages whose field header matches pattern (a regular
+    expression, searched for case-insensitively) with tags.
+    """
+
+    def __init__(self, field, pattern, tags):
+        self.field = field
+        self.pattern = re.compile(pattern, re.I)
+        self.tags = list(tags)
+
+    @classmethod
+    def parse(cls, spec):
+        """
+        Make a Rule from a string like 'List-Id:dev\\.example\\.com:Lists/dev'.
+        """
+        field, rest = spec.split(':', 1)
+        pattern, tag = rest.rsplit(':', 1)
+        return cls(field, pattern, [tag.decode('utf-8')])
+
+    def match(self, message):
+        return any(self.pattern.search(h.value) for h in message.headers
+                   if h.field.lower() == self.field.lower())
+
+class Metrics(object):
+    """
+    Counters for how the service is doing. Latency is the time from a
+    message being received to it being committed.
+    """
+
+    # How many recent deliveries to work out latency percentiles from
+    window = 1000
+
+    def __init__(self):
+        self.deliveries = 0
+        self.failures = 0
+        self.batches = 0
+        self.max_batch = 0
+        self.max_latency = 0.0
+        self._latency_total = 0.0
+        self._recent = deque(maxlen=self.window)
+
+    def batch(self, size):
+        self.batches += 1
+        self.max_batch = max(self.max_batch, size)
+
+    def delivered(self, latency):
+        self.deliveries += 1
+        self.max_latency = max(self.max_latency, latency)
+        self._latency_total += latency
+        self._recent.append(latency)
+
+    def failed(self):
+        self.failures += 1
+
+    def _percentile(self, p):
+        if not self._recent:
+            return 0.0
+        recent = sorted(self._recent)
+        return recent[min(len(recent) - 1, int(len(recent) * p))]
+
+    def snapshot(self):
+        """
+        Return the metrics as a dict.
+        """
+        return {'deliveries': self.deliveries,
+                'failures': self.failures,
+                'batches': self.batches,
+                'mean_batch': self.batches and
+                    float(self.deliveries) / self.batches or 0.0,
+                'max_batch': self.max_batch,
+                'mean_latency': self.deliveries and
+                    self._latency_total / self.deliveries or 0.0,
+                'p50_latency': self._percentile(0.5),
+                'p99_latency': self._percentile(0.99),
+                'max_latency': self.max_latency}
+
+class GroupCommitter(object):
+    """
+    Collect deliveries and commit them in batches.
+    """
+
+    def __init__(self, max_batch=100, max_delay=0.05, rules=[],
+                 default_tags=[u'INBOX'], clock=reactor):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.rules = list(rules)
+        self.default_tags = list(default_tags)
+        self.clock = clock
+        self.metrics = Metrics()
+        self._pending = []
+        self._timer = None
+
+    def deliver(self, data, tags=()):
+        """
+        Queue a raw message for delivery. Returns a Deferred that
+        fires with the new message's id once it's committed.
+        """
+        d = defer.Deferred()
+        self._pending.append((data, list(tags), self.clock.seconds(), d))
+        if len(self._pending) >= self.max_batch:
+            self.flush()
+        elif self._timer is None:
+            self._timer = self.clock.callLater(self.max_delay, self.flush)
+        return d
+
+    def _tag(self, names, cache):
+        tags = set()
+        for name in names:
+            if name not in cache:
+                t = meta.Session.query(Tag).filter_by(name=name).first()
+                if t is None:
+                    t = Tag(name=name)
+                    meta.Session.add(t)
+                cache[name] = t
+            tags.add(cache[name])
+        return tags
+
+    def _message(self, data, tags, cache):
+        m = Message.fromString(data)
+        names = list(tags) or list(self.default_tags)
+        for rule in self.rules:
+            if rule.match(m):
+                names.extend(rule.tags)
+        m.tags.update(self._tag(names, cache))
+        meta.Session.add(m)
+        return m
+
+    def _commit(self, batch):
+        """
+        Commit a batch of deliveries, returning the ids of the new
+        messages.
+        """
+        cache = {}
+        try:
+            messages = [self._message(data, tags, cache)
+                        for data, tags, _, _ in batch]
+            meta.Session.flush()
+            # Get the ids before committing expires them
+            ids = [m.id for m in messages]
+            meta.Session.commit()
+        except:
+            meta.Session.rollback()
+            raise
+        return ids
+
+    def flush(self):
+        """
+        Commit everything that's waiting.
+        """
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        self.metrics.batch(len(batch))
+
+        try:
+            results = [(d, received, message_id, None) for
+                       (_, _, received, d), message_id in
+                       zip(batch, self._commit(batch))]
+        except Exception:
+            log.err(None, 'Committing a batch of %d failed; retrying '
+                    'them one at a time' % len(batch))
+            # Don't let one bad message take the rest down with it
+            results = []
+            for delivery in batch:
+                try:
+                    message_id, = self._commit([delivery])
+                    results.append((delivery[3], delivery[2], message_id,
+                                    None))
+                except Exception, e:
+                    results.append((delivery[3], delivery[2], None, e))
+
+        now = self.clock.seconds()
+        for d, received, message_id, error in results:
+            if error is None:
+                self.metrics.delivered(now - received)
+                d.callback(message_id)
+            else:
+                self.metrics.failed()
+                d.errback(error)
+
+class DeliveryProtocol(basic.LineReceiver):
+    # Requests are small, but messages can be anything
+    MAX_LENGTH = 4096
+
+    def connectionMade(self):
+        self._size = None
+        self._buffer = []
+        self._received = 0
+
+    def lineReceived(self, line):
+        words = line.split()
+        command = words and words[0].upper() or ''
+        if command == 'DELIVER' and len(words) >= 2 and words[1].isdigit():
+            self._size = int(words[1])
+            self._tags = [urllib.unquote(t).decode('utf-8')
+                          for t in words[2:]]
+            self._buffer = []
+            self._received = 0
+            self.setRawMode()
+            if self._size == 0:
+                self.rawDataReceived('')
+        elif command == 'STATS':
+            self.sendLine('STATS ' + json.dumps(
+                    self.factory.committer.metrics.snapshot()))
+        else:
+            self.sendLine('NO unknown command')
+
+    def rawDataReceived(self, data):
+        wanted = self._size - self._received
+        self._buffer.append(data[:wanted])
+        self._received += len(data[:wanted])
+        if self._received < self._size:
+            return
+        message = ''.join(self._buffer)
+        self._buffer = []
+        d = self.factory.committer.deliver(message, self._tags)
+        d.addCallbacks(lambda message_id: self.sendLine('OK %d' % message_id),
+                       lambda f: self.sendLine(
+                'NO ' + f.getErrorMessage().replace('\n', ' ')))
+        self.setLineMode(data[wanted:])
+
+class DeliveryFactory(protocol.ServerFactory):
+    protocol = DeliveryProtocol
+
+    def __init__(self, committer):
+        self.committer = committer
+
+    def stopFactory(self):
+        # Don't leave anything uncommitted behind
+        self.committer.flush()
@@ -7,18 +7,84 @@ from sqlalchemy import orm
 from ponyexpress.model.base import Base
 from ponyexpress.model.header import Header
 from ponyexpress.model.message_tag import MessageTag
+from ponyexpress.model.mailbox_message import MailboxMessage
+from ponyexpress.model.tag_counter import TagCounter
+from ponyexpress.model.vanished_uid import VanishedUID
+from ponyexpress.model.fulltext_trigram import FullTextTrigram
+from ponyexpress.model.body_dictionary import BodyDictionary
+from ponyexpress.model.blob import Blob
+from ponyexpress.model.mime_part import MimePart
+from ponyexpress.model.envelope import Envelope
+from ponyexpress.model.import_checkpoint import ImportCheckpoint
 from ponyexpress.model.tag import Tag
 from ponyexpress.model.message import Message
 from ponyexpress.model.mailbox import Mailbox
 
 from ponyexpress.model import meta
+from ponyexpress.model.contents import ContentsExtension
+from ponyexpress.model.index import TagIndex, IndexExtension
+from ponyexpress.model.counters import CountersExtension
+from ponyexpress.model.envelopes import EnvelopeExtension
+from ponyexpress.model import fulltext as _fulltext
+from ponyexpress.model.blobs import BlobStore, BlobExtension
+from ponyexpress.model.segments import SegmentStore
+from ponyexpress.model.notify import Notifier, NotifyExtension
+from ponyexpress.model import idsets
+from ponyexpress.model import tuning
 
-def init_model(engine):
-    """Call me before using any of the tables or classes in the model"""
+def init_model(engine, index=False, fulltext=True, compression=None,
+               blobs=None, segments=None, profile=True, read_engine=None):
+    """
+    Call me before using any of the tables or classes in the model
 
-    sm = orm.sessionmaker(autoflush=True, autocommit=False, bind=engine)
+    If index is True, keep an in-memory index of which messages have
+    which tags (see ponyexpress.model.index).
 
+    If fulltext is True, index message text for SEARCH (see
+    ponyexpress.model.fulltext).
+
+    compression, if given, is the codec to compress new message
+    bodies with (see ponyexpress.model.bodies).
+
+    blobs, if given, is a BlobStore to deduplicate message bodies
+    into (see ponyexpress.model.blobs).
+
+    segments, if given, is a SegmentStore to keep raw messages in
+    (see ponyexpress.model.segments).
+
+    If profile is True, set up the engine's connections for serving
+    mail (see ponyexpress.model.tuning).
+
+    read_engine, if given, is a second engine for the same database,
+    used by meta.ReadSession for read-only queries.
+    """
+
+    sm = orm.sessionmaker(autoflush=True, autocommit=False, bind=engine,
+                          extension=[ContentsExtension(), IndexExtension(),
+                                     CountersExtension(),
+                                     EnvelopeExtension(),
+                                     _fulltext.FullTextExtension(),
+                                     BlobExtension(), NotifyExtension(),
+                                     idsets.IdSetExtension()])
+
+    if profile:
+        tuning.tune(engine)
+        if read_engine is not None:
+            tuning.tune(read_engine, read_only=True)
+    idsets.setup(engine)
     meta.engine = engine
     meta.Session = orm.scoped_session(sm)
+    if read_engine is not None:
+        meta.ReadSession = orm.scoped_session(
+            orm.sessionmaker(autoflush=False, autocommit=True,
+                             bind=read_engine))
+    else:
+        meta.ReadSession = meta.Session
+    meta.index = index and TagIndex() or None
+    meta.fulltext = fulltext and _fulltext.for_engine(engine) or None
+    meta.compression = compression
+    meta.blobs = blobs
+    meta.segments = segments
+    meta.notifier = Notifier()
 
     orm.compile_mappers()
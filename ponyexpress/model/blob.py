@@ -0,0 +1,46 @@
+import sqlalchemy as sa
+from sqlalchemy.orm import deferred
+
+from ponyexpress.model.base import Base
+from ponyexpress.model import bodies
+from ponyexpress.model import meta
+
+class Blob(Base):
+    """
+    A message body that may be shared by any number of Messages, keyed
+    by a hash of its contents. These rows are maintained by
+    ponyexpress.model.blobs.
+    """
+    __tablename__ = 'blobs'
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = sa.Column(sa.types.Integer, primary_key=True)
+    # The SHA-1 of the body, encoded as UTF-8
+    hash = sa.Column(sa.types.String(40), nullable=False, unique=True,
+                     index=True)
+    # The number of Messages using this body
+    refcount = sa.Column(sa.types.Integer, nullable=False, default=0)
+    # The size of the body in bytes, encoded as UTF-8
+    size = sa.Column(sa.types.Integer, nullable=False)
+    # The body is either stored in the database like a Message's body
+    # would be (see ponyexpress.model.bodies), or in a file under the
+    # blob store's directory, in which case path is set
+    _body = deferred(sa.Column('body', sa.types.Text), group='body')
+    _compressed_body = deferred(sa.Column('compressed_body',
+                                          sa.types.Binary), group='body')
+    path = sa.Column(sa.types.Text)
+
+    @property
+    def text(self):
+        if self.path is not None:
+            f = open(meta.blobs.filename(self.path), 'rb')
+            try:
+                return f.read().decode('utf-8')
+            finally:
+                f.close()
+        return bodies.decode(self._body, self._compressed_body)
+
+    def getBodyFile(self):
+        if self.path is not None:
+            return open(meta.blobs.filename(self.path), 'rb')
+        return bodies.open_body(self._body, self._compressed_body)
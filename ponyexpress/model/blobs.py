@@ -0,0 +1,323 @@
+"""
+A content-addressed, deduplicated store for message bodies
+
+The same body often gets stored many times over: a message
+cross-posted to several mailing lists, or an import that gets run
+twice. With the blob store enabled (see init_model), bodies are
+stored once each in the blobs table, keyed by a hash of their
+contents, and Messages refer to them by blob_id instead of having a
+body of their own.
+
+Each blob keeps a count of the Messages using it. BlobExtension
+assigns blobs to Messages as they're flushed, and drops a blob once
+nothing refers to it any more.
+
+Several transactions can store the same body at once. Whichever
+inserts its blob second gets an IntegrityError from the unique hash,
+and uses the other one's blob instead. A blob is only deleted if its
+count is still zero when the DELETE runs, so one that's been picked up
+again in the meantime stays.
+
+Bodies larger than the store's threshold can be kept in files under
+its directory instead of in the database, named by their hash. Those
+files are only removed once the transaction that dropped their blob
+commits, and not even then if another transaction has written or
+reused the same file since. Changes to the files are made while
+holding a lock on the directory, so that this check and the removal
+happen together. A file written by a transaction that's rolled back is
+left behind, and will get picked up again the next time that body is
+stored; sweep(), which the compact script runs, cleans up any that
+are never used again.
+
+Like compressed bodies, deduplicated bodies aren't in messages.body,
+so searches decode them (see ponyexpress.model.search).
+
+report() shows how much space deduplication is saving.
+"""
+
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import os
+import time
+from weakref import WeakKeyDictionary
+
+import sqlalchemy as sa
+from sqlalchemy.orm.interfaces import SessionExtension
+
+from ponyexpress.model.blob import Blob
+from ponyexpress.model import bodies
+from ponyexpress.model import meta
+
+blobs = Blob.__table__
+
+def _fsync(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class BlobStore(object):
+    """
+    The configuration and pending file removals for the blob store.
+    """
+
+    def __init__(self, directory=None, threshold=1048576):
+        """
+        Create a BlobStore.
+
+        If directory is given, bodies larger than threshold bytes are
+        kept in files under it.
+        """
+        self.directory = directory
+        self.threshold = threshold
+        # Files to remove once their session commits, with when they
+        # were dropped
+        self._unlink = WeakKeyDictionary()
+
+    def filename(self, path):
+        return os.path.join(self.directory, path)
+
+    @contextmanager
+    def _locked(self):
+        """
+        Hold the lock on the store's directory, which every process
+        and thread using it shares.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        f = open(os.path.join(self.directory, '.lock'), 'a')
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            yield
+        finally:
+            f.close()
+
+    def _write(self, digest, data):
+        path = os.path.join(digest[:2], digest[2:])
+        filename = self.filename(path)
+        with self._locked():
+            if os.path.exists(filename):
+                # Whoever dropped this file last may be about to remove
+                # it; this tells them not to
+                os.utime(filename, None)
+                return path
+            directory = os.path.dirname(filename)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+                _fsync(self.directory)
+            # Write to a temporary file first, so that nobody ever sees
+            # half a body
+            tmp = '%s.%d.tmp' % (filename, os.getpid())
+            f = open(tmp, 'wb')
+            try:
+                f.write(data)
+                # The blob row that points at the file is about to be
+                # committed, so it has to be on disk first, and so
+                # does its name
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+            os.rename(tmp, filename)
+            _fsync(directory)
+        return path
+
+    def _reference(self, blob_id):
+        """
+        Count another reference to a blob. Returns False if the blob
+        has been deleted since it was looked up.
+        """
+        result = meta.Session.execute(blobs.update(
+                blobs.c.id==blob_id,
+                values={'refcount': blobs.c.refcount + 1}))
+        return result.rowcount > 0
+
+    def _insert(self, values):
+        """
+        Insert a blob and return its id, or None if there's already
+        one with the same hash.
+        """
+        # After an error, PostgreSQL won't run anything else in the
+        # transaction unless the error was inside a savepoint. SQLite
+        # only undoes the statement that failed, and pysqlite commits
+        # the transaction before a SAVEPOINT, so it can't have one
+        savepoint = meta.engine.name == 'postgres'
+        if savepoint:
+            meta.Session.begin_nested()
+        try:
+            result = meta.Session.execute(blobs.insert(), values)
+        except sa.exc.IntegrityError:
+            if savepoint:
+                meta.Session.rollback()
+            return None
+        if savepoint:
+            meta.Session.commit()
+        return result.last_inserted_ids()[0]
+
+    def acquire(self, text):
+        """
+        Return the id of the blob holding text, creating it if
+        necessary, and count another reference to it.
+        """
+        data = bodies._bytes(text)
+        digest = hashlib.sha1(data).hexdigest()
+        values = None
+        while True:
+            row = meta.Session.execute(
+                sa.select([blobs.c.id], blobs.c.hash==digest)).fetchone()
+            if row is not None and self._reference(row[0]):
+                return row[0]
+
+            if values is None:
+                values = {'hash': digest, 'refcount': 1, 'size': len(data),
+                          'body': None, 'compressed_body': None,
+                          'path': None}
+                if self.directory is not None and len(data) > self.threshold:
+                    values['path'] = self._write(digest, data)
+                    # If this body was dropped earlier in the
+                    # transaction, its file needs to stay
+                    pending = self._unlink.get(meta.Session(), {})
+                    pending.pop(values['path'], None)
+                else:
+                    values['body'], values['compressed_body'] = \
+                        bodies.encode(text)
+            blob_id = self._insert(values)
+            if blob_id is not None:
+                return blob_id
+            # Another transaction stored the same body since we looked,
+            # so go back and use theirs
+
+    def release(self, blob_id):
+        """
+        Drop a reference to a blob, and remove it if it was the last
+        one.
+        """
+        meta.Session.execute(blobs.update(
+                blobs.c.id==blob_id,
+                values={'refcount': blobs.c.refcount - 1}))
+        row = meta.Session.execute(sa.select([blobs.c.refcount, blobs.c.path],
+                                             blobs.c.id==blob_id)).fetchone()
+        if row is None or row[0] > 0:
+            return
+        # The count is checked again by the DELETE itself, in case
+        # another transaction has picked the blob up in the meantime
+        result = meta.Session.execute(blobs.delete(
+                sa.and_(blobs.c.id==blob_id, blobs.c.refcount <= 0)))
+        if result.rowcount and row[1] is not None:
+            self._unlink.setdefault(meta.Session(), {})[row[1]] = time.time()
+
+    def commit(self, session):
+        pending = self._unlink.pop(session, {})
+        if not pending:
+            return
+        with self._locked():
+            for path, dropped in pending.iteritems():
+                filename = self.filename(path)
+                try:
+                    # Another transaction has written or reused the
+                    # file since this one dropped it
+                    if os.path.getmtime(filename) > dropped:
+                        continue
+                    os.unlink(filename)
+                except OSError:
+                    pass
+
+    def rollback(self, session):
+        self._unlink.pop(session, None)
+
+    def texts(self, blob_ids):
+        """
+        Return a dict mapping each of blob_ids to its text.
+        """
+        return dict((b.id, b.text) for b in \
+                        meta.Session.query(Blob).filter(Blob.id.in_(blob_ids)))
+
+    def sweep(self, min_age=3600):
+        """
+        Remove any files in the store's directory that don't belong to
+        a blob. Returns the number of files removed.
+
+        A file that was written or reused in the last min_age seconds
+        is left alone, since the transaction that did it may not have
+        committed its blob yet. Transactions that last longer than
+        that can lose their files, so don't make it any shorter on a
+        live server.
+        """
+        if self.directory is None:
+            return 0
+        used = set(r[0] for r in meta.Session.execute(
+                sa.select([blobs.c.path], blobs.c.path!=None)))
+        cutoff = time.time() - min_age
+        removed = 0
+        with self._locked():
+            for dirpath, dirnames, filenames in os.walk(self.directory):
+                for name in filenames:
+                    filename = os.path.join(dirpath, name)
+                    path = os.path.relpath(filename, self.directory)
+                    if path == '.lock' or path in used or \
+                            os.path.getmtime(filename) > cutoff:
+                        continue
+                    os.unlink(filename)
+                    removed += 1
+        return removed
+
+def report():
+    """
+    Return a dict describing how much space deduplication saves:
+
+     - messages: the number of Messages using blobs
+     - blobs: the number of distinct bodies stored
+     - logical: the total size of those Messages' bodies, in bytes
+     - stored: the total size of the bodies actually stored
+     - on_disk: how much of stored is in files rather than the database
+     - saved: logical - stored
+    """
+    messages, blob_count, logical, stored = meta.Session.execute(
+        sa.select([sa.func.sum(blobs.c.refcount),
+                   sa.func.count(blobs.c.id),
+                   sa.func.sum(blobs.c.size * blobs.c.refcount),
+                   sa.func.sum(blobs.c.size)])).fetchone()
+    on_disk = meta.Session.execute(
+        sa.select([sa.func.sum(blobs.c.size)], blobs.c.path!=None)).scalar()
+    logical = logical or 0
+    stored = stored or 0
+    return {'messages': messages or 0,
+            'blobs': blob_count,
+            'logical': logical,
+            'stored': stored,
+            'on_disk': on_disk or 0,
+            'saved': logical - stored}
+
+class BlobExtension(SessionExtension):
+    """
+    Move the bodies of Messages being flushed into the blob store, and
+    drop the blobs of Messages being deleted.
+    """
+
+    def before_flush(self, session, flush_context, instances):
+        from ponyexpress.model.message import Message
+
+        store = meta.blobs
+        if store is None:
+            return
+
+        for obj in list(session.new) + list(session.dirty):
+            if isinstance(obj, Message) and '_pending_body' in obj.__dict__:
+                body = obj.__dict__.pop('_pending_body')
+                old = obj.blob_id
+                obj.blob_id = body is not None and store.acquire(body) or None
+                if old is not None:
+                    store.release(old)
+        for obj in session.deleted:
+            if isinstance(obj, Message) and obj.blob_id is not None:
+                store.release(obj.blob_id)
+
+    def after_commit(self, session):
+        if meta.blobs is not None:
+            meta.blobs.commit(session)
+
+    def after_rollback(self, session):
+        if meta.blobs is not None:
+            meta.blobs.rollback(session)
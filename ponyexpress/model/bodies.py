@@ -0,0 +1,310 @@
+"""
+Compressed message bodies
+
+Most of the database is message bodies, and message bodies compress
+well. A Message's body is stored in one of two columns:
+
+ - messages.body, as plain text, which is what happens when
+   compression is off (the default)
+
+ - messages.compressed_body, as a compressed blob, when init_model
+   is given one of the codecs below
+
+Each blob starts with a byte saying how it was compressed, so a
+database can hold a mix of plain bodies and bodies compressed in
+different ways, and the codec can be changed at any time. Existing
+bodies can be converted in batches with recompress().
+
+The codecs are:
+
+ - Zlib, which is plain zlib at a configurable level
+
+ - ZlibDictionary, which primes zlib with a shared dictionary of
+   text that's common across messages (typical header and footer
+   lines, MIME boilerplate, and so on) before compressing each
+   body. This makes a big difference for small messages, which
+   otherwise don't have enough text for zlib to find much to
+   reuse. Python's zlib module has no API for preset dictionaries,
+   so the dictionary is compressed first and the output up to that
+   point is left off the stored blob; decompressing feeds the same
+   prefix back in first. Dictionaries are built with train() and
+   stored in the body_dictionaries table.
+
+Compressed bodies can't be searched with LIKE, so searches for BODY
+and TEXT either use the full-text index (see
+ponyexpress.model.fulltext), when it can give an exact answer, or
+decompress the bodies and check them in Python (see
+ponyexpress.model.search).
+
+open_body() returns a file-like object for a message's body that inflates
+it a piece at a time, so that sending a large body to a client
+doesn't mean holding the whole thing in memory.
+"""
+
+import struct
+import zlib
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+import sqlalchemy as sa
+
+from ponyexpress.model.body_dictionary import BodyDictionary
+from ponyexpress.model import meta
+from ponyexpress.util.chunks import chunked
+
+# The first byte of each compressed blob
+ZLIB = 'z'
+DICTIONARY = 'd'
+
+# The number of messages to recompress per transaction
+chunk_size = 500
+
+# Dictionaries by id, as (data, decompressor) pairs, where the
+# decompressor has already been fed the dictionary. Dictionaries never
+# change once they've been stored, so it's safe to keep them around
+_primed = {}
+
+def _prime(dictionary_id):
+    if dictionary_id not in _primed:
+        data = str(meta.Session.query(BodyDictionary.data).\
+                       filter_by(id=dictionary_id).one()[0])
+        # Inflating only depends on the text that came before, not on
+        # how it was compressed, so any compression level will do
+        # here
+        compressor = zlib.compressobj()
+        decompressor = zlib.decompressobj()
+        decompressor.decompress(compressor.compress(data) +
+                                compressor.flush(zlib.Z_SYNC_FLUSH))
+        _primed[dictionary_id] = (data, decompressor)
+    return _primed[dictionary_id]
+
+def _bytes(text):
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return str(text)
+
+class Zlib(object):
+    """
+    Compress bodies with zlib.
+    """
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def encode(self, data):
+        return ZLIB + zlib.compress(data, self.level)
+
+class ZlibDictionary(object):
+    """
+    Compress bodies with zlib, primed with a shared dictionary.
+
+    Bodies larger than threshold have plenty of their own text for
+    zlib to work with, so they're compressed without the dictionary.
+    """
+
+    def __init__(self, dictionary_id, level=6, threshold=65536):
+        self.id = dictionary_id
+        self.level = level
+        self.threshold = threshold
+        self._fallback = Zlib(level)
+        self._compressor = None
+
+    def encode(self, data):
+        if len(data) > self.threshold:
+            return self._fallback.encode(data)
+        if self._compressor is None:
+            # Compress the dictionary once, and start each body from a
+            # copy of the compressor's state after that. The output up
+            # to this point gets thrown away
+            dictionary, _ = _prime(self.id)
+            self._compressor = zlib.compressobj(self.level)
+            self._compressor.compress(dictionary)
+            self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        compressor = self._compressor.copy()
+        return DICTIONARY + struct.pack('>I', self.id) + \
+            compressor.compress(data) + compressor.flush()
+
+def _decompressor(blob):
+    """
+    Return a decompressor for a compressed blob, and the offset in
+    blob where the compressed data starts.
+    """
+    kind = blob[:1]
+    if kind == ZLIB:
+        return zlib.decompressobj(), 1
+    elif kind == DICTIONARY:
+        dictionary_id, = struct.unpack('>I', blob[1:5])
+        return _prime(dictionary_id)[1].copy(), 5
+    raise ValueError('Unknown body compression %r' % kind)
+
+def encode(text):
+    """
+    Return the (body, compressed_body) column values for a body,
+    using the codec configured by init_model.
+    """
+    if text is None or meta.compression is None:
+        return text, None
+    return None, meta.compression.encode(_bytes(text))
+
+def decode(body, compressed_body):
+    """
+    Return the text of a body, given its column values.
+    """
+    if compressed_body is None:
+        return body
+    blob = str(compressed_body)
+    decompressor, start = _decompressor(blob)
+    data = decompressor.decompress(blob[start:]) + decompressor.flush()
+    return data.decode('utf-8')
+
+class InflatingFile(object):
+    """
+    A read-only file over a compressed body, which decompresses it as
+    it's read.
+    """
+
+    # The most input to feed to zlib at a time
+    read_size = 16384
+
+    def __init__(self, blob):
+        self.blob = blob
+        self.seek(0)
+
+    def _fill(self, size):
+        # Inflate until there are at least size bytes buffered, or
+        # there's nothing left
+        while (size < 0 or len(self.buffer) < size) and not self.done:
+            if self.pending:
+                chunk = self.decompressor.decompress(self.pending,
+                                                     self.read_size)
+                self.pending = self.decompressor.unconsumed_tail
+            elif self.offset < len(self.blob):
+                data = self.blob[self.offset:self.offset + self.read_size]
+                self.offset += len(data)
+                chunk = self.decompressor.decompress(data, self.read_size)
+                self.pending = self.decompressor.unconsumed_tail
+            else:
+                chunk = self.decompressor.flush()
+                self.done = True
+            self.buffer += chunk
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0:
+            data, self.buffer = self.buffer, ''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.position += len(data)
+        return data
+
+    def readline(self):
+        while '\n' not in self.buffer and not self.done:
+            self._fill(len(self.buffer) + 1)
+        i = self.buffer.find('\n')
+        if i < 0:
+            return self.read()
+        return self.read(i + 1)
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            raise IOError('Cannot seek from the end of a compressed body')
+        if offset < getattr(self, 'position', 0) or \
+                not hasattr(self, 'decompressor'):
+            # Going backwards means starting over
+            self.decompressor, self.offset = _decompressor(self.blob)
+            self.pending = ''
+            self.buffer = ''
+            self.done = False
+            self.position = 0
+        # Skip forwards a piece at a time
+        while self.position < offset:
+            if not self.read(min(offset - self.position, self.read_size)):
+                break
+
+    def close(self):
+        self.buffer = ''
+
+def open_body(body, compressed_body):
+    """
+    Return a file-like object for the bytes of a body, given its
+    column values.
+    """
+    if compressed_body is None:
+        return StringIO(_bytes(body or u''))
+    return InflatingFile(str(compressed_body))
+
+def train(samples, size=32768):
+    """
+    Build a dictionary from sample bodies.
+
+    This picks the lines that show up in more than one sample, with
+    the most common ones last, since zlib finds matches closest to
+    the data it's compressing most cheaply. zlib only looks back
+    32 KiB, so there's no point in a bigger dictionary.
+    """
+    counts = {}
+    for sample in samples:
+        for line in set(_bytes(sample).splitlines(True)):
+            counts[line] = counts.get(line, 0) + 1
+    lines = [l for l in counts if counts[l] > 1]
+    lines.sort(key=lambda l: (counts[l] * len(l), l))
+    dictionary = ''.join(lines)
+    return dictionary[-size:]
+
+def create_dictionary(samples, size=32768):
+    """
+    Train a dictionary on sample bodies and store it, returning its
+    id for use with ZlibDictionary.
+    """
+    d = BodyDictionary(data=train(samples, size))
+    meta.Session.add(d)
+    meta.Session.flush()
+    return d.id
+
+def recompress(codec, batch_size=None):
+    """
+    Re-encode every message body with codec (or decompress them all,
+    if codec is None), committing after each batch of messages so that
+    this can be run against a live database.
+
+    Returns the number of messages that were changed.
+    """
+    from ponyexpress.model.message import Message
+    messages = Message.__table__
+
+    saved = meta.compression
+    meta.compression = codec
+    changed = 0
+    try:
+        ids = [r[0] for r in meta.Session.query(Message.id).order_by(Message.id)]
+        for chunk in chunked(ids, batch_size or chunk_size):
+            rows = []
+            for message_id, body, compressed_body in meta.Session.execute(
+                sa.select([messages.c.id, messages.c.body,
+                           messages.c.compressed_body],
+                          messages.c.id.in_(chunk))):
+                new_body, new_compressed = encode(decode(body, compressed_body))
+                rows.append({'message_id': message_id,
+                             'new_body': new_body,
+                             'new_compressed': new_compressed})
+            if rows:
+                meta.Session.execute(messages.update(
+                        messages.c.id==sa.bindparam('message_id'),
+                        values={'body': sa.bindparam('new_body'),
+                                'compressed_body':
+                                    sa.bindparam('new_compressed',
+                                                 type_=sa.types.Binary)}),
+                                     rows)
+                changed += len(rows)
+            meta.Session.commit()
+    finally:
+        meta.compression = saved
+    return changed
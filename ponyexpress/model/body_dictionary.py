@@ -0,0 +1,15 @@
+import sqlalchemy as sa
+
+from ponyexpress.model.base import Base
+
+class BodyDictionary(Base):
+    """
+    A shared zlib dictionary for compressing message bodies. Bodies
+    compressed with a dictionary refer to it by id, so these rows
+    must never change or go away. See ponyexpress.model.bodies.
+    """
+    __tablename__ = 'body_dictionaries'
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = sa.Column(sa.types.Integer, primary_key=True)
+    data = sa.Column(sa.types.Binary, nullable=False)
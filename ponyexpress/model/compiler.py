@@ -0,0 +1,357 @@
+"""
+A compiler for Mailbox queries
+
+A Mailbox query (see Mailbox.query) is a nested tuple of tag names,
+tag ids and operators, evaluated left to right. Turning that directly
+into a chain of INTERSECT/UNION/EXCEPT queries means one join against
+tags per leaf and no freedom for the database to reorder anything.
+
+Instead, the query is compiled in a few steps:
+
+ 1. normalize() turns it into a tree of ('and', [...]), ('or', [...]),
+    ('not', node), ('tag', id), ('all',) and ('none',) nodes, resolving
+    all of the tag names to ids in a single query, flattening nested
+    operators and folding away constants.
+
+ 2. plan() looks up how many messages have each tag, also in a single
+    query, and sorts the children of every node so that the most
+    selective intersections come first.
+
+ 3. compile_tree() emits one SELECT over messages_tags, grouping by
+    message_id and testing the whole boolean expression in a HAVING
+    clause. When the query has a positive tag that every match must
+    have, the scan is restricted to the messages with the smallest
+    such tag.
+
+compile_query() runs all three steps, and explain() shows the plan and
+the SQL that a query compiles to.
+
+When the in-memory tag index is enabled, evaluate() can answer a
+normalized query from the index without going to the database at all.
+"""
+
+import sqlalchemy as sa
+
+from ponyexpress.model.message_tag import MessageTag
+from ponyexpress.model import meta
+from ponyexpress.util.bitmap import Bitmap
+
+messages_tags = MessageTag.__table__
+
+ALL = ('all',)
+NONE = ('none',)
+
+def _names(query, names):
+    """
+    Collect every tag name used in query into the set names.
+    """
+    if isinstance(query, basestring):
+        if query != '*':
+            names.add(query)
+    elif not isinstance(query, int):
+        for q in query[::2]:
+            _names(q, names)
+
+def _build(query, ids):
+    """
+    Turn a query into a tree, using the dict ids to look up tag names.
+    """
+    if query == '*':
+        return ALL
+    elif isinstance(query, basestring):
+        if query in ids:
+            return ('tag', ids[query])
+        else:
+            # There's no such tag, so nothing can have it
+            return NONE
+    elif isinstance(query, int):
+        return ('tag', query)
+    else:
+        query = list(query)
+        node = _build(query.pop(0), ids)
+        while query:
+            op, next = query[0:2]
+            next = _build(next, ids)
+            if op == '&':
+                node = ('and', [node, next])
+            elif op == '|':
+                node = ('or', [node, next])
+            elif op == '-':
+                node = ('and', [node, ('not', next)])
+            del query[0:2]
+        return node
+
+def _simplify(node):
+    """
+    Flatten nested operators of the same kind, and fold away ALL and
+    NONE wherever possible.
+    """
+    kind = node[0]
+    if kind == 'not':
+        child = _simplify(node[1])
+        if child == ALL:
+            return NONE
+        elif child == NONE:
+            return ALL
+        elif child[0] == 'not':
+            return child[1]
+        return ('not', child)
+    elif kind in ('and', 'or'):
+        # The identity element and the absorbing element
+        if kind == 'and':
+            identity, absorb = ALL, NONE
+        else:
+            identity, absorb = NONE, ALL
+
+        children = []
+        for child in node[1]:
+            child = _simplify(child)
+            if child == absorb:
+                return absorb
+            elif child == identity:
+                continue
+            elif child[0] == kind:
+                children.extend(child[1])
+            elif child not in children:
+                children.append(child)
+
+        if not children:
+            return identity
+        elif len(children) == 1:
+            return children[0]
+        return (kind, children)
+    else:
+        return node
+
+def normalize(query):
+    """
+    Convert a Mailbox query into a simplified tree, with all tag names
+    resolved to ids.
+    """
+    from ponyexpress.model.tag import Tag
+
+    names = set()
+    _names(query, names)
+    if names:
+        ids = dict((r[1], r[0]) for r in \
+                       meta.Session.query(Tag.id, Tag.name).\
+                       filter(Tag.name.in_(names)))
+    else:
+        ids = {}
+    return _simplify(_build(query, ids))
+
+def tags(node):
+    """
+    Return the set of tag ids referenced by a tree.
+    """
+    if node[0] == 'tag':
+        return set([node[1]])
+    elif node[0] == 'not':
+        return tags(node[1])
+    elif node[0] in ('and', 'or'):
+        result = set()
+        for child in node[1]:
+            result |= tags(child)
+        return result
+    return set()
+
+def estimate(node, counts, total):
+    """
+    Estimate the number of messages that match a tree, given the
+    number of messages with each tag and the total number of
+    messages.
+    """
+    kind = node[0]
+    if kind == 'all':
+        return total
+    elif kind == 'none':
+        return 0
+    elif kind == 'tag':
+        return counts.get(node[1], 0)
+    elif kind == 'not':
+        return max(total - estimate(node[1], counts, total), 0)
+    elif kind == 'and':
+        return min(estimate(c, counts, total) for c in node[1])
+    elif kind == 'or':
+        return min(sum(estimate(c, counts, total) for c in node[1]), total)
+
+def _order(node, counts, total):
+    """
+    Sort the children of every node in a tree so that the smallest
+    sets come first.
+    """
+    if node[0] == 'not':
+        return ('not', _order(node[1], counts, total))
+    elif node[0] in ('and', 'or'):
+        children = [_order(c, counts, total) for c in node[1]]
+        children.sort(key=lambda c: estimate(c, counts, total))
+        return (node[0], children)
+    return node
+
+def plan(query):
+    """
+    Normalize a query and order it by tag cardinality.
+
+    Returns a tuple of (tree, counts, total), where counts maps each
+    referenced tag id to the number of messages with that tag, and
+    total is the total number of messages.
+    """
+    from ponyexpress.model.message import Message
+
+    node = normalize(query)
+    ids = tags(node)
+    if ids:
+        counts = dict(meta.Session.execute(
+                sa.select([messages_tags.c.tag_id,
+                           sa.func.count(messages_tags.c.message_id)],
+                          messages_tags.c.tag_id.in_(ids),
+                          group_by=[messages_tags.c.tag_id])).fetchall())
+    else:
+        counts = {}
+    total = meta.Session.query(sa.func.count(Message.id)).scalar()
+    return _order(node, counts, total), counts, total
+
+def _having(node):
+    """
+    Convert a tree into a boolean expression over aggregates of a
+    group of messages_tags rows for a single message.
+    """
+    kind = node[0]
+    if kind == 'tag':
+        return sa.func.max(sa.case([(messages_tags.c.tag_id==node[1], 1)],
+                                   else_=0)) == 1
+    elif kind == 'not':
+        return sa.not_(_having(node[1]))
+    elif kind == 'and':
+        return sa.and_(*[_having(c) for c in node[1]])
+    elif kind == 'or':
+        return sa.or_(*[_having(c) for c in node[1]])
+
+def _matches_nothing(node):
+    """
+    Return whether a message with none of the referenced tags would
+    match a tree.
+    """
+    kind = node[0]
+    if kind == 'all':
+        return True
+    elif kind in ('none', 'tag'):
+        return False
+    elif kind == 'not':
+        return not _matches_nothing(node[1])
+    elif kind == 'and':
+        return all(_matches_nothing(c) for c in node[1])
+    elif kind == 'or':
+        return any(_matches_nothing(c) for c in node[1])
+
+def compile_tree(node):
+    """
+    Compile a planned tree into a single SELECT statement returning
+    the matching message ids.
+    """
+    from ponyexpress.model.message import Message
+    messages = Message.__table__
+
+    if node == ALL:
+        return sa.select([messages.c.id])
+    elif node == NONE:
+        # The primary key is never NULL, so this never matches
+        return sa.select([messages.c.id], messages.c.id==None)
+
+    ids = tags(node)
+    if _matches_nothing(node):
+        # Messages without any of the tags we're looking at can match,
+        # so we need to start from every message, not just the ones
+        # with rows in messages_tags
+        return sa.select([messages.c.id],
+                         from_obj=[messages.outerjoin(messages_tags,
+                             sa.and_(messages_tags.c.message_id==messages.c.id,
+                                     messages_tags.c.tag_id.in_(ids)))],
+                         group_by=[messages.c.id],
+                         having=_having(node))
+
+    where = messages_tags.c.tag_id.in_(ids)
+    # Every match has to have the first tag of an intersection (or
+    # the only tag), which is also the most selective one, so only
+    # look at those messages
+    driver = node
+    if driver[0] == 'and':
+        positive = [c for c in driver[1] if c[0] == 'tag']
+        driver = positive and positive[0] or None
+    if driver is not None and driver[0] == 'tag' and len(ids) > 1:
+        inner = messages_tags.alias()
+        where = sa.and_(where, messages_tags.c.message_id.in_(
+                sa.select([inner.c.message_id], inner.c.tag_id==driver[1])))
+    return sa.select([messages_tags.c.message_id],
+                     where,
+                     group_by=[messages_tags.c.message_id],
+                     having=_having(node))
+
+def evaluate(node, index):
+    """
+    Evaluate a normalized tree against a TagIndex, returning a Bitmap
+    of the matching message ids.
+    """
+    kind = node[0]
+    if kind == 'all':
+        return index.all()
+    elif kind == 'none':
+        return Bitmap()
+    elif kind == 'tag':
+        return index.get(node[1])
+    elif kind == 'not':
+        return index.all() - evaluate(node[1], index)
+    elif kind == 'and':
+        # Subtracting the negated children, rather than intersecting
+        # with their complements, saves building the complement
+        positive = [c for c in node[1] if c[0] != 'not']
+        negative = [c[1] for c in node[1] if c[0] == 'not']
+        if positive:
+            result = evaluate(positive[0], index)
+            for c in positive[1:]:
+                result = result & evaluate(c, index)
+        else:
+            result = index.all()
+        for c in negative:
+            result = result - evaluate(c, index)
+        return result
+    elif kind == 'or':
+        result = Bitmap()
+        for c in node[1]:
+            result = result | evaluate(c, index)
+        return result
+
+def compile_query(query):
+    """
+    Compile a Mailbox query into a single SELECT statement returning
+    the matching message ids.
+    """
+    return compile_tree(plan(query)[0])
+
+def explain(query):
+    """
+    Return a human-readable description of how a query will be
+    executed: the planned tree, annotated with estimated
+    cardinalities, followed by the SQL it compiles to.
+    """
+    node, counts, total = plan(query)
+
+    lines = []
+    def describe(node, depth):
+        kind = node[0]
+        if kind == 'tag':
+            label = 'tag %d' % node[1]
+        else:
+            label = kind
+        lines.append('%s%s (~%d)' % ('  ' * depth, label,
+                                     estimate(node, counts, total)))
+        if kind == 'not':
+            describe(node[1], depth + 1)
+        elif kind in ('and', 'or'):
+            for c in node[1]:
+                describe(c, depth + 1)
+    describe(node, 0)
+
+    lines.append('')
+    lines.append(str(compile_tree(node).compile(bind=meta.engine)))
+    return '\n'.join(lines)
@@ -0,0 +1,172 @@
+"""
+Materialized Mailbox contents
+
+Evaluating a Mailbox's query means running a compound query over every
+message in the database, which is far too expensive to do every time
+a client lists, selects or asks for the status of a folder. Instead,
+the ids of the messages in each Mailbox are stored in the
+mailboxes_messages table, and kept up to date as messages are tagged,
+untagged, created and deleted.
+
+Updates are incremental: when a set of messages changes, only those
+messages are re-checked, and only against the mailboxes whose queries
+reference the tags that changed.
+
+Changes made through the ORM are picked up by ContentsExtension, which
+init_model installs on the session. Code that changes messages_tags
+directly (such as ponyexpress.model.store) needs to call update()
+itself.
+
+A database created before this table existed can be brought up to
+date with rebuild_all().
+"""
+
+import sqlalchemy as sa
+from sqlalchemy.orm.interfaces import SessionExtension
+
+from ponyexpress.model.mailbox_message import MailboxMessage
+from ponyexpress.model.message_tag import MessageTag
+from ponyexpress.model import meta
+from ponyexpress.util.chunks import chunked
+
+mailboxes_messages = MailboxMessage.__table__
+messages_tags = MessageTag.__table__
+
+# The number of messages to re-check per statement
+chunk_size = 500
+
+def rebuild(mailbox_id, query):
+    """
+    Recompute the contents of a single mailbox from scratch.
+    """
+    from ponyexpress.model.mailbox import Mailbox
+
+    meta.Session.execute(mailboxes_messages.delete(
+            mailboxes_messages.c.mailbox_id==mailbox_id))
+    rows = [{'mailbox_id': mailbox_id, 'message_id': m}
+            for m in Mailbox.parseQuery(query)]
+    if rows:
+        meta.Session.execute(mailboxes_messages.insert(), rows)
+
+def rebuild_all():
+    """
+    Recompute the contents of every mailbox from scratch.
+    """
+    from ponyexpress.model.mailbox import Mailbox
+
+    for mailbox_id, query in meta.Session.query(Mailbox.id, Mailbox.query):
+        rebuild(mailbox_id, query)
+
+def update(message_ids, tag_ids=None):
+    """
+    Bring the contents of every mailbox up to date for the messages in
+    message_ids.
+
+    tag_ids, if given, is the set of tags that were added to or
+    removed from those messages; mailboxes whose queries don't
+    reference any of those tags can't have changed, so they're
+    skipped. Pass None if the messages themselves were created or
+    deleted, or if it's not known which tags changed.
+    """
+    from ponyexpress.model.mailbox import Mailbox
+    from ponyexpress.model.message import Message
+    from ponyexpress.model.tag import Tag
+
+    message_ids = list(message_ids)
+    if not message_ids:
+        return
+
+    mailboxes = meta.Session.query(Mailbox.id, Mailbox.query).all()
+    if tag_ids is not None:
+        tag_ids = set(tag_ids)
+        tags = meta.Session.query(Tag.id, Tag.name).\
+            filter(Tag.id.in_(tag_ids)).all()
+        tag_names = set(r[1] for r in tags)
+    # If some of the tags have been deleted, we can't find out what
+    # their names were, so we have to check everything
+    if tag_ids is not None and len(tags) == len(tag_ids):
+        affected = []
+        for mailbox_id, query in mailboxes:
+            names, ids = Mailbox.queryTags(query)
+            if names & tag_names or ids & tag_ids:
+                affected.append((mailbox_id, query))
+        mailboxes = affected
+    if not mailboxes:
+        return
+
+    for chunk in chunked(message_ids, chunk_size):
+        # Messages that have been deleted don't belong anywhere
+        exists = set(r[0] for r in meta.Session.query(Message.id).\
+                         filter(Message.id.in_(chunk)))
+
+        names = dict((m, set()) for m in chunk)
+        ids = dict((m, set()) for m in chunk)
+        for message_id, tag_id, name in meta.Session.execute(
+            sa.select([messages_tags.c.message_id, Tag.id, Tag.name],
+                      sa.and_(messages_tags.c.tag_id==Tag.id,
+                              messages_tags.c.message_id.in_(chunk)))):
+            names[message_id].add(name)
+            ids[message_id].add(tag_id)
+
+        current = set((r[0], r[1]) for r in meta.Session.execute(
+                sa.select([mailboxes_messages.c.mailbox_id,
+                           mailboxes_messages.c.message_id],
+                          sa.and_(mailboxes_messages.c.mailbox_id.in_(
+                                [mb[0] for mb in mailboxes]),
+                                  mailboxes_messages.c.message_id.in_(chunk)))))
+
+        insert = []
+        for mailbox_id, query in mailboxes:
+            remove = []
+            for m in chunk:
+                match = m in exists and \
+                    Mailbox.matchQuery(query, names[m], ids[m])
+                if match and (mailbox_id, m) not in current:
+                    insert.append({'mailbox_id': mailbox_id,
+                                   'message_id': m})
+                elif not match and (mailbox_id, m) in current:
+                    remove.append(m)
+            if remove:
+                meta.Session.execute(mailboxes_messages.delete(
+                        sa.and_(mailboxes_messages.c.mailbox_id==mailbox_id,
+                                mailboxes_messages.c.message_id.in_(remove))))
+        if insert:
+            meta.Session.execute(mailboxes_messages.insert(), insert)
+
+class ContentsExtension(SessionExtension):
+    """
+    Keep mailbox contents up to date with changes flushed through the
+    ORM.
+    """
+
+    def after_flush(self, session, flush_context):
+        from ponyexpress.model.mailbox import Mailbox
+        from ponyexpress.model.message import Message
+
+        # Messages that were created or deleted, which could affect
+        # any mailbox
+        messages = set()
+        # Messages that were tagged or untagged, and with what
+        message_ids = set()
+        tag_ids = set()
+        for obj in list(session.new) + list(session.deleted):
+            if isinstance(obj, MessageTag):
+                message_ids.add(obj.message_id)
+                tag_ids.add(obj.tag_id)
+            elif isinstance(obj, Message):
+                messages.add(obj.id)
+
+        for obj in session.deleted:
+            if isinstance(obj, Mailbox):
+                session.execute(mailboxes_messages.delete(
+                        mailboxes_messages.c.mailbox_id==obj.id))
+        for obj in list(session.new) + list(session.dirty):
+            if isinstance(obj, Mailbox) and obj not in session.deleted and \
+                    (obj in session.new or session.is_modified(obj)):
+                rebuild(obj.id, obj.query)
+
+        message_ids.discard(None)
+        if messages:
+            update(messages)
+        if message_ids - messages:
+            update(message_ids - messages, tag_ids)
@@ -0,0 +1,311 @@
+"""
+Cached STATUS counters for tags
+
+Clients poll STATUS on every folder every few seconds, and answering
+it from scratch means counting every message in the folder, checking
+each one for \\Seen, and finding the highest UID. Instead, those values
+are kept in the tag_counters table, one row per tag, and adjusted in
+the same transaction as whatever changed them.
+
+Changes are described as before and after snapshots: dicts mapping
+each affected message id to the set of tag ids it has. From those,
+update() works out how many messages each tag gained or lost, how many
+of them were unseen, and which folders need their UIDNEXT and modseq
+bumped.
+
+A counter row is created, by counting from scratch, the first time
+its folder changes. Until then, reading the counters counts them
+without storing anything, so that STATUS never needs a write (which
+would hold SQLite's write lock until the reader's session ended). If
+two transactions create the same row at once, the second one's insert
+fails, and it adds its change to the first one's row instead.
+
+Every change also gives the messages_tags rows it touched the folder's
+new modseq, and leaves a VanishedUID tombstone for each row it
+removed, so that a reconnecting client can ask for just what changed
+since the modseq it last saw (CONDSTORE and QRESYNC).
+"""
+
+import sqlalchemy as sa
+from sqlalchemy.orm.interfaces import SessionExtension
+
+from ponyexpress.model.message_tag import MessageTag
+from ponyexpress.model.tag_counter import TagCounter
+from ponyexpress.model.vanished_uid import VanishedUID
+from ponyexpress.model import meta
+from ponyexpress.model.idsets import match
+
+messages_tags = MessageTag.__table__
+tag_counters = TagCounter.__table__
+vanished_uids = VanishedUID.__table__
+
+def _seen():
+    from ponyexpress.model.tag import Tag
+    return meta.Session.query(Tag.id).filter_by(name=ur'\Seen').scalar()
+
+def snapshot(message_ids):
+    """
+    Return a dict mapping each message id in message_ids to the set of
+    tag ids it currently has.
+    """
+    result = dict((m, set()) for m in message_ids)
+    if result:
+        for m, t in meta.Session.execute(
+            sa.select([messages_tags.c.message_id, messages_tags.c.tag_id],
+                      match(messages_tags.c.message_id, result.keys()))):
+            result[m].add(t)
+    return result
+
+def _adjust(params):
+    """
+    Apply changes to the counter rows they're for. Each of params is
+    a dict of the tag id 't', the change in the message count 'dm'
+    and in the unseen count 'du', and the lowest the UIDNEXT can now
+    be 'un'.
+    """
+    # The parameter names can't match any column names, or they'd be
+    # taken as new values for those columns
+    meta.Session.execute(tag_counters.update(
+            tag_counters.c.tag_id==sa.bindparam('t'),
+            values={'messages': tag_counters.c.messages + sa.bindparam('dm'),
+                    'unseen': tag_counters.c.unseen + sa.bindparam('du'),
+                    'uidnext': sa.case([(tag_counters.c.uidnext <
+                                         sa.bindparam('un'),
+                                         sa.bindparam('un'))],
+                                       else_=tag_counters.c.uidnext),
+                    'modseq': tag_counters.c.modseq + 1}),
+                         params)
+
+def update(before, after, touched=(), rows=(), vanished=()):
+    """
+    Adjust the counters for a change to some messages' tags.
+
+    before and after are snapshots of the messages from before and
+    after the change. Messages that were created should be in before
+    with no tags, and messages that were deleted should be in after
+    with no tags.
+
+    touched is a list of additional tag ids whose folders changed in a
+    way that isn't reflected in the snapshots; their modseq is bumped.
+    rows is a list of (message_id, tag_id) pairs whose flags changed
+    that way, such as a message's \\Deleted flag changing.
+
+    vanished is a list of (uid, message_id, tag_id) for the
+    messages_tags rows that were removed.
+    """
+    seen = _seen()
+
+    messages = {}
+    unseen = {}
+    added = set()
+    changed = set(touched)
+    stamps = list(rows)
+    changed.update(t for m, t in stamps)
+    changed.update(t for u, m, t in vanished)
+    for m, old in before.iteritems():
+        new = after.get(m, set())
+        if old == new:
+            continue
+        changed |= old | new
+        added |= new - old
+        # The message's flags changed in every folder it's in
+        stamps.extend((m, t) for t in new)
+        for t in new - old:
+            messages[t] = messages.get(t, 0) + 1
+        for t in old - new:
+            messages[t] = messages.get(t, 0) - 1
+        if seen not in old:
+            for t in old:
+                unseen[t] = unseen.get(t, 0) - 1
+        if seen not in new:
+            for t in new:
+                unseen[t] = unseen.get(t, 0) + 1
+
+    if not changed:
+        return
+
+    # UIDs are messages_tags ids, so the folders that gained messages
+    # need to know their new highest id
+    uidnext = {}
+    if added:
+        for t, last in meta.Session.execute(
+            sa.select([messages_tags.c.tag_id, sa.func.max(messages_tags.c.id)],
+                      messages_tags.c.tag_id.in_(added),
+                      group_by=[messages_tags.c.tag_id])):
+            uidnext[t] = last + 1
+
+    params = dict((t, {'t': t,
+                       'dm': messages.get(t, 0),
+                       'du': unseen.get(t, 0),
+                       'un': uidnext.get(t, 0)})
+                  for t in changed)
+    _adjust(params.values())
+
+    # Folders without a counter row yet get one now, counted after
+    # the change. get() may already have handed out the modseq that
+    # counting comes up with, so this change has to come after it
+    modseqs = dict((t, modseq) for t, modseq in meta.Session.execute(
+            sa.select([tag_counters.c.tag_id, tag_counters.c.modseq],
+                      tag_counters.c.tag_id.in_(changed))))
+    for t in changed.difference(modseqs):
+        counts = create(t, bump=1)
+        if counts is None:
+            # Another transaction got there first, counting without
+            # this change, so it goes on top of theirs
+            _adjust([params[t]])
+            counts = _read(meta.Session, t)
+        modseqs[t] = counts['modseq']
+
+    # One statement per folder, rather than one per row
+    by_tag = {}
+    for m, t in stamps:
+        by_tag.setdefault(t, set()).add(m)
+    for t, message_ids in by_tag.iteritems():
+        meta.Session.execute(messages_tags.update(
+                sa.and_(messages_tags.c.tag_id==t,
+                        match(messages_tags.c.message_id, message_ids)),
+                values={'modseq': modseqs[t]}))
+    if vanished:
+        meta.Session.execute(vanished_uids.insert(),
+                             [{'uid': u, 'message_id': m, 'tag_id': t,
+                               'modseq': modseqs[t]}
+                              for u, m, t in vanished])
+
+def touch(tag_ids, rows=()):
+    """
+    Bump the modseq of the folders for tag_ids, and stamp the
+    (message_id, tag_id) pairs in rows with it.
+    """
+    update({}, {}, tag_ids, rows)
+
+def compute(tag_id):
+    """
+    Count the STATUS values for a tag from scratch.
+    """
+    from ponyexpress.model.message import Message
+
+    seen = _seen()
+    messages = meta.Session.query(MessageTag).\
+        filter(MessageTag.tag_id==tag_id).count()
+    if seen is None:
+        unseen = messages
+    else:
+        unseen = meta.Session.query(Message).\
+            filter(Message.message_tags.any(MessageTag.tag_id==tag_id)).\
+            filter(~Message.message_tags.any(MessageTag.tag_id==seen)).\
+            count()
+    last = meta.Session.query(sa.func.max(MessageTag.id)).\
+        filter(MessageTag.tag_id==tag_id).scalar()
+    # The modseq has to stay ahead of anything already stamped
+    modseq = max(meta.Session.query(sa.func.max(MessageTag.modseq)).\
+                     filter(MessageTag.tag_id==tag_id).scalar(),
+                 meta.Session.query(sa.func.max(VanishedUID.modseq)).\
+                     filter(VanishedUID.tag_id==tag_id).scalar())
+    return {'messages': messages,
+            'unseen': unseen,
+            'uidnext': (last or 0) + 1,
+            'modseq': (modseq or 0) + 1}
+
+def _read(session, tag_id):
+    row = session.execute(
+        sa.select([tag_counters.c.messages, tag_counters.c.unseen,
+                   tag_counters.c.uidnext, tag_counters.c.modseq],
+                  tag_counters.c.tag_id==tag_id)).fetchone()
+    if row is not None:
+        return dict(zip(('messages', 'unseen', 'uidnext', 'modseq'), row))
+
+def read(tag_id):
+    """
+    Like get, but through meta.ReadSession, so it only sees what's
+    been committed. Returns None if the counters for the tag haven't
+    been stored yet.
+    """
+    return _read(meta.ReadSession, tag_id)
+
+def create(tag_id, bump=0):
+    """
+    Count the STATUS values for a tag from scratch and store them as
+    its counters, with bump added to the modseq. Returns them like
+    get() does, or None if another transaction has stored them
+    first.
+
+    This is a write, so it's only done on the way to changing the
+    folder anyway.
+    """
+    counts = compute(tag_id)
+    counts['modseq'] += bump
+    values = dict(counts)
+    values['tag_id'] = tag_id
+    # As in ponyexpress.model.blobs, PostgreSQL needs a savepoint to
+    # carry on after the error, and pysqlite can't have one
+    savepoint = meta.engine.name == 'postgres'
+    if savepoint:
+        meta.Session.begin_nested()
+    try:
+        meta.Session.execute(tag_counters.insert(), [values])
+    except sa.exc.IntegrityError:
+        if savepoint:
+            meta.Session.rollback()
+        return None
+    if savepoint:
+        meta.Session.commit()
+    return counts
+
+def get(tag_id):
+    """
+    Return the STATUS values for a tag, as a dict with keys
+    'messages', 'unseen', 'uidnext' and 'modseq'.
+
+    Once the counters exist, this is a single query. Until then,
+    they're counted from scratch every time, but not stored.
+    """
+    counts = _read(meta.Session, tag_id)
+    if counts is not None:
+        return counts
+    return compute(tag_id)
+
+class CountersExtension(SessionExtension):
+    """
+    Keep the counters up to date with changes made through the ORM.
+    """
+
+    def after_flush(self, session, flush_context):
+        from ponyexpress.model.message import Message
+
+        added = []
+        removed = []
+        vanished = []
+        rows = []
+        message_ids = set()
+        for obj in session.new:
+            if isinstance(obj, MessageTag):
+                added.append((obj.message_id, obj.tag_id))
+            elif isinstance(obj, Message):
+                message_ids.add(obj.id)
+        for obj in session.deleted:
+            if isinstance(obj, MessageTag):
+                removed.append((obj.message_id, obj.tag_id))
+                vanished.append((obj.id, obj.message_id, obj.tag_id))
+            elif isinstance(obj, Message):
+                message_ids.add(obj.id)
+        for obj in session.dirty:
+            if isinstance(obj, MessageTag) and session.is_modified(obj):
+                rows.append((obj.message_id, obj.tag_id))
+        message_ids.update(m for m, t in added + removed)
+        message_ids.discard(None)
+        if not message_ids and not rows:
+            return
+
+        after = snapshot(message_ids)
+        before = dict((m, set(tags)) for m, tags in after.iteritems())
+        for m, t in added:
+            before[m].discard(t)
+        for m, t in removed:
+            if m in before:
+                before[m].add(t)
+        # Deleted messages don't have any tags left, even if their
+        # rows haven't been cleaned up yet
+        for obj in session.deleted:
+            if isinstance(obj, Message):
+                after[obj.id] = set()
+        update(before, after, rows=rows, vanished=vanished)
@@ -9,8 +9,9 @@ from decorator import decorator
 @decorator
 def in_transaction(f, *args, **kwargs):
     try:
-        f(*args, **kwargs)
+        result = f(*args, **kwargs)
         meta.Session.commit()
+        return result
     except:
         meta.Session.rollback()
         raise
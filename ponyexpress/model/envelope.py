@@ -0,0 +1,27 @@
+import sqlalchemy as sa
+
+from ponyexpress.model.base import Base
+
+class Envelope(Base):
+    """
+    The fields of a message's IMAP ENVELOPE, worked out when the
+    message is added so that FETCH ENVELOPE doesn't need its
+    headers. These rows are maintained by ponyexpress.model.envelopes.
+    """
+    __tablename__ = 'envelopes'
+
+    message_id = sa.Column(sa.ForeignKey('messages.id', ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
+    # These are the header values, as they are
+    date = sa.Column(sa.types.UnicodeText)
+    subject = sa.Column(sa.types.UnicodeText)
+    in_reply_to = sa.Column(sa.types.UnicodeText)
+    # The Message-ID header
+    mid = sa.Column(sa.types.UnicodeText)
+    # These are address lists, already in IMAP form: a parenthesized
+    # list of (name adl mailbox host) lists, or NULL for NIL
+    from_ = sa.Column(sa.types.UnicodeText)
+    sender = sa.Column(sa.types.UnicodeText)
+    reply_to = sa.Column(sa.types.UnicodeText)
+    to_ = sa.Column(sa.types.UnicodeText)
+    cc = sa.Column(sa.types.UnicodeText)
+    bcc = sa.Column(sa.types.UnicodeText)
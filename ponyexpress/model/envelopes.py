@@ -0,0 +1,194 @@
+"""
+Precomputed IMAP envelopes
+
+A client building a message list asks for ENVELOPE, RFC822.SIZE and
+INTERNALDATE on thousands of messages at once. Answering that from
+Message.headers means loading a Header object per field of every
+message and picking through them, over and over.
+
+Instead, the envelope fields of each message are pulled out of its
+headers once, when it's flushed, and stored in the envelopes table,
+with the address fields already formatted for IMAP. summaries() then
+loads everything a list view needs for a batch of messages in a
+single query, with no ORM objects involved at all.
+
+Messages and headers flushed through the ORM are picked up by
+EnvelopeExtension. Code that inserts them some other way should call
+update() itself. A database created before this table existed can be
+brought up to date with rebuild().
+"""
+
+from collections import namedtuple
+
+import sqlalchemy as sa
+from sqlalchemy.orm.interfaces import SessionExtension
+from twisted.mail import imap4
+
+from ponyexpress.model.envelope import Envelope
+from ponyexpress.model.header import Header
+from ponyexpress.model import meta
+from ponyexpress.util.headers import Headers
+from ponyexpress.util.chunks import chunked
+
+envelopes = Envelope.__table__
+headers = Header.__table__
+
+# The number of messages to handle per statement
+chunk_size = 500
+
+# The columns of an envelope, in the order IMAP wants them
+FIELDS = ('date', 'subject', 'from_', 'sender', 'reply_to', 'to_', 'cc',
+          'bcc', 'in_reply_to', 'mid')
+ADDRESS_FIELDS = ('from_', 'sender', 'reply_to', 'to_', 'cc', 'bcc')
+
+# What a list view wants to know about each message. envelope is the
+# ENVELOPE, ready to send, or None if the message doesn't have one
+Summary = namedtuple('Summary', 'message_id envelope size internal_date')
+
+def _addresses(value):
+    return u'(%s)' % imap4.collapseNestedLists(
+        imap4.parseAddr(value and value.encode('utf-8'))).decode('utf-8')
+
+def fields(items):
+    """
+    Return the column values of the envelope for a message with the
+    given (field, value) headers.
+
+    This follows twisted.mail.imap4.getEnvelope, right down to the
+    defaults for Sender and Reply-To.
+    """
+    h = Headers(items)
+    from_ = h.get('from')
+    # Sender and Reply-To are usually missing, and so the same as From
+    from_addresses = _addresses(from_)
+    sender = h.get('sender')
+    reply_to = h.get('reply-to')
+    if reply_to is None:
+        reply_to = from_ and from_addresses
+    else:
+        reply_to = reply_to and _addresses(reply_to)
+    return {'date': h.get('date'),
+            'subject': h.get('subject'),
+            'from_': from_addresses,
+            'sender': sender is None and from_addresses or _addresses(sender),
+            'reply_to': reply_to,
+            'to_': h.get('to') and _addresses(h['to']),
+            'cc': h.get('cc') and _addresses(h['cc']),
+            'bcc': h.get('bcc') and _addresses(h['bcc']),
+            'in_reply_to': h.get('in-reply-to'),
+            'mid': h.get('message-id')}
+
+def format(row):
+    """
+    Return the ENVELOPE for a row (or anything else with the envelope
+    columns as keys), as it's sent to the client.
+    """
+    items = []
+    for f in FIELDS:
+        value = row[f]
+        if value is not None:
+            value = value.encode('utf-8')
+            if f in ADDRESS_FIELDS:
+                value = imap4.DontQuoteMe(value)
+        items.append(value)
+    return imap4.collapseNestedLists([items])
+
+def update(message_ids):
+    """
+    Recompute the envelopes of the messages in message_ids from their
+    headers.
+    """
+    for chunk in chunked(list(message_ids), chunk_size):
+        items = dict((m, []) for m in chunk)
+        for message_id, field, value in meta.Session.execute(
+            sa.select([headers.c.message_id, headers.c.field, headers.c.value],
+                      headers.c.message_id.in_(chunk),
+                      order_by=[headers.c.message_id, headers.c.position])):
+            items[message_id].append((field, value))
+        meta.Session.execute(envelopes.delete(
+                envelopes.c.message_id.in_(chunk)))
+        meta.Session.execute(envelopes.insert(),
+                             [dict(fields(i), message_id=m)
+                              for m, i in items.iteritems()])
+
+def remove(message_ids):
+    for chunk in chunked(list(message_ids), chunk_size):
+        meta.Session.execute(envelopes.delete(
+                envelopes.c.message_id.in_(chunk)))
+
+def rebuild():
+    """
+    Recompute every message's envelope.
+    """
+    from ponyexpress.model.message import Message
+    ids = [r[0] for r in meta.Session.query(Message.id)]
+    update(ids)
+
+def summaries(ids, key=None):
+    """
+    Return a dict mapping each of ids to the Summary of its message.
+
+    ids are message ids, unless key is given, in which case they're
+    values of that column, which has to be in a table with a
+    message_id column (like messages_tags.c.id, for UIDs in a
+    Tag). Ids with no message are left out.
+
+    This reads through meta.ReadSession, so it only sees committed
+    messages.
+    """
+    from ponyexpress.model.message import Message
+    messages = Message.__table__
+
+    if key is None:
+        key = messages.c.id
+    result = {}
+    for chunk in chunked(list(ids), chunk_size):
+        where = key.in_(chunk)
+        if key.table is not messages:
+            where = sa.and_(where, key.table.c.message_id==messages.c.id)
+        for row in meta.ReadSession.execute(
+            sa.select([key.label('key'), messages.c.id, messages.c.length,
+                       messages.c.created_at] +
+                      [envelopes.c[f] for f in FIELDS],
+                      where,
+                      from_obj=[messages.outerjoin(
+                            envelopes,
+                            envelopes.c.message_id==messages.c.id)])):
+            envelope = None
+            if any(row[f] is not None for f in FIELDS):
+                envelope = format(row)
+            result[row['key']] = Summary(row['id'], envelope, row['length'],
+                                         row['created_at'])
+    return result
+
+class EnvelopeExtension(SessionExtension):
+    """
+    Keep envelopes up to date with messages and headers flushed
+    through the ORM.
+    """
+
+    def after_flush(self, session, flush_context):
+        from ponyexpress.model.message import Message
+
+        changed = set()
+        removed = set()
+        for obj in session.new:
+            if isinstance(obj, Message):
+                changed.add(obj.id)
+            elif isinstance(obj, Header):
+                changed.add(obj.message_id)
+        for obj in session.dirty:
+            if isinstance(obj, Header) and session.is_modified(obj):
+                changed.add(obj.message_id)
+        for obj in session.deleted:
+            if isinstance(obj, Message):
+                removed.add(obj.id)
+            elif isinstance(obj, Header):
+                changed.add(obj.message_id)
+
+        changed -= removed
+        changed.discard(None)
+        if removed:
+            remove(removed)
+        if changed:
+            update(changed)
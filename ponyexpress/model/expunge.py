@@ -0,0 +1,235 @@
+"""
+Expunging deleted messages, and reclaiming their space
+
+A STORE of \\Deleted only marks a message's messages_tags row. EXPUNGE
+is what actually takes it out of the folder, and until then every
+count, every sequence map and every search keeps paying for it.
+
+expunge() removes a folder's \\Deleted rows a chunk at a time, keeping
+the counters, modseqs, mailbox contents, tag index and listeners in
+step, just as ponyexpress.model.store does for other tag changes. A
+message is only really gone once it has no tags left at all, and then
+collect() deletes it along with its headers, MIME structure, envelope,
+full-text entry and blob reference. Everything here works directly
+against the tables, so none of it loads a single ORM object.
+
+Deleting rows doesn't make the database file any smaller. compact()
+hands the free pages back to the filesystem. With SQLite in
+incremental auto-vacuum mode it does that a few pages at a time, each
+step a transaction of its own, so readers are never held up for long
+(see ponyexpress.scripts.compact).
+
+Raw messages in segment files (see ponyexpress.model.segments) leave
+their bytes behind when they're deleted, since segments are
+append-only. compact_segments() copies what's left of a mostly-empty
+segment onto the end of the newest one, and deletes segments that
+nothing uses any more.
+"""
+
+import os
+import time
+
+import sqlalchemy as sa
+
+from ponyexpress.model.message_tag import MessageTag
+from ponyexpress.model.header import Header
+from ponyexpress.model.mime_part import MimePart
+from ponyexpress.model.mailbox_message import MailboxMessage
+from ponyexpress.model import meta
+from ponyexpress.model import contents
+from ponyexpress.model import counters
+from ponyexpress.model import envelopes
+from ponyexpress.model.idsets import match
+from ponyexpress.util.chunks import chunked
+
+messages_tags = MessageTag.__table__
+headers = Header.__table__
+mime_parts = MimePart.__table__
+mailboxes_messages = MailboxMessage.__table__
+
+# The number of rows to delete per statement
+chunk_size = 500
+
+def expunge(tag_id, message_ids=None):
+    """
+    Remove the messages flagged \\Deleted from the folder for tag_id,
+    and garbage collect any of them that are left without tags.
+
+    If message_ids is given, only those messages are considered.
+
+    Returns a list of the (uid, message_id) of each row removed, in
+    UID order.
+    """
+    where = sa.and_(messages_tags.c.tag_id==tag_id,
+                    messages_tags.c.deleted==True)
+    if message_ids is not None:
+        where = sa.and_(where, match(messages_tags.c.message_id, message_ids))
+    rows = sorted((r[0], r[1]) for r in meta.Session.execute(
+            sa.select([messages_tags.c.id, messages_tags.c.message_id],
+                      where)))
+    if not rows:
+        return []
+
+    removed = [m for u, m in rows]
+    before = counters.snapshot(removed)
+    for chunk in chunked(rows, chunk_size):
+        meta.Session.execute(messages_tags.delete(
+                messages_tags.c.id.in_([u for u, m in chunk])))
+    contents.update(removed, [tag_id])
+    counters.update(before, dict((m, tags - set([tag_id]))
+                                 for m, tags in before.iteritems()),
+                    vanished=[(u, m, tag_id) for u, m in rows])
+    if meta.index is not None:
+        meta.index.remove_tags(removed, [tag_id])
+    meta.notifier.tags_changed(removed)
+
+    collect(m for m, tags in before.iteritems() if tags == set([tag_id]))
+    return rows
+
+def collect(message_ids):
+    """
+    Delete each message in message_ids that has no tags left, and
+    everything that belongs to it. Returns the ids of the messages
+    deleted.
+    """
+    from ponyexpress.model.message import Message
+    messages = Message.__table__
+
+    message_ids = list(message_ids)
+    if not message_ids:
+        return []
+    tagged = set(r[0] for r in meta.Session.execute(
+            sa.select([messages_tags.c.message_id],
+                      match(messages_tags.c.message_id, message_ids),
+                      distinct=True)))
+    orphans = [m for m in message_ids if m not in tagged]
+    if not orphans:
+        return []
+
+    if meta.fulltext is not None:
+        meta.fulltext.remove(orphans)
+    envelopes.remove(orphans)
+    for chunk in chunked(orphans, chunk_size):
+        if meta.blobs is not None:
+            for r in meta.Session.execute(
+                sa.select([messages.c.blob_id],
+                          sa.and_(messages.c.id.in_(chunk),
+                                  messages.c.blob_id!=None))):
+                meta.blobs.release(r[0])
+        for table in (headers, mime_parts, mailboxes_messages):
+            meta.Session.execute(table.delete(table.c.message_id.in_(chunk)))
+        meta.Session.execute(messages.delete(messages.c.id.in_(chunk)))
+    if meta.index is not None:
+        meta.index.remove_messages(orphans)
+    return orphans
+
+def compact(pages=256, pause=0.0, full=False):
+    """
+    Return the space freed by deleted rows to the filesystem.
+
+    On a SQLite database in incremental auto-vacuum mode, this frees
+    pages at a time, committing after each step and then sleeping for
+    pause seconds to let anyone waiting on the database in. Otherwise,
+    if full is True, it runs a plain VACUUM, which rewrites the whole
+    file and holds a lock for as long as that takes, and switches the
+    database to incremental auto-vacuum so that it never has to again.
+
+    Other databases reclaim space on their own, so this does nothing
+    for them.
+
+    Returns the number of pages freed, or None if nothing was done.
+    """
+    engine = meta.engine
+    if engine.name != 'sqlite':
+        return None
+
+    # VACUUM can't run inside a transaction, so this uses a DB-API
+    # connection of its own rather than the session
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        def pragma(statement):
+            cursor.execute('PRAGMA ' + statement)
+            row = cursor.fetchone()
+            return row and row[0]
+
+        before = pragma('freelist_count')
+        # 2 is INCREMENTAL
+        if pragma('auto_vacuum') == 2:
+            while pragma('freelist_count'):
+                cursor.execute('PRAGMA incremental_vacuum(%d)' % pages)
+                cursor.fetchall()
+                conn.commit()
+                if pause:
+                    time.sleep(pause)
+        elif full:
+            conn.commit()
+            cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            cursor.execute('VACUUM')
+        else:
+            return None
+        return before - pragma('freelist_count')
+    finally:
+        conn.close()
+
+def compact_segments(threshold=0.5, min_age=3600):
+    """
+    Reclaim the space that deleted messages take up in the segment
+    store's files.
+
+    Each segment but the newest, less than threshold of which is still
+    used by messages, has those messages copied onto the end of the
+    newest segment and pointed at their new copies, one transaction
+    per segment. A segment that no message uses is deleted, but only
+    once min_age seconds have passed since anything was written to it
+    or moved out of it, since a transaction that started before then
+    may still go looking for it there.
+
+    Returns the number of segment files deleted.
+    """
+    from ponyexpress.model.message import Message
+    messages = Message.__table__
+
+    store = meta.segments
+    if store is None:
+        return 0
+    used = dict((r[0], (r[1], r[2])) for r in meta.Session.execute(
+            sa.select([messages.c.segment, sa.func.count(messages.c.id),
+                       sa.func.sum(messages.c.length)],
+                      messages.c.segment!=None,
+                      group_by=[messages.c.segment])))
+    cutoff = time.time() - min_age
+    removed = 0
+    # The newest segment is the one still being appended to
+    for segment in store.segments()[:-1]:
+        filename = store.filename(segment)
+        count, length = used.get(segment, (0, 0))
+        if not count:
+            if os.path.getmtime(filename) <= cutoff:
+                store.remove(segment)
+                removed += 1
+            continue
+        if length >= threshold * os.path.getsize(filename):
+            continue
+
+        rows = meta.Session.execute(
+            sa.select([messages.c.id, messages.c.segment_offset,
+                       messages.c.length],
+                      messages.c.segment==segment,
+                      order_by=[messages.c.segment_offset])).fetchall()
+        moved = []
+        for message_id, offset, length in rows:
+            data = store.open(segment, offset, length).read()
+            new_segment, new_offset = store.append(data)
+            moved.append({'message_id': message_id,
+                          'new_segment': new_segment,
+                          'new_offset': new_offset})
+        meta.Session.execute(messages.update(
+                messages.c.id==sa.bindparam('message_id'),
+                values={'segment': sa.bindparam('new_segment'),
+                        'segment_offset': sa.bindparam('new_offset')}),
+                             moved)
+        meta.Session.commit()
+        # Start the clock on deleting it
+        os.utime(filename, None)
+    return removed
@@ -0,0 +1,311 @@
+"""
+A full-text index for SEARCH BODY, TEXT and SUBJECT
+
+IMAP searches are case-insensitive substring matches, which a LIKE
+'%...%' can only answer by reading every body in the folder. Instead,
+every message's text is indexed by trigram as it's inserted, and a
+search only has to look at the messages that contain every trigram
+of what's being searched for.
+
+Each message is indexed as three fields:
+
+ - subject: the values of its Subject headers
+ - headers: the values of all of its headers
+ - body: its body
+
+There are two implementations, chosen by for_engine():
+
+ - FTS5Index keeps the text in an SQLite FTS5 virtual table with the
+   trigram tokenizer, which answers substring matches exactly.
+
+ - TrigramIndex keeps an inverted index from trigrams to messages in
+   the fulltext_trigrams table, and works with any database. A
+   message having all the right trigrams doesn't mean they're in the
+   right order, so the candidates are then checked with the original
+   LIKE condition.
+
+Neither can do anything with search strings shorter than three
+characters, which fall back to the LIKE condition on its own. LIKE
+only sees plain bodies in messages.body, so ponyexpress.model.search
+checks any other bodies itself, with body_texts().
+
+Messages flushed through the ORM are indexed by FullTextExtension.
+Code that inserts messages some other way should call update() on the
+index itself. A database created before the index existed can be
+brought up to date with rebuild().
+"""
+
+import sqlalchemy as sa
+from sqlalchemy.orm.interfaces import SessionExtension
+
+from ponyexpress.model.fulltext_trigram import FullTextTrigram
+from ponyexpress.model.header import Header
+from ponyexpress.model import meta
+from ponyexpress.model import bodies
+from ponyexpress.util.chunks import chunked
+
+headers = Header.__table__
+trigrams = FullTextTrigram.__table__
+
+FIELDS = ('subject', 'headers', 'body')
+
+# The number of messages to index per statement
+chunk_size = 500
+
+def _text(s):
+    if s is None:
+        return u''
+    elif isinstance(s, str):
+        return s.decode('utf-8', 'replace')
+    return s
+
+def body_texts(message_ids):
+    """
+    Yield (message_id, body) for each of the messages in message_ids,
+    wherever its body is stored, loading chunk_size of them at a
+    time.
+    """
+    from ponyexpress.model.message import Message
+    messages = Message.__table__
+
+    for chunk in chunked(list(message_ids), chunk_size):
+        rows = meta.Session.execute(
+            sa.select([messages.c.id, messages.c.body,
+                       messages.c.compressed_body, messages.c.blob_id,
+                       messages.c.segment, messages.c.segment_offset,
+                       messages.c.header_length, messages.c.length],
+                      messages.c.id.in_(chunk))).fetchall()
+        blob_ids = [r[3] for r in rows if r[3] is not None]
+        blobs = blob_ids and meta.blobs.texts(blob_ids) or {}
+        for message_id, body, compressed_body, blob_id, \
+                segment, offset, header_length, length in rows:
+            if blob_id is not None:
+                body = blobs[blob_id]
+            elif segment is not None:
+                body = meta.segments.open(segment, offset + header_length,
+                                          length - header_length).read()
+            else:
+                body = bodies.decode(body, compressed_body)
+            yield message_id, _text(body)
+
+def documents(message_ids):
+    """
+    Load the indexed fields of the messages in message_ids.
+
+    Returns a dict mapping each message id to a tuple of the text for
+    each of FIELDS.
+    """
+    result = {}
+    for chunk in chunked(list(message_ids), chunk_size):
+        fields = {}
+        for message_id, field, value in meta.Session.execute(
+            sa.select([headers.c.message_id, headers.c.field_lower,
+                       headers.c.value],
+                      headers.c.message_id.in_(chunk),
+                      order_by=[headers.c.message_id, headers.c.position])):
+            subject, values = fields.setdefault(message_id, ([], []))
+            if field == u'subject':
+                subject.append(value)
+            values.append(value)
+        for message_id, body in body_texts(chunk):
+            subject, values = fields.get(message_id, ([], []))
+            result[message_id] = (u'\n'.join(subject), u'\n'.join(values),
+                                  body)
+    return result
+
+class FullTextIndex(object):
+    """
+    The interface shared by the full-text index implementations.
+    """
+
+    # Whether candidates() are exactly the messages that match, or
+    # only the ones that might
+    exact = False
+
+    def add(self, documents):
+        """
+        Index messages, given a dict like the one documents() returns.
+        """
+        raise NotImplementedError
+
+    def remove(self, message_ids):
+        """
+        Remove messages from the index.
+        """
+        raise NotImplementedError
+
+    def candidates(self, message_id, fields, value):
+        """
+        Return a condition for whether the message whose id is in the
+        column message_id might contain value in any of fields, or
+        None if the index can't narrow it down.
+        """
+        raise NotImplementedError
+
+    def match(self, message_id, fields, value, condition):
+        """
+        Return a condition for whether the message whose id is in the
+        column message_id contains value in any of fields.
+
+        condition is the equivalent LIKE test, for when the index
+        can't answer the question on its own.
+        """
+        candidates = self.candidates(message_id, fields, value)
+        if candidates is None:
+            return condition
+        elif self.exact:
+            return candidates
+        return sa.and_(candidates, condition)
+
+    def update(self, message_ids):
+        """
+        Re-index messages from what's currently in the database.
+        """
+        message_ids = list(message_ids)
+        self.remove(message_ids)
+        self.add(documents(message_ids))
+
+    def rebuild(self):
+        """
+        Re-index every message.
+        """
+        from ponyexpress.model.message import Message
+        ids = [r[0] for r in meta.Session.query(Message.id)]
+        for chunk in chunked(ids, chunk_size):
+            self.update(chunk)
+
+class FTS5Index(FullTextIndex):
+    """
+    A full-text index in an SQLite FTS5 table, keyed by message id.
+    """
+
+    exact = True
+
+    # This table isn't part of the model's metadata, since
+    # create_all() doesn't know how to make a virtual table
+    table = sa.Table('fulltext', sa.MetaData(),
+                     sa.Column('rowid', sa.types.Integer, primary_key=True),
+                     *[sa.Column(f, sa.types.UnicodeText) for f in FIELDS])
+
+    def __init__(self, engine):
+        engine.execute("CREATE VIRTUAL TABLE IF NOT EXISTS fulltext "
+                       "USING fts5(%s, tokenize='trigram')" % ', '.join(FIELDS))
+
+    def add(self, documents):
+        rows = [dict(zip(FIELDS, doc), rowid=message_id)
+                for message_id, doc in documents.iteritems()]
+        if rows:
+            meta.Session.execute(self.table.insert(), rows)
+
+    def remove(self, message_ids):
+        for chunk in chunked(list(message_ids), chunk_size):
+            meta.Session.execute(self.table.delete(
+                    self.table.c.rowid.in_(chunk)))
+
+    def candidates(self, message_id, fields, value):
+        value = _text(value)
+        if len(value) < 3:
+            return None
+        # A quoted string is a phrase, which the trigram tokenizer
+        # turns into a substring match
+        query = u'{%s} : "%s"' % (' '.join(fields), value.replace('"', '""'))
+        return message_id.in_(
+            sa.select([self.table.c.rowid],
+                      sa.literal_column('fulltext').op('MATCH')(query)))
+
+class TrigramIndex(FullTextIndex):
+    """
+    A full-text index built from plain tables: a row in
+    fulltext_trigrams for each distinct trigram in each field of each
+    message.
+    """
+
+    # Searching for every trigram of a long string is no more
+    # selective than searching for a few of them, so at most this many
+    # are used
+    max_trigrams = 8
+
+    @staticmethod
+    def trigrams(text):
+        text = text.lower()
+        return set(text[i:i + 3] for i in xrange(len(text) - 2))
+
+    def add(self, documents):
+        rows = []
+        for message_id, doc in documents.iteritems():
+            for field, text in enumerate(doc):
+                rows.extend({'trigram': t, 'field': field,
+                             'message_id': message_id}
+                            for t in self.trigrams(text))
+        if rows:
+            meta.Session.execute(trigrams.insert(), rows)
+
+    def remove(self, message_ids):
+        for chunk in chunked(list(message_ids), chunk_size):
+            meta.Session.execute(trigrams.delete(
+                    trigrams.c.message_id.in_(chunk)))
+
+    def candidates(self, message_id, fields, value):
+        wanted = sorted(self.trigrams(_text(value)))
+        if not wanted:
+            return None
+        # Spread the trigrams we use out over the whole string
+        if len(wanted) > self.max_trigrams:
+            step = float(len(wanted)) / self.max_trigrams
+            wanted = [wanted[int(i * step)] for i in xrange(self.max_trigrams)]
+        candidates = sa.select(
+            [trigrams.c.message_id],
+            sa.and_(trigrams.c.trigram.in_(wanted),
+                    trigrams.c.field.in_([FIELDS.index(f) for f in fields])),
+            group_by=[trigrams.c.message_id],
+            having=sa.func.count(sa.distinct(trigrams.c.trigram))==len(wanted))
+        return message_id.in_(candidates)
+
+def for_engine(engine):
+    """
+    Return the best full-text index available on engine.
+    """
+    if engine.name == 'sqlite':
+        try:
+            return FTS5Index(engine)
+        except sa.exc.OperationalError:
+            # SQLite was built without FTS5
+            pass
+    return TrigramIndex()
+
+class FullTextExtension(SessionExtension):
+    """
+    Keep the full-text index up to date with messages flushed through
+    the ORM.
+    """
+
+    def after_flush(self, session, flush_context):
+        from ponyexpress.model.message import Message
+
+        index = meta.fulltext
+        if index is None:
+            return
+
+        changed = set()
+        removed = set()
+        for obj in session.new:
+            if isinstance(obj, Message):
+                changed.add(obj.id)
+            elif isinstance(obj, Header):
+                changed.add(obj.message_id)
+        for obj in session.dirty:
+            if isinstance(obj, (Message, Header)) and \
+                    session.is_modified(obj):
+                changed.add(getattr(obj, 'message_id', obj.id))
+        for obj in session.deleted:
+            if isinstance(obj, Message):
+                removed.add(obj.id)
+            elif isinstance(obj, Header):
+                changed.add(obj.message_id)
+
+        changed -= removed
+        changed.discard(None)
+        if removed:
+            index.remove(removed)
+        if changed:
+            index.update(changed)
@@ -0,0 +1,16 @@
+import sqlalchemy as sa
+
+from ponyexpress.model.base import Base
+
+class FullTextTrigram(Base):
+    """
+    One entry in the built-in full-text index: a message has this
+    trigram somewhere in one of its indexed fields. These rows are
+    maintained by ponyexpress.model.fulltext, and are only used on
+    databases without a native full-text index.
+    """
+    __tablename__ = 'fulltext_trigrams'
+
+    trigram = sa.Column(sa.types.Unicode(3), primary_key=True)
+    field = sa.Column(sa.types.Integer, primary_key=True, autoincrement=False)
+    message_id = sa.Column(sa.ForeignKey('messages.id', ondelete='CASCADE', onupdate='CASCADE'), primary_key=True, index=True)
@@ -1,5 +1,5 @@
 import sqlalchemy as sa
-from sqlalchemy.orm import relation
+from sqlalchemy.orm import relation, validates
 from ponyexpress.model.base import Base
 
 class Header(Base):
@@ -8,6 +8,20 @@ class Header(Base):
 
     id = sa.Column(sa.types.Integer, primary_key=True)
     position = sa.Column(sa.types.Integer)
-    message_id = sa.Column(sa.ForeignKey('messages.id', ondelete='CASCADE', onupdate='CASCADE'), nullable=False)
+    message_id = sa.Column(sa.ForeignKey('messages.id', ondelete='CASCADE', onupdate='CASCADE'), nullable=False, index=True)
     field = sa.Column(sa.types.Unicode(255), nullable=False)
+    # Header names are case-insensitive, so lookups by name go
+    # through this instead of field. It's set whenever field is, but
+    # code that inserts headers without the ORM has to fill it in
+    field_lower = sa.Column(sa.types.Unicode(255), nullable=False)
     value = sa.Column(sa.types.UnicodeText, nullable=False)
+
+    @validates('field')
+    def _set_field(self, key, field):
+        self.field_lower = field.lower()
+        return field
+
+# For finding messages by the value of a header, like a Message-ID.
+# Added to existing databases by ponyexpress.model.migrations
+sa.Index('ix_headers_field_lower_value', Header.__table__.c.field_lower,
+         Header.__table__.c.value)
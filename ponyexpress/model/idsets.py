@@ -0,0 +1,133 @@
+"""
+Set arguments for queries
+
+Plenty of IMAP commands come down to "this, for all of these
+messages", and the obvious way to say that in SQL is an IN list. That
+works for a handful of ids, but a STORE across a big folder turns into
+a statement with tens of thousands of bind parameters: slow to
+compile, never the same twice (so the statement cache is no help),
+and over SQLite's limit on host parameters. Splitting it into chunks
+keeps it under the limit, at the cost of a round trip per chunk.
+
+match() picks a better way to say it depending on the ids:
+
+ - a few ids are still an IN list;
+ - ids that mostly run in unbroken stretches, like a whole folder or
+   a sequence range, become a handful of BETWEENs;
+ - anything else is loaded into the id_sets temporary table, and the
+   statement selects from that instead. Every set gets its own
+   set_id, so several can be in use at once.
+
+id_sets is created on every connection as it's opened (see
+IdSetListener), since creating a table in the middle of a transaction
+would commit it on some databases. Its rows go away when the session
+commits or rolls back (see IdSetExtension).
+"""
+
+import itertools
+from weakref import WeakKeyDictionary
+
+import sqlalchemy as sa
+from sqlalchemy.interfaces import PoolListener
+from sqlalchemy.orm.interfaces import SessionExtension
+
+from ponyexpress.model import meta
+
+# Up to this many ids, an IN list is fine
+threshold = 500
+
+# The most BETWEENs to use before falling back on the temporary table
+max_ranges = 16
+
+# This isn't part of Base.metadata, because create_all shouldn't make
+# a permanent copy of it
+id_sets = sa.Table('id_sets', sa.MetaData(),
+                   sa.Column('set_id', sa.types.Integer, primary_key=True),
+                   sa.Column('id', sa.types.Integer, primary_key=True))
+
+CREATE = 'CREATE TEMPORARY TABLE IF NOT EXISTS id_sets ' \
+    '(set_id INTEGER NOT NULL, id INTEGER NOT NULL, PRIMARY KEY (set_id, id))'
+
+_set_ids = itertools.count(1)
+
+# The sessions that have put rows in id_sets
+_used = WeakKeyDictionary()
+
+def ranges(ids):
+    """
+    Return the unbroken runs in a sorted list of unique ids, as (low,
+    high) pairs.
+    """
+    result = []
+    for i in ids:
+        if result and result[-1][1] == i - 1:
+            result[-1] = (result[-1][0], i)
+        else:
+            result.append((i, i))
+    return result
+
+def match(column, ids):
+    """
+    Return a clause that's true where column is one of ids.
+    """
+    ids = sorted(set(ids))
+    if not ids:
+        # IN () isn't valid SQL everywhere
+        return sa.literal(False)
+
+    runs = ranges(ids)
+    if len(runs) <= max_ranges and len(runs) * 2 < len(ids):
+        clauses = []
+        for low, high in runs:
+            if low == high:
+                clauses.append(column == low)
+            else:
+                clauses.append(column.between(low, high))
+        return sa.or_(*clauses)
+    if len(ids) <= threshold:
+        return column.in_(ids)
+
+    set_id = _set_ids.next()
+    meta.Session.execute(id_sets.insert(),
+                         [{'set_id': set_id, 'id': i} for i in ids])
+    _used[meta.Session()] = True
+    return column.in_(sa.select([id_sets.c.id],
+                                id_sets.c.set_id==set_id))
+
+def setup(engine):
+    """
+    Make sure every connection engine hands out has id_sets.
+    """
+    pool = engine.pool
+    if not any(isinstance(l, IdSetListener) for l in pool.listeners):
+        pool.add_listener(IdSetListener())
+    # Connections that are already open have missed their chance
+    conn = engine.raw_connection()
+    try:
+        IdSetListener().connect(conn, None)
+    finally:
+        conn.close()
+
+class IdSetListener(PoolListener):
+    """
+    Create id_sets on each new connection.
+    """
+
+    def connect(self, dbapi_con, con_record):
+        cursor = dbapi_con.cursor()
+        cursor.execute(CREATE)
+        cursor.close()
+        dbapi_con.commit()
+
+class IdSetExtension(SessionExtension):
+    """
+    Empty id_sets before a session commits. Rolling back takes care
+    of itself.
+    """
+
+    def before_commit(self, session):
+        if _used.pop(session, False):
+            session.execute(id_sets.delete())
+
+    def after_rollback(self, session):
+        _used.pop(session, None)
@@ -0,0 +1,20 @@
+import sqlalchemy as sa
+
+from ponyexpress.model.base import Base
+
+class ImportCheckpoint(Base):
+    """
+    How far a bulk import of a mailbox has got. It's updated in the
+    same transaction as each batch of messages, so an interrupted
+    import can pick up exactly where it left off. See
+    ponyexpress.model.ingest.
+    """
+    __tablename__ = 'import_checkpoints'
+
+    # The absolute path of the mbox file or Maildir
+    source = sa.Column(sa.types.Unicode(255), primary_key=True)
+    # Where to resume from: a byte offset into an mbox, or the name of
+    # the last file imported from a Maildir
+    position = sa.Column(sa.types.UnicodeText, nullable=False)
+    # The number of messages imported so far
+    count = sa.Column(sa.types.Integer, nullable=False, default=0)
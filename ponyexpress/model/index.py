@@ -0,0 +1,275 @@
+"""
+An in-memory index of tag membership
+
+Counting unseen messages, or working out which messages match a
+Mailbox query, normally means a join or a GROUP BY over the whole of
+messages_tags. With the index enabled (see init_model), the messages
+with each tag are kept in memory as a compressed Bitmap of message
+ids, and those questions become bitmap AND/OR/AND NOT operations.
+
+The index is loaded from the database the first time it's used, and
+is then kept up to date by the same code paths that maintain Mailbox
+contents: ponyexpress.model.store for bulk changes, and IndexExtension
+for anything flushed through the ORM. Changes are held per session
+and only applied once that session commits, so a rolled-back STORE
+never shows up in the index.
+
+The load goes through a connection of its own, so that it only sees
+what's been committed; whatever a session had going on at the time is
+applied when it commits, like any other change. An in-memory SQLite
+database can't have a second connection, so there the load has to go
+through the session, and it isn't kept if the session has changes of
+its own that haven't been committed.
+
+Memory use is bounded by the Bitmap representation: each tag costs at
+most 2 bytes per message it's on, and never more than 8 KiB per 65536
+message ids, plus about 100 bytes per non-empty block of 65536 ids.
+For a million-message archive, that's at most 2 MB per tag, and
+usually much less for the tags that are on most messages. Use
+memory_usage() to see what the index actually costs.
+
+The index only knows about changes made by this process. If other
+processes write to the database, call invalidate() to have it
+reloaded.
+
+One index is shared by every thread in the process (including the
+workers of ponyexpress.model.threads), so everything that touches it
+holds its lock. Committed changes replace the affected Bitmaps instead
+of changing them in place, which means a Bitmap handed out by get() or
+all() stays as it was for as long as the caller holds on to it.
+"""
+
+import threading
+from weakref import WeakKeyDictionary
+
+import sqlalchemy as sa
+from sqlalchemy.orm.interfaces import SessionExtension
+from sqlalchemy.pool import NullPool
+
+from ponyexpress.model.message_tag import MessageTag
+from ponyexpress.model import meta
+from ponyexpress.model import tuning
+from ponyexpress.util.bitmap import Bitmap
+
+messages_tags = MessageTag.__table__
+
+class TagIndex(object):
+    """
+    A Bitmap of message ids for every tag, plus one of every message.
+    """
+
+    def __init__(self):
+        self.tags = {}
+        self.messages = Bitmap()
+        self.loaded = False
+        # Changes waiting for their session to commit
+        self._pending = WeakKeyDictionary()
+        # Re-entrant, since the readers load the index while holding
+        # it
+        self._lock = threading.RLock()
+
+    def _read(self, bind):
+        """
+        Read every tag's messages, and every message, through bind.
+        """
+        from ponyexpress.model.message import Message
+        messages = Message.__table__
+
+        tags = {}
+        for message_id, tag_id in bind.execute(
+            sa.select([messages_tags.c.message_id, messages_tags.c.tag_id])):
+            tags.setdefault(tag_id, []).append(message_id)
+        return (dict((t, Bitmap(ids)) for t, ids in tags.iteritems()),
+                Bitmap(r[0] for r in
+                       bind.execute(sa.select([messages.c.id]))))
+
+    def load(self):
+        """
+        Build the index from what's been committed to the database.
+        """
+        with self._lock:
+            if tuning.is_memory(meta.engine.url):
+                self.tags, self.messages = self._read(meta.Session)
+            else:
+                engine = tuning.create_engine(meta.engine.url,
+                                              poolclass=NullPool)
+                conn = engine.connect()
+                try:
+                    self.tags, self.messages = self._read(conn)
+                finally:
+                    conn.close()
+                    engine.dispose()
+            self.loaded = True
+
+    def invalidate(self):
+        """
+        Throw away the index, so that it gets reloaded next time it's
+        used.
+        """
+        with self._lock:
+            self.tags = {}
+            self.messages = Bitmap()
+            self.loaded = False
+
+    def _contents(self):
+        """
+        Return the index's (tags, messages), loading it first if need
+        be. Only called with the lock held.
+        """
+        if not self.loaded:
+            if tuning.is_memory(meta.engine.url) and \
+                    meta.Session() in self._pending:
+                # Reading through the session would pick up its
+                # uncommitted changes, so this can only be used once
+                return self._read(meta.Session)
+            self.load()
+        return self.tags, self.messages
+
+    def get(self, tag_id):
+        """
+        Return the Bitmap of messages with a tag.
+
+        The Bitmap belongs to the index, so don't modify it.
+        """
+        with self._lock:
+            return self._contents()[0].get(tag_id, Bitmap())
+
+    def all(self):
+        """
+        Return the Bitmap of all messages.
+
+        The Bitmap belongs to the index, so don't modify it.
+        """
+        with self._lock:
+            return self._contents()[1]
+
+    def memory_usage(self):
+        """
+        Return an estimate of the number of bytes used by the index.
+        """
+        with self._lock:
+            return self.messages.memory_usage() + \
+                sum(b.memory_usage() for b in self.tags.itervalues())
+
+    # Recording changes. Each of these takes effect when the current
+    # session commits
+
+    def _record(self, *change):
+        # This happens whether or not the index is loaded, since it
+        # may be by the time the session commits, from a load that
+        # couldn't see the change
+        session = meta.Session()
+        with self._lock:
+            self._pending.setdefault(session, []).append(change)
+
+    def add_tags(self, pairs):
+        """
+        Record that each (message_id, tag_id) pair in pairs was added.
+        """
+        self._record('add', list(pairs))
+
+    def remove_tags(self, message_ids, tag_ids):
+        """
+        Record that each tag in tag_ids was removed from each message in
+        message_ids.
+        """
+        self._record('remove', list(message_ids), list(tag_ids))
+
+    def retain_tags(self, message_ids, tag_ids):
+        """
+        Record that every tag except for those in tag_ids was removed
+        from each message in message_ids.
+        """
+        self._record('retain', list(message_ids), list(tag_ids))
+
+    def add_messages(self, message_ids):
+        """
+        Record that messages were created.
+        """
+        self._record('create', list(message_ids))
+
+    def remove_messages(self, message_ids):
+        """
+        Record that messages were deleted.
+        """
+        self._record('delete', list(message_ids))
+
+    def commit(self, session):
+        """
+        Apply the changes recorded by session.
+        """
+        # Bitmaps are never changed in place, since another thread
+        # may be in the middle of reading them
+        with self._lock:
+            changes = self._pending.pop(session, [])
+            if not self.loaded:
+                # The load, whenever it happens, will see them
+                return
+            for change in changes:
+                kind = change[0]
+                if kind == 'add':
+                    by_tag = {}
+                    for message_id, tag_id in change[1]:
+                        by_tag.setdefault(tag_id, []).append(message_id)
+                    for tag_id, ids in by_tag.iteritems():
+                        self.tags[tag_id] = \
+                            self.tags.get(tag_id, Bitmap()).union(ids)
+                elif kind == 'remove':
+                    ids = Bitmap(change[1])
+                    for tag_id in change[2]:
+                        if tag_id in self.tags:
+                            self.tags[tag_id] = self.tags[tag_id] - ids
+                elif kind == 'retain':
+                    ids = Bitmap(change[1])
+                    keep = set(change[2])
+                    for tag_id in self.tags.keys():
+                        if tag_id not in keep:
+                            self.tags[tag_id] = self.tags[tag_id] - ids
+                elif kind == 'create':
+                    self.messages = self.messages.union(change[1])
+                elif kind == 'delete':
+                    ids = Bitmap(change[1])
+                    self.messages = self.messages - ids
+                    for tag_id in self.tags.keys():
+                        self.tags[tag_id] = self.tags[tag_id] - ids
+
+    def rollback(self, session):
+        """
+        Throw away the changes recorded by session.
+        """
+        with self._lock:
+            self._pending.pop(session, None)
+
+class IndexExtension(SessionExtension):
+    """
+    Keep the tag index up to date with changes made through the ORM.
+    """
+
+    def after_flush(self, session, flush_context):
+        from ponyexpress.model.message import Message
+
+        index = meta.index
+        if index is None:
+            return
+
+        added = []
+        for obj in session.new:
+            if isinstance(obj, MessageTag):
+                added.append((obj.message_id, obj.tag_id))
+            elif isinstance(obj, Message):
+                index.add_messages([obj.id])
+        if added:
+            index.add_tags(added)
+        for obj in session.deleted:
+            if isinstance(obj, MessageTag):
+                index.remove_tags([obj.message_id], [obj.tag_id])
+            elif isinstance(obj, Message):
+                index.remove_messages([obj.id])
+
+    def after_commit(self, session):
+        if meta.index is not None:
+            meta.index.commit(session)
+
+    def after_rollback(self, session):
+        if meta.index is not None:
+            meta.index.rollback(session)
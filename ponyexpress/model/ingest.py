@@ -0,0 +1,467 @@
+"""
+Bulk import of mbox files and Maildirs
+
+Adding messages through the ORM means a Message, a Header per field
+and a MessageTag per tag, each flushed one at a time, with every
+session extension picking over them afterwards. That's fine for
+delivering one message, and hopeless for importing a 10 GB archive.
+
+Importer instead streams messages out of a source (Mbox or Maildir),
+parses them in a pool of worker processes, and inserts each batch
+with one executemany per table: messages, headers, mime_parts,
+envelopes and messages_tags. Everything the session extensions would
+have done (the full-text index, mailbox contents, tag counters, the
+tag index, the blob and segment stores) is done for the whole batch
+at once.
+
+Each batch is committed along with a checkpoint recording how far
+through the source it got, so an interrupted import can just be run
+again and will carry on from the last batch that made it in.
+
+On PostgreSQL, each batch takes its message ids from the messages
+sequence, as a delivery would. Elsewhere the importer hands them out
+itself, carrying on from the highest id there is, so it takes the
+write lock first: SQLite's by writing the checkpoint before anything
+else, and MySQL's by reading the highest id FOR UPDATE. Deliveries
+wait for the batch to commit, and then get ids after it, since SQLite
+and MySQL move their counters past explicit ids by themselves.
+
+The workers are forked from the importing process, so they see the
+compression codec it was set up with and can compress bodies
+themselves; they never touch the database.
+"""
+
+import multiprocessing
+import os
+import re
+import time
+from datetime import datetime
+
+import sqlalchemy as sa
+
+from ponyexpress.model.message import Message
+from ponyexpress.model.header import Header
+from ponyexpress.model.message_tag import MessageTag
+from ponyexpress.model.mime_part import MimePart
+from ponyexpress.model.envelope import Envelope
+from ponyexpress.model.tag import Tag
+from ponyexpress.model.import_checkpoint import ImportCheckpoint
+from ponyexpress.model import meta
+from ponyexpress.model import bodies
+from ponyexpress.model import mime
+from ponyexpress.model import envelopes
+from ponyexpress.model import contents
+from ponyexpress.model import counters
+from ponyexpress.util import rfc822
+from ponyexpress.util.chunks import chunked
+
+messages = Message.__table__
+headers = Header.__table__
+messages_tags = MessageTag.__table__
+mime_parts = MimePart.__table__
+envelopes_table = Envelope.__table__
+checkpoints = ImportCheckpoint.__table__
+
+# The tags that Maildir flags turn into. T (trashed) becomes the
+# \Deleted flag instead
+MAILDIR_FLAGS = {'S': ur'\Seen',
+                 'R': ur'\Answered',
+                 'F': ur'\Flagged',
+                 'D': ur'\Draft'}
+
+class Mbox(object):
+    """
+    The messages in an mbox file.
+
+    Messages are split on From_ lines that follow a blank line, and
+    are otherwise imported exactly as they are in the file; in
+    particular, ">From " lines are left alone.
+    """
+
+    # How much of the file to read at a time
+    read_size = 1048576
+
+    # What the start of a From_ line looks like: "From", the envelope
+    # sender, and then a date starting with the day of the week
+    from_line = re.compile(r'From \S+ +[A-Z][a-z]{2} ')
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.name = self.path.decode('utf-8', 'replace')
+
+    @staticmethod
+    def _split(message):
+        """
+        Split the From_ line off of a message, returning the message
+        and the date from the From_ line, if it can be made sense of.
+        """
+        eol = message.find('\n')
+        if eol < 0:
+            eol = len(message)
+        line = message[:eol].rstrip('\r')
+        date = None
+        parts = line.split(None, 2)
+        if len(parts) == 3:
+            try:
+                date = datetime.strptime(parts[2].strip(),
+                                         '%a %b %d %H:%M:%S %Y')
+            except ValueError:
+                pass
+        return message[eol + 1:], date
+
+    def read(self, position=None):
+        """
+        Yield (position, message, date, flags) for each message after
+        position, where position is where the next message starts.
+        """
+        f = open(self.path, 'rb')
+        try:
+            offset = int(position or 0)
+            f.seek(offset)
+            buf = ''
+            searched = 0
+            eof = False
+            while True:
+                i = buf.find('\n\nFrom ', searched)
+                if i >= 0 and not self.from_line.match(buf, i + 2):
+                    # Not a From_ line, just a line that starts with
+                    # "From " that nobody escaped
+                    searched = i + 1
+                    continue
+                if i < 0 and not eof:
+                    # Don't search what we've already searched again,
+                    # except for a separator that might straddle the
+                    # end of what we had
+                    searched = max(0, len(buf) - 6)
+                    data = f.read(self.read_size)
+                    if data:
+                        buf += data
+                    else:
+                        eof = True
+                    continue
+                if i < 0:
+                    if not buf.strip():
+                        return
+                    message = buf
+                    if message.endswith('\n\n'):
+                        message = message[:-1]
+                    consumed = len(buf)
+                else:
+                    # The first newline ends the message, and the
+                    # second is the blank line before the next one
+                    message = buf[:i + 1]
+                    consumed = i + 2
+                buf = buf[consumed:]
+                searched = 0
+                offset += consumed
+                message, date = self._split(message)
+                yield unicode(offset), message, date, ''
+        finally:
+            f.close()
+
+class Maildir(object):
+    """
+    The messages in a Maildir, in the order of their filenames (which
+    start with the time they were delivered).
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.name = self.path.decode('utf-8', 'replace')
+
+    @staticmethod
+    def _key(name):
+        # Ignore the directory and flags, which can change if a
+        # message is moved or marked read
+        return os.path.basename(name).split(':', 1)[0]
+
+    def read(self, position=None):
+        """
+        Yield (position, message, date, flags) for each message after
+        position, where position is the name of the last message.
+        """
+        names = []
+        for sub in ('cur', 'new'):
+            d = os.path.join(self.path, sub)
+            if os.path.isdir(d):
+                names.extend(os.path.join(sub, n) for n in os.listdir(d)
+                             if not n.startswith('.'))
+        names.sort(key=self._key)
+        after = position and self._key(position)
+        for name in names:
+            if after is not None and self._key(name) <= after:
+                continue
+            filename = os.path.join(self.path, name)
+            f = open(filename, 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            date = datetime.utcfromtimestamp(os.path.getmtime(filename))
+            flags = ''
+            if ':2,' in name:
+                flags = name.rsplit(':2,', 1)[1]
+            yield name.decode('utf-8', 'replace'), data, date, flags
+
+def source(path):
+    """
+    Return an Mbox or Maildir for path, depending on what it is.
+    """
+    if os.path.isdir(path):
+        return Maildir(path)
+    return Mbox(path)
+
+# The codec for workers to compress bodies with, if they should. It's
+# set before the pool forks
+_codec = None
+
+def parse(item):
+    """
+    Parse a message into everything that needs inserting for it.
+
+    This runs in the worker processes, so item is (message, date,
+    flags), and the result is a dict.
+    """
+    data, date, flags = item
+    length, items = rfc822.parse_headers(data)
+    body = data[length:]
+    text = body.decode('utf-8', 'replace')
+    result = {'length': len(data),
+              'header_length': length,
+              'headers': items,
+              'text': text,
+              'compressed': None,
+              'parts': mime.scan([(f.encode('utf-8'), v.encode('utf-8'))
+                                  for f, v in items], body),
+              'envelope': envelopes.fields(items),
+              'date': date,
+              'flags': flags}
+    if _codec is not None:
+        result['compressed'] = _codec.encode(bodies._bytes(text))
+    return result
+
+class Importer(object):
+    """
+    Import messages in bulk, tagging each one with tags (and with
+    whatever flags its source says it has).
+    """
+
+    # The number of messages per transaction
+    batch_size = 1000
+
+    def __init__(self, tags=[u'INBOX'], processes=None, batch_size=None,
+                 progress=None):
+        """
+        Create an Importer.
+
+        processes is the number of worker processes to parse messages
+        with: None for one per CPU, or 0 to parse them in this one.
+
+        progress, if given, is called after each batch with the
+        number of messages imported so far and the number of seconds
+        it's taken.
+        """
+        self.tags = list(tags)
+        self.processes = processes
+        if batch_size is not None:
+            self.batch_size = batch_size
+        self.progress = progress
+        self.count = 0
+        self.elapsed = 0.0
+
+    @property
+    def rate(self):
+        """
+        Messages imported per second.
+        """
+        return self.elapsed and self.count / self.elapsed or 0.0
+
+    def _tag_ids(self, names):
+        ids = {}
+        for name in names:
+            t = meta.Session.query(Tag).filter_by(name=name).first()
+            if t is None:
+                t = Tag(name=name)
+                meta.Session.add(t)
+                meta.Session.flush()
+            ids[name] = t.id
+        return ids
+
+    def run(self, source):
+        """
+        Import every message from source that hasn't been imported
+        already. Returns the number of messages imported.
+        """
+        global _codec
+
+        row = meta.Session.execute(
+            sa.select([checkpoints.c.position],
+                      checkpoints.c.source==source.name)).fetchone()
+        position = row and row[0] or None
+
+        # Tags for Maildir flags are only made once a message has them
+        self._tags = self._tag_ids(self.tags)
+        meta.Session.commit()
+
+        # Bodies that are going into a blob store or segments don't
+        # get compressed here
+        _codec = None
+        if meta.compression is not None and meta.blobs is None and \
+                meta.segments is None:
+            _codec = meta.compression
+            # Make sure a dictionary is loaded before forking
+            _codec.encode('')
+
+        pool = None
+        if self.processes != 0:
+            pool = multiprocessing.Pool(self.processes)
+        start = time.time()
+        before = self.count
+        try:
+            # Parse the next batch while this one's inserted
+            pending = None
+            for batch in chunked(source.read(position), self.batch_size):
+                items = [(m, date, flags) for _, m, date, flags in batch]
+                if pool is not None:
+                    result = pool.map_async(parse, items)
+                else:
+                    result = map(parse, items)
+                if pending is not None:
+                    self._insert(source, *pending)
+                    self._report(start)
+                pending = (batch, result)
+            if pending is not None:
+                self._insert(source, *pending)
+                self._report(start)
+        except:
+            if pool is not None:
+                pool.terminate()
+                pool = None
+            meta.Session.rollback()
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            _codec = None
+        return self.count - before
+
+    def _report(self, start):
+        self.elapsed = time.time() - start
+        if self.progress is not None:
+            self.progress(self.count, self.elapsed)
+
+    def _ids(self, count):
+        """
+        Return the ids for count new messages.
+        """
+        if meta.engine.name == 'postgres':
+            return [r[0] for r in meta.Session.execute(
+                    "SELECT nextval('messages_id_seq') "
+                    "FROM generate_series(1, :count)", {'count': count})]
+        first = (meta.Session.execute(
+                sa.select([sa.func.max(messages.c.id)],
+                          for_update=True)).scalar() or 0) + 1
+        return range(first, first + count)
+
+    def _insert(self, source, batch, result):
+        if hasattr(result, 'get'):
+            result = result.get()
+
+        # This comes first so that, on SQLite, the batch holds the
+        # write lock before it looks for the highest message id
+        position = batch[-1][0]
+        done = meta.Session.execute(checkpoints.update(
+                checkpoints.c.source==source.name,
+                values={'position': position,
+                        'count': checkpoints.c.count + len(batch)}))
+        if not done.rowcount:
+            meta.Session.execute(checkpoints.insert(),
+                                 {'source': source.name,
+                                  'position': position,
+                                  'count': len(batch)})
+
+        ids = self._ids(len(batch))
+        tag_ids = [self._tags[name] for name in self.tags]
+        flags = set(MAILDIR_FLAGS[f] for parsed in result
+                    for f in parsed['flags'] if f in MAILDIR_FLAGS)
+        self._tags.update(self._tag_ids(flags - set(self._tags)))
+
+        message_rows = []
+        header_rows = []
+        part_rows = []
+        envelope_rows = []
+        tags = {}
+        documents = {}
+        for message_id, (_, data, _, _), parsed in zip(ids, batch, result):
+            row = {'id': message_id,
+                   'body': None,
+                   'compressed_body': None,
+                   'blob_id': None,
+                   'segment': None,
+                   'segment_offset': None,
+                   'header_length': None,
+                   'length': parsed['length'],
+                   'deleted': False,
+                   'created_at': parsed['date'] or datetime.utcnow()}
+            if meta.segments is not None:
+                row['segment'], row['segment_offset'] = \
+                    meta.segments.append(data)
+                row['header_length'] = parsed['header_length']
+            elif meta.blobs is not None:
+                row['blob_id'] = meta.blobs.acquire(parsed['text'])
+            elif parsed['compressed'] is not None:
+                row['compressed_body'] = parsed['compressed']
+            else:
+                row['body'] = parsed['text']
+            message_rows.append(row)
+
+            header_rows.extend({'message_id': message_id, 'position': i,
+                                'field': field, 'field_lower': field.lower(),
+                                'value': value}
+                               for i, (field, value) in
+                               enumerate(parsed['headers']))
+            part_rows.extend(dict(part, message_id=message_id, position=i)
+                             for i, part in enumerate(parsed['parts']))
+            envelope_rows.append(dict(parsed['envelope'],
+                                      message_id=message_id))
+
+            tags[message_id] = set(tag_ids) | \
+                set(self._tags[MAILDIR_FLAGS[f]] for f in parsed['flags']
+                    if f in MAILDIR_FLAGS)
+            if meta.fulltext is not None:
+                subject = [v for f, v in parsed['headers']
+                           if f.lower() == u'subject']
+                documents[message_id] = (
+                    u'\n'.join(subject),
+                    u'\n'.join(v for f, v in parsed['headers']),
+                    parsed['text'])
+
+        meta.Session.execute(messages.insert(), message_rows)
+        if header_rows:
+            meta.Session.execute(headers.insert(), header_rows)
+        meta.Session.execute(mime_parts.insert(), part_rows)
+        meta.Session.execute(envelopes_table.insert(), envelope_rows)
+
+        # Insert tag by tag so that, within a tag, UIDs get assigned in
+        # the same order as the messages
+        all_tags = sorted(set().union(*tags.values()))
+        tag_rows = [{'message_id': m, 'tag_id': t,
+                     'deleted': 'T' in parsed['flags']}
+                    for t in all_tags
+                    for m, parsed in zip(ids, result)
+                    if t in tags[m]]
+        if tag_rows:
+            meta.Session.execute(messages_tags.insert(), tag_rows)
+
+        if documents:
+            meta.fulltext.add(documents)
+        contents.update(ids)
+        counters.update(dict((m, set()) for m in ids), tags)
+        if meta.index is not None:
+            meta.index.add_messages(ids)
+            meta.index.add_tags((r['message_id'], r['tag_id'])
+                                for r in tag_rows)
+        meta.notifier.tags_changed(ids)
+        meta.Session.commit()
+        self.count += len(batch)
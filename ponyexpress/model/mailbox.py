@@ -1,10 +1,25 @@
 import sqlalchemy as sa
+from sqlalchemy.orm import eagerload
 
 from ponyexpress.model.base import Base
 from ponyexpress.model.tag import Tag
 from ponyexpress.model.message_tag import MessageTag
 from ponyexpress.model.message import Message
+from ponyexpress.model.mailbox_message import MailboxMessage
+from ponyexpress.model.vanished_uid import VanishedUID
 from ponyexpress.model import meta
+from ponyexpress.model import store
+from ponyexpress.model import compiler
+from ponyexpress.model import search
+from ponyexpress.model import envelopes
+from ponyexpress.model import notify
+from ponyexpress.model import counters
+from ponyexpress.model import expunge as _expunge
+from ponyexpress.model import idsets
+from ponyexpress.model.idsets import match
+from ponyexpress.util.chunks import chunked
+from ponyexpress.util.bitmap import Bitmap
+from ponyexpress.util.seqmap import SequenceMap, covers
 
 from zope.interface import implements
 from twisted.mail import imap4
@@ -44,6 +59,13 @@ class Mailbox(Base):
     the folder is read-only.
     """
 
+    # The maximum number of messages to load in a single query when
+    # fetching
+    fetch_chunk_size = 500
+
+    # The SequenceMap of self.messages, and the list it was made from
+    _sequence = None
+
     def setTag(self):
         if not self.isWriteable():
             return
@@ -55,55 +77,119 @@ class Mailbox(Base):
     @sa.orm.reconstructor
     def loadContents(self):
         """
-        Load the list of Message ids contained in this Mailbox based
-        on the query value.
+        Load the list of Message ids contained in this Mailbox.
+
+        The query isn't evaluated here; the results are kept up to
+        date in the mailboxes_messages table by
+        ponyexpress.model.contents.
         """
-        self.messages = self.parseQuery(self.query).all()
-        self.messages.sort()
+        self.messages = [r[0] for r in \
+                             meta.Session.query(MailboxMessage.message_id).\
+                             filter(MailboxMessage.mailbox_id==self.id).\
+                             order_by(MailboxMessage.message_id)]
+
+    def _loadNewContents(self):
+        """
+        Add the messages that have come into this Mailbox since its
+        contents were loaded.
+
+        The sequence numbers a client already has can't change until
+        it expunges, so, as with Tag, only messages after the last one
+        we know about are added, and messages that leave stay where
+        they are. Anything that starts matching further back shows up
+        the next time the mailbox is selected.
+        """
+        q = meta.Session.query(MailboxMessage.message_id).\
+            filter(MailboxMessage.mailbox_id==self.id)
+        if self.messages:
+            q = q.filter(MailboxMessage.message_id > self.messages[-1])
+        new = [r[0] for r in q.order_by(MailboxMessage.message_id)]
+        if new:
+            self.messages = self.messages + new
 
     @classmethod
     def parseQuery(cls, query):
         """
-        Given a query list or string, return those messages that match
-        that query.
+        Given a query list or string, return the ids of those messages
+        that match that query, in ascending order.
+
+        See ponyexpress.model.compiler for how the query gets turned
+        into SQL. If the in-memory tag index is enabled, it's used
+        instead of the database.
+        """
+        if meta.index is not None:
+            return list(compiler.evaluate(compiler.normalize(query),
+                                          meta.index))
+        return sorted(r[0] for r in \
+                          meta.Session.execute(compiler.compile_query(query)))
+
+    @classmethod
+    def queryTags(cls, query):
+        """
+        Return the tag names and tag ids referenced by a query, as a
+        pair of sets.
+        """
+        names = set()
+        ids = set()
+        if isinstance(query, basestring):
+            if query != '*':
+                names.add(query)
+        elif isinstance(query, int):
+            ids.add(query)
+        else:
+            for q in query[::2]:
+                n, i = cls.queryTags(q)
+                names |= n
+                ids |= i
+        return names, ids
+
+    @classmethod
+    def matchQuery(cls, query, names, ids):
+        """
+        Return whether a message tagged with the given tag names and
+        tag ids matches a query.
+
+        This evaluates the query for a single message in Python,
+        which is useful when only a few messages have changed and
+        running parseQuery against the whole database would be
+        overkill.
         """
         if query == '*':
-            return meta.Session.query(Message.id)
+            return True
         elif isinstance(query, basestring):
-            return meta.Session.query(Message.id).join('tags').\
-                filter_by(name=query)
+            return query in names
         elif isinstance(query, int):
-            return meta.Session.query(Message.id).join('tags').\
-                filter_by(id=query)
+            return query in ids
         else:
-            # I'm going to be manipulating the query list, so I need
-            # to duplicate it
             query = list(query)
-            # We need somewhere to start from
-            messages = cls.parseQuery(query.pop(0))
+            match = cls.matchQuery(query.pop(0), names, ids)
             while query:
-                # Evaluate the next query spec
-                next = cls.parseQuery(query[1])
-                # And combine appropriately
-                op = query[0]
+                op, next = query[0:2]
                 if op == '&':
-                    messages = messages.intersect(next)
+                    match = match and cls.matchQuery(next, names, ids)
                 elif op == '|':
-                    messages = messages.union(next)
+                    match = match or cls.matchQuery(next, names, ids)
                 elif op == '-':
-                    messages = messages.except_(next)
-
-                # Remove the operand and query spec we just processed
+                    match = match and not cls.matchQuery(next, names, ids)
                 del query[0:2]
-            return messages
+            return match
+
+    def _getSequenceMap(self):
+        """
+        Return a SequenceMap of self.messages.
+
+        self.messages is only ever replaced, never changed in place,
+        so the map is kept until it's a different list.
+        """
+        if self._sequence is None or self._sequence[0] is not self.messages:
+            self._sequence = (self.messages, SequenceMap(self.messages))
+        return self._sequence[1]
 
     def __parseSet(self, messages, uid):
-        if uid:
-            messages.last = self.messages[-1]
-            return messages
-        else:
-            messages.last = len(self.messages)
-            return [self.messages[m - 1] for m in messages]
+        # A range of UIDs can cover any number of ids that aren't in
+        # this mailbox, so rather than checking every one of them,
+        # the SequenceMap slices out the ones that are
+        return self._getSequenceMap().resolve(messages, uid)
 
     # The twisted.mail.imap4.IMailboxInfo interface (inherited by IMailbox)
 
@@ -153,15 +239,26 @@ class Mailbox(Base):
         return len(self.messages)
 
     def getRecentCount(self):
-        # Slightly less easy
-        return meta.Session.query(Message).\
-            filter(Message.id.in_(self.messages)).\
-            filter(Message.recent==True).count()
+        # PonyExpress never sets the \Recent flag; see
+        # Tag.getRecentCount
+        return 0
 
     def getUnseenCount(self):
-        return meta.Session.query(Message).\
-            filter(Message.id.in_(self.messages)).\
-            filter(Message.seen==False).count()
+        seen = meta.Session.query(Tag.id).filter_by(name=ur'\Seen').scalar()
+        if seen is None:
+            return len(self.messages)
+        if meta.index is not None:
+            return len(Bitmap(self.messages) - meta.index.get(seen))
+        # Count the seen messages by joining against our contents, so
+        # we don't have to send the whole list of messages back to the
+        # database
+        return len(self.messages) - \
+            meta.Session.query(MailboxMessage).\
+            filter(MailboxMessage.mailbox_id==self.id).\
+            join((MessageTag,
+                  MessageTag.message_id==MailboxMessage.message_id)).\
+            filter(MessageTag.tag_id==seen).\
+            count()
 
     def isWriteable(self):
         # A mailbox is only writeable if moving a message into it
@@ -172,9 +269,10 @@ class Mailbox(Base):
         try:
             setTag = self.setTag()
             if setTag is not None:
-                meta.Session.query(MessageTag).\
-                    filter(MessageTag.tag_id==setTag).\
-                    delete()
+                message_ids = [r[0] for r in \
+                                   meta.Session.query(MessageTag.message_id).\
+                                   filter(MessageTag.tag_id==setTag.id)]
+                store.remove_tags(message_ids, [setTag.id])
                 meta.Session.commit()
         except:
             meta.Session.rollback()
@@ -184,25 +282,108 @@ class Mailbox(Base):
         return imap4.statusRequestHelper(self, names)
 
     def addListener(self, listener):
-        raise NotImplementedError
+        meta.notifier.subscribe(self, listener)
 
     def removeListener(self, listener):
-        raise NotImplementedError
+        meta.notifier.unsubscribe(self, listener)
+
+    def _notify(self, listeners, changes):
+        """
+        Tell listeners what changes (a ponyexpress.model.notify.Changes)
+        mean for this mailbox.
+        """
+        setTag = self.setTag()
+        message_ids = set(changes.messages)
+        if setTag is not None:
+            message_ids.update(m for m, t in changes.deleted
+                               if t == setTag.id)
+        if not message_ids:
+            return
+
+        known = len(self.messages)
+        self._loadNewContents()
+        exists = None
+        if len(self.messages) > known:
+            exists = len(self.messages)
+
+        # As with Tag, only report the messages the client already
+        # knows about, including any that have left the mailbox but
+        # haven't been expunged
+        sequence = self._getSequenceMap()
+        message_ids = [m for m in message_ids
+                       if m in sequence and sequence.getSequence(m) <= known]
+        deleted = set()
+        if setTag is not None and message_ids:
+            deleted.update(r[0] for r in
+                           meta.Session.query(MessageTag.message_id).\
+                               filter(MessageTag.tag_id==setTag.id).\
+                               filter(MessageTag.deleted==True).\
+                               filter(match(MessageTag.message_id,
+                                            message_ids)))
+        tags = notify.flags(message_ids)
+        changed = dict((sequence.getSequence(m),
+                        tags[m] + (m in deleted and ['\Deleted'] or []))
+                       for m in message_ids)
+        notify.tell(listeners, exists, changed)
 
     def addMessage(self, message, flags={}, date=None):
         raise NotImplementedError
 
     def expunge(self):
-        raise NotImplementedError
+        if not self.isWriteable():
+            raise imap4.ReadOnlyMailbox
+
+        # Messages are only \Deleted on the tag this mailbox sets,
+        # which is also the only tag in its query, so expunging from
+        # the mailbox is expunging from the tag
+        try:
+            _expunge.expunge(self.setTag().id)
+            meta.Session.commit()
+        except:
+            meta.Session.rollback()
+            raise
+
+        # That takes the expunged messages out of the contents, and
+        # anything that other sessions took out has been kept in the
+        # sequence until now, so both go
+        current = set(r[0] for r in
+                      meta.Session.query(MailboxMessage.message_id).\
+                          filter(MailboxMessage.mailbox_id==self.id).\
+                          filter(match(MailboxMessage.message_id,
+                                       self.messages)))
+        sequence = SequenceMap(self.messages)
+        removed = sequence.remove(m for m in self.messages
+                                  if m not in current)
+        self.messages = list(sequence)
+        return removed
 
     def fetch(self, messages, uid):
         messages = self.__parseSet(messages, uid)
-        for m in messages:
-            # If we're looping over a range of UIDs, we should
-            # make sure each UID exists so we don't yield None
-            msg = meta.Session.query(Message).get(m)
-            if msg is not None:
-                yield msg
+        # Load the messages with their headers a chunk at a time, and
+        # hand them back in the order they were asked for
+        for chunk in chunked(messages, self.fetch_chunk_size):
+            rows = meta.Session.query(Message).\
+                options(eagerload('headers')).\
+                filter(Message.id.in_(chunk))
+            found = dict((msg.id, msg) for msg in rows)
+            for m in chunk:
+                # If we're looping over a range of UIDs, not every
+                # UID is going to exist, and we shouldn't yield None
+                if m in found:
+                    yield found[m]
+
+    def fetchSummaries(self, messages, uid):
+        """
+        Like fetch, but yield the Summary of each message (see
+        ponyexpress.model.envelopes) instead of the message itself,
+        which is everything a client's message list asks for.
+        """
+        messages = self.__parseSet(messages, uid)
+        for chunk in chunked(messages, self.fetch_chunk_size):
+            found = envelopes.summaries(chunk)
+            for m in chunk:
+                if m in found:
+                    yield found[m]
 
     def store(self, messages, flags, mode, uid):
         # Make sure this folder isn't read-only
@@ -211,72 +392,99 @@ class Mailbox(Base):
 
         messages = self.__parseSet(messages, uid)
 
-        # \Deleted is the special case flag - it's not treated as a
-        # normal tag, but instead it's stored on the messages_tags
-        # secondary table
-        try:
-            flags.remove('\Deleted')
-            deleted = True
-        except ValueError:
-            deleted = False
-
         try:
-            # Look up tag IDs from flags
-            tags = meta.Session.query(Tag.id).filter(Tag.name.in_(flags)).all()
-
-            if mode == -1:
-                meta.Session.query(MessageTag).\
-                    filter(MessageTag.message_id.in_(messages)).\
-                    filter(MessageTag.tag_id.in_(tags)).\
-                    delete()
-                # If we're unsetting flags and \Deleted is one of the
-                # ones to unset
-                if deleted:
-                    meta.Session.query(MessageTag).\
-                        filter(MessageTag.message_id.in_(messages)).\
-                        filter(MessageTag.tag_id==self.setTag()).\
-                        update({'deleted': False})
-            else:
-                if mode == 0:
-                    # Clear all flags that we're not about to set
-                    meta.Session.query(MessageTag).\
-                        filter(MessageTag.message_in.in_(messages)).\
-                        filter(sa.sql.not_(MessageTag.tag_id.in_(tags))).\
-                        delete()
-                    # If \Deleted isn't one of the flags that should
-                    # stay set, unset it
-                    if not deleted:
-                        meta.Session.query(MessageTag).\
-                            filter(MessageTag.message_id.in_(messages)).\
-                            filter(MessageTag.tag_id==self.setTag()).\
-                            update({'deleted': False})
-
-                # We know that we're not removing flags, so regardless
-                # of whether we're in mode 0 or 1, we need to set all
-                # of the flags that were passed in
-                #
-                # Now set all of the tags we've been asked to set
-                for tag in tags:
-                    for message in messages:
-                        meta.Session.add(MessageTag(message_id=message,
-                                                    tag_id=tag))
-
-                # If we are setting tags and we should set \Deleted
-                if deleted:
-                    meta.Session.query(MessageTag).\
-                        filter(MessageTag.message_id.in_(messages)).\
-                        filter(MessageTag.tag_id==self.setTag()).\
-                        update({'deleted': True})
-
+            setTag = self.setTag()
+            # Removing the flag corresponding to this folder takes
+            # messages out of it, but, as with Tag, they keep their
+            # sequence numbers until the next EXPUNGE
+            store.store(messages, flags, mode, setTag.id)
             meta.Session.commit()
         except:
             meta.Session.rollback()
             raise
 
+    # CONDSTORE and QRESYNC; see the same methods on Tag. Only a
+    # mailbox that sets a tag has the same contents as that tag, so
+    # only those can share its modseqs. The rest have none, which
+    # RFC 4551 calls NOMODSEQ
+
+    def getHighestModSeq(self):
+        setTag = self.setTag()
+        if setTag is None:
+            return None
+        return counters.get(setTag.id)['modseq']
+
+    def fetchChanged(self, messages, uid, since):
+        setTag = self.setTag()
+        if setTag is None or not self.messages:
+            return []
+        messages = self.__parseSet(messages, uid)
+        q = meta.Session.query(MessageTag.message_id, MessageTag.modseq,
+                               MessageTag.deleted).\
+            filter(MessageTag.tag_id==setTag.id).\
+            filter(MessageTag.modseq > since)
+        # See Tag.fetchChanged
+        if len(messages) <= idsets.threshold:
+            q = q.filter(MessageTag.message_id.in_(messages))
+        wanted = set(messages)
+        rows = sorted(r for r in q if r[0] in wanted)
+        tags = notify.flags(r[0] for r in rows)
+        return [(message_id, modseq, tags[message_id] +
+                 (deleted and ['\Deleted'] or []))
+                for message_id, modseq, deleted in rows]
+
+    def vanishedSince(self, since, messages=None):
+        setTag = self.setTag()
+        if setTag is None:
+            return []
+        # Our UIDs are message ids, which can come back if the tag is
+        # added again, so leave out anything that's back
+        uids = set(r[0] for r in
+                   meta.Session.query(VanishedUID.message_id).\
+                       filter(VanishedUID.tag_id==setTag.id).\
+                       filter(VanishedUID.modseq > since))
+        if uids:
+            uids -= set(r[0] for r in
+                        meta.Session.query(MailboxMessage.message_id).\
+                            filter(MailboxMessage.mailbox_id==self.id).\
+                            filter(match(MailboxMessage.message_id, uids)))
+        uids = sorted(uids)
+        if messages is not None:
+            uids = [u for u in uids if covers(messages, u)]
+        return uids
+
+    def resync(self, uidvalidity, since, messages=None):
+        if uidvalidity != self.getUIDValidity() or \
+                self.getHighestModSeq() is None:
+            return None
+        if messages is None:
+            messages = imap4.MessageSet(1, None)
+        return (self.vanishedSince(since, messages),
+                self.fetchChanged(messages, True, since))
+
     # The twisted.mail.imap4.ISearchableMailbox interface
 
     def search(self, query, uid):
-        raise NotImplementedError
+        # Search our materialized contents; see
+        # ponyexpress.model.search
+        mailboxes_messages = MailboxMessage.__table__
+        deleted = None
+        setTag = self.setTag()
+        if setTag is not None:
+            # Messages are only \Deleted in a mailbox that sets a tag,
+            # and then it's recorded on that tag
+            mt = MessageTag.__table__.alias()
+            deleted = sa.exists([mt.c.id],
+                                sa.and_(mt.c.message_id==
+                                        mailboxes_messages.c.message_id,
+                                        mt.c.tag_id==setTag.id,
+                                        mt.c.deleted==True))
+        return search.run(query,
+                          mailboxes_messages.c.message_id,
+                          mailboxes_messages.c.message_id,
+                          mailboxes_messages.c.mailbox_id==self.id,
+                          self._getSequenceMap(),
+                          deleted)
 
     # The twisted.mail.imap4.IMessageCopier interface
 
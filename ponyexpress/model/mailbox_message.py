@@ -0,0 +1,14 @@
+import sqlalchemy as sa
+
+from ponyexpress.model.base import Base
+
+class MailboxMessage(Base):
+    """
+    The materialized contents of a Mailbox: one row for each message
+    that matches the mailbox's query. These rows are maintained by
+    ponyexpress.model.contents.
+    """
+    __tablename__ = 'mailboxes_messages'
+
+    mailbox_id = sa.Column(sa.ForeignKey('mailboxes.id', ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
+    message_id = sa.Column(sa.ForeignKey('messages.id', ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
@@ -6,6 +6,14 @@ from sqlalchemy.ext.associationproxy import association_proxy
 from ponyexpress.model.base import Base
 from ponyexpress.model.header import Header
 from ponyexpress.model.message_tag import MessageTag
+from ponyexpress.model.blob import Blob
+from ponyexpress.model.mime_part import MimePart
+from ponyexpress.model import bodies
+from ponyexpress.model import mime
+from ponyexpress.model import meta
+from ponyexpress.util.mpart import MPart
+from ponyexpress.util import rfc822
+from twisted.mail import imap4
 
 from datetime import datetime
 
@@ -15,8 +23,26 @@ class Message(Base):
 
     # Used as the UID of the message
     id = sa.Column(sa.types.Integer, primary_key=True)
-    # Just the message body; does not include headers
-    body = deferred(sa.Column(sa.types.Text, index=True))
+    # Just the message body; does not include headers. It's stored
+    # either as plain text in the body column or compressed in the
+    # compressed_body column, depending on how the model was set up
+    # (see ponyexpress.model.bodies), or in a shared Blob (see
+    # ponyexpress.model.blobs); use the body property to get at it
+    # any of those ways.
+    #
+    # It isn't indexed directly, since a B-tree index is no help for
+    # substring searches; see ponyexpress.model.fulltext instead
+    _body = deferred(sa.Column('body', sa.types.Text), group='body')
+    _compressed_body = deferred(sa.Column('compressed_body',
+                                          sa.types.Binary), group='body')
+    blob_id = sa.Column(sa.ForeignKey('blobs.id', onupdate='CASCADE'))
+    # Or, for messages added with fromString while there's a segment
+    # store, the raw message is in a segment file instead, starting at
+    # segment_offset; its first header_length bytes are the headers
+    # (see ponyexpress.model.segments)
+    segment = sa.Column(sa.types.Integer)
+    segment_offset = sa.Column(sa.types.Integer)
+    header_length = sa.Column(sa.types.Integer)
     # This is the total size of the message, including headers, in
     # bytes when rendered in RFC 2822 form
     length = sa.Column(sa.types.Integer, nullable=False)
@@ -37,3 +63,117 @@ class Message(Base):
                             cascade='all, delete-orphan')
     tags = association_proxy('message_tags', 'tag',
                              creator=(lambda x: MessageTag(tag=x)))
+    blob = relation(Blob)
+    # The MIME structure of the message (see ponyexpress.model.mime)
+    mime_parts = relation(MimePart,
+                          collection_class=ordering_list('position'),
+                          cascade='all, delete-orphan',
+                          order_by=[MimePart.position])
+
+    @classmethod
+    def fromString(cls, data, **kwargs):
+        """
+        Create a Message from its raw RFC 2822 form.
+
+        The headers become Header rows, and the MIME structure is
+        indexed into MimeParts. If there's a segment store,
+        the raw message is appended to it; otherwise the rest becomes
+        the body.
+        """
+        length, headers = rfc822.parse_headers(data)
+        m = cls(length=len(data), **kwargs)
+        for field, value in headers:
+            m.headers.append(Header(field=field, value=value))
+        if meta.segments is not None:
+            m.segment, m.segment_offset = meta.segments.append(data)
+            m.header_length = length
+            body = data[length:]
+        else:
+            m.body = data[length:].decode('utf-8', 'replace')
+            body = bodies._bytes(m.body)
+        mime.index(m, body)
+        return m
+
+    def _get_body(self):
+        if '_pending_body' in self.__dict__:
+            return self.__dict__['_pending_body']
+        elif self.blob_id is not None:
+            return self.blob.text
+        elif self.segment is not None:
+            return self.getBodyFile().read().decode('utf-8', 'replace')
+        return bodies.decode(self._body, self._compressed_body)
+
+    def _set_body(self, body):
+        self.segment = self.segment_offset = self.header_length = None
+        if meta.blobs is not None:
+            # The body gets moved into the blob store when this
+            # Message is flushed
+            self.__dict__['_pending_body'] = body
+            self._body = self._compressed_body = None
+        else:
+            self._body, self._compressed_body = bodies.encode(body)
+            self.blob_id = None
+
+    body = property(_get_body, _set_body)
+
+    def getBodyFile(self):
+        """
+        Return a file-like object for the body, which decompresses it
+        a piece at a time if it's compressed, or reads it straight out
+        of its segment.
+        """
+        if '_pending_body' in self.__dict__:
+            return bodies.open_body(self.__dict__['_pending_body'], None)
+        elif self.blob_id is not None:
+            return self.blob.getBodyFile()
+        elif self.segment is not None:
+            return meta.segments.open(self.segment,
+                                      self.segment_offset + self.header_length,
+                                      self.length - self.header_length)
+        return bodies.open_body(self._body, self._compressed_body)
+
+    def getRawFile(self):
+        """
+        Return a file-like object for the whole message in RFC 2822
+        form, or None if it wasn't stored that way.
+
+        Reading part of it only reads that part of the segment, so
+        this is what answers FETCH BODY[], partial or not (see
+        ponyexpress.model.monkeypatch).
+        """
+        if self.segment is None:
+            return None
+        return meta.segments.open(self.segment, self.segment_offset,
+                                  self.length)
+
+    def getSize(self):
+        return self.length
+
+    def _getStructure(self):
+        if self.mime_parts:
+            return mime.IndexedPart(self, self.mime_parts[0])
+        # Not indexed, so there's nothing for it but to parse the
+        # whole thing
+        raw = self.getRawFile()
+        if raw is None:
+            raw = u''.join(u'%s: %s\r\n' % (h.field, h.value)
+                           for h in self.headers).encode('utf-8') + \
+                '\r\n' + self.getBodyFile().read()
+        return MPart(raw)
+
+    def isMultipart(self):
+        return self._getStructure().isMultipart()
+
+    def getBodyStructure(self, extended=False):
+        """
+        Return the message's BODYSTRUCTURE from its MIME index, or by
+        parsing it if it hasn't been indexed (see
+        ponyexpress.model.monkeypatch).
+        """
+        structure = self._getStructure()
+        if self.mime_parts:
+            return mime.getBodyStructure(structure, extended)
+        return imap4.getBodyStructure(structure, extended)
+
+    def getSubPart(self, part):
+        return self._getStructure().getSubPart(part)
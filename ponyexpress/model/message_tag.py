@@ -10,3 +10,16 @@ class MessageTag(Base):
     message_id = sa.Column(sa.ForeignKey('messages.id', ondelete='CASCADE', onupdate='CASCADE'))
     tag_id = sa.Column(sa.ForeignKey('tags.id', ondelete='CASCADE', onupdate='CASCADE'))
     deleted = sa.Column(sa.types.Boolean, nullable=False, default=False)
+    # The folder's modseq when this message's flags in it last changed
+    # (see ponyexpress.model.counters)
+    modseq = sa.Column(sa.types.Integer, nullable=False, default=0)
+
+# A message is either in a folder or not, so each (message, tag) pair
+# can only appear once. Both indexes come first in the lookups they
+# serve: by message, for a message's flags, and by folder in UID
+# order, for sequence maps and UIDNEXT. They were added to existing
+# databases by ponyexpress.model.migrations
+sa.Index('ix_messages_tags_message_id_tag_id', MessageTag.__table__.c.message_id,
+         MessageTag.__table__.c.tag_id, unique=True)
+sa.Index('ix_messages_tags_tag_id_id', MessageTag.__table__.c.tag_id,
+         MessageTag.__table__.c.id)
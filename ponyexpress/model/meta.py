@@ -4,4 +4,34 @@ engine = None
 # SQLAlchemy session manager.  Updated by model.init_model()
 Session = None
 
-__all__ = ['engine', 'Session']
+# SQLAlchemy session manager for read-only queries that don't need to
+# see uncommitted changes; the same as Session unless there's a
+# separate read engine.  Updated by model.init_model()
+ReadSession = None
+
+# In-memory tag membership index, if enabled.  Updated by
+# model.init_model()
+index = None
+
+# Full-text index of message text, if enabled.  Updated by
+# model.init_model()
+fulltext = None
+
+# Codec for compressing new message bodies, if any.  Updated by
+# model.init_model()
+compression = None
+
+# Deduplicated store for message bodies, if enabled.  Updated by
+# model.init_model()
+blobs = None
+
+# Segment files for raw messages, if enabled.  Updated by
+# model.init_model()
+segments = None
+
+# Listeners on selected folders, and the changes waiting for them.
+# Updated by model.init_model()
+notifier = None
+
+__all__ = ['engine', 'Session', 'ReadSession', 'index', 'fulltext', 'compression', 'blobs',
+           'segments', 'notifier']
@@ -0,0 +1,271 @@
+"""
+Versioned changes to the schema of existing databases
+
+create_all() builds a new database with everything in the model, but
+it never touches a table that's already there, so a database created
+by an older version of PonyExpress doesn't get new columns, indexes or
+constraints, and any data that breaks them has to be cleaned up
+first.
+
+Each migration is a function with a version number, listed in order
+in migrations. The schema_migrations table records which versions a
+database has, and upgrade() applies the rest, one transaction each.
+Migrations are written so that it's safe to run them against a
+database that create_all() has just made, which already has
+everything they add; upgrade() straight after create_all() is always
+correct (see ponyexpress.scripts.migrate).
+"""
+
+from datetime import datetime
+
+import sqlalchemy as sa
+
+from ponyexpress.model.message import Message
+from ponyexpress.model.message_tag import MessageTag
+from ponyexpress.model.header import Header
+from ponyexpress.model.mime_part import MimePart
+from ponyexpress.model import meta
+from ponyexpress.model import counters
+from ponyexpress.model.idsets import match
+
+messages = Message.__table__
+messages_tags = MessageTag.__table__
+headers = Header.__table__
+mime_parts = MimePart.__table__
+
+# This isn't part of Base.metadata, so that create_all doesn't make a
+# database look up to date when it hasn't been migrated
+schema_migrations = sa.Table(
+    'schema_migrations', sa.MetaData(),
+    sa.Column('version', sa.types.Integer, primary_key=True,
+              autoincrement=False),
+    sa.Column('applied_at', sa.types.DateTime, nullable=False))
+
+# Indexes that have since been dropped from the model. They're
+# declared on copies of their tables, so that they aren't part of it
+# any more: the B-tree index on messages.body, which was no use for
+# searching, and the (field, value) index on headers that migration 7
+# added and migration 8 replaced
+_old_messages = sa.Table('messages', sa.MetaData(),
+                         sa.Column('body', sa.types.Text))
+body_index = sa.Index('ix_messages_body', _old_messages.c.body)
+_old_headers = sa.Table('headers', sa.MetaData(),
+                        sa.Column('field', sa.types.Unicode(255)),
+                        sa.Column('value', sa.types.UnicodeText))
+field_value_index = sa.Index('ix_headers_field_value',
+                             _old_headers.c.field, _old_headers.c.value)
+
+def has_index(name):
+    """
+    Whether the database already has an index called name. Raises
+    ValueError for a database that it doesn't know how to ask.
+    """
+    dialect = meta.engine.name
+    if dialect == 'sqlite':
+        query = "SELECT 1 FROM sqlite_master WHERE type = 'index' " \
+            "AND name = :name"
+    elif dialect == 'postgres':
+        query = 'SELECT 1 FROM pg_indexes WHERE indexname = :name'
+    elif dialect == 'mysql':
+        query = 'SELECT 1 FROM information_schema.statistics ' \
+            'WHERE table_schema = DATABASE() AND index_name = :name'
+    else:
+        raise ValueError('Unsupported database %s' % dialect)
+    return meta.Session.execute(query, {'name': name}).fetchone() is not None
+
+def has_column(table, name):
+    """
+    Whether the database's copy of table has a column called name.
+    """
+    reflected = sa.Table(table.name, sa.MetaData(), autoload=True,
+                         autoload_with=meta.Session.connection())
+    return name in reflected.c
+
+def add_column(column):
+    """
+    Add column to the database's copy of its table, if it isn't there
+    already.
+
+    Only the column's type is used, so it ends up nullable whatever
+    the model says: there's nothing to fill existing rows in with
+    until the migration does it.
+    """
+    if has_column(column.table, column.name):
+        return
+    spec = column.type.dialect_impl(meta.engine.dialect).get_col_spec()
+    meta.Session.execute('ALTER TABLE %s ADD COLUMN %s %s' %
+                         (column.table.name, column.name, spec))
+
+def create_indexes(table):
+    """
+    Create each of the indexes declared on table that the database
+    doesn't have yet.
+    """
+    for index in sorted(table.indexes, key=lambda i: i.name):
+        if not has_index(index.name):
+            index.create(bind=meta.Session.connection())
+
+def version():
+    """
+    Return the newest migration applied to the database, or 0 if
+    there are none.
+    """
+    # Creating a table can commit whatever else is going on, so this
+    # has to happen before anything else
+    schema_migrations.create(bind=meta.engine, checkfirst=True)
+    return meta.Session.execute(
+        sa.select([sa.func.max(schema_migrations.c.version)])).scalar() or 0
+
+def upgrade(target=None):
+    """
+    Apply every migration the database doesn't have yet, up to
+    target (or all of them), and return their versions.
+    """
+    current = version()
+    applied = []
+    for number, migration in migrations:
+        if number <= current or (target is not None and number > target):
+            continue
+        try:
+            migration()
+            meta.Session.execute(schema_migrations.insert(),
+                                 [{'version': number,
+                                   'applied_at': datetime.utcnow()}])
+            meta.Session.commit()
+        except:
+            meta.Session.rollback()
+            raise
+        applied.append(number)
+    return applied
+
+# The migrations
+
+def drop_body_index():
+    """
+    Drop the index on messages.body, which only made every insert
+    slower (see ponyexpress.model.fulltext).
+    """
+    if has_index(body_index.name):
+        body_index.drop(bind=meta.Session.connection())
+
+def compressed_bodies():
+    """
+    Add messages.compressed_body (see ponyexpress.model.bodies).
+    """
+    add_column(messages.c.compressed_body)
+
+def blob_bodies():
+    """
+    Add messages.blob_id (see ponyexpress.model.blobs).
+    """
+    add_column(messages.c.blob_id)
+
+def segment_bodies():
+    """
+    Add the columns recording where a message is in the segment store
+    (see ponyexpress.model.segments).
+    """
+    for column in (messages.c.segment, messages.c.segment_offset,
+                   messages.c.header_length):
+        add_column(column)
+
+def message_tag_modseqs():
+    """
+    Add messages_tags.modseq (see ponyexpress.model.counters). Every
+    existing row starts at 0, before any change a client could have
+    seen.
+    """
+    add_column(messages_tags.c.modseq)
+    meta.Session.execute(messages_tags.update(messages_tags.c.modseq==None,
+                                              values={'modseq': 0}))
+
+def dedup_messages_tags():
+    """
+    Remove messages_tags rows for a (message, tag) pair that already
+    has one.
+
+    The first row for each pair, which has the lowest UID, is the one
+    kept. Each of the others looked like another copy of the message
+    to clients, so they're recorded as vanished, and the folders'
+    counters are counted again.
+    """
+    pairs = dict(((m, t), first) for m, t, first in meta.Session.execute(
+            sa.select([messages_tags.c.message_id, messages_tags.c.tag_id,
+                       sa.func.min(messages_tags.c.id)],
+                      group_by=[messages_tags.c.message_id,
+                                messages_tags.c.tag_id],
+                      having=sa.func.count(messages_tags.c.id) > 1)))
+    if not pairs:
+        return
+
+    extra = [(u, m, t) for u, m, t in meta.Session.execute(
+            sa.select([messages_tags.c.id, messages_tags.c.message_id,
+                       messages_tags.c.tag_id],
+                      match(messages_tags.c.message_id,
+                            set(m for m, t in pairs))))
+             if (m, t) in pairs and u != pairs[(m, t)]]
+    meta.Session.execute(messages_tags.delete(
+            match(messages_tags.c.id, [u for u, m, t in extra])))
+
+    tag_ids = set(t for u, m, t in extra)
+    counters.update({}, {}, vanished=extra)
+    # The counters may well have counted the extra rows, so count
+    # them again
+    meta.Session.execute(counters.tag_counters.delete(
+            counters.tag_counters.c.tag_id.in_(tag_ids)))
+    for t in tag_ids:
+        counters.create(t)
+
+def index_messages_tags():
+    """
+    Add the unique (message_id, tag_id) index, and the (tag_id, id)
+    index for folders in UID order.
+    """
+    create_indexes(messages_tags)
+
+def index_headers():
+    """
+    Add the (field, value) index for looking up messages by header.
+    """
+    if not has_index(field_value_index.name):
+        field_value_index.create(bind=meta.Session.connection())
+
+def lower_header_fields():
+    """
+    Add headers.field_lower, the lowercased header name that searches
+    look headers up by, and replace the (field, value) index with one
+    on (field_lower, value).
+
+    Existing rows are filled in with the database's lower(), which is
+    the same as Python's for the ASCII that header names are made of.
+    """
+    add_column(headers.c.field_lower)
+    meta.Session.execute(headers.update(
+            headers.c.field_lower==None,
+            values={'field_lower': sa.func.lower(headers.c.field)}))
+    create_indexes(headers)
+    if has_index(field_value_index.name):
+        field_value_index.drop(bind=meta.Session.connection())
+
+def mime_part_headers():
+    """
+    Add mime_parts.headers, each part's own header block.
+
+    Parts that were indexed before it are left NULL, and their headers
+    are read from the body as they were before (see
+    ponyexpress.model.mime).
+    """
+    add_column(mime_parts.c.headers)
+
+# The columns come first, since the rest use the model's queries,
+# which expect them to be there
+migrations = [(1, drop_body_index),
+              (2, compressed_bodies),
+              (3, blob_bodies),
+              (4, segment_bodies),
+              (5, message_tag_modseqs),
+              (6, dedup_messages_tags),
+              (7, index_messages_tags),
+              (8, index_headers),
+              (9, lower_header_fields),
+              (10, mime_part_headers)]
@@ -0,0 +1,327 @@
+"""
+An index of the MIME structure of each message
+
+Answering BODYSTRUCTURE or fetching BODY[2.1] with MPart means
+parsing the whole message into an email.message.Message tree, which
+for a message with a 20 MB attachment means parsing and holding all
+20 MB. Instead, the structure is worked out once, when the message is
+added (see Message.fromString), and stored as a row per MIME entity
+in the mime_parts table: its content type, charset and transfer
+encoding, its size and line count, its headers, and where its body is
+in the message.
+
+IndexedPart then implements IMessagePart from those rows alone,
+reading a part's body by seeking straight to it in the message's body
+file. getBodyStructure() answers BODYSTRUCTURE from the rows without
+reading any of the body; ponyexpress.model.monkeypatch has twisted's
+IMAP server use it.
+
+Parts are numbered the way email.message.Message nests them, which
+is the way MPart.getSubPart walks them: each part of a multipart is a
+child, and a message/rfc822 part has a single child, the message it
+encapsulates.
+
+Messages added before this index existed, or some other way, can be
+indexed with index(); until they are, Message falls back on parsing
+them.
+"""
+
+import email.message
+import email.parser
+
+from zope.interface import implements
+from twisted.mail import imap4
+from twisted.mail.imap4 import getEnvelope, unquote
+
+from ponyexpress.model.mime_part import MimePart
+from ponyexpress.util.headers import Headers
+from ponyexpress.util import rfc822
+
+def _parse_headers(data):
+    return email.parser.HeaderParser().parsestr(data, True)
+
+def _scan(data, header_start, start, end, headers, path, parts):
+    """
+    Add the entity whose headers (already parsed into headers) start
+    at header_start and whose body runs from start to end, and
+    everything inside it, to parts.
+    """
+    content_type = headers.get_content_type()
+    # Lines are counted the way twisted's getLineCount does, which is
+    # what clients were told before there was an index
+    lines = data.count('\n', start, end)
+    if end > start and data[end - 1] != '\n':
+        lines += 1
+    parts.append({'path': path,
+                  'content_type': content_type,
+                  'charset': headers.get_content_charset(),
+                  'encoding': (headers.get('content-transfer-encoding') or
+                               '7bit').strip().lower(),
+                  'header_start': header_start,
+                  'body_start': start,
+                  'body_end': end,
+                  'lines': lines,
+                  'headers': path and data[header_start:start] or None})
+
+    prefix = path and path + '.' or ''
+    if content_type.startswith('multipart/') and headers.get_boundary():
+        default = content_type == 'multipart/digest' and \
+            'message/rfc822' or 'text/plain'
+        for i, (part_start, part_end) in enumerate(
+            _split(data, start, end, headers.get_boundary())):
+            _scan_entity(data, part_start, part_end, default,
+                         prefix + str(i + 1), parts)
+    elif content_type == 'message/rfc822':
+        _scan_entity(data, start, end, 'text/plain', prefix + '1', parts)
+
+def _scan_entity(data, start, end, default, path, parts):
+    """
+    Like _scan, but for an entity that starts with its own headers.
+    """
+    if data.startswith('\r\n', start):
+        length = 2
+    elif data.startswith('\n', start):
+        length = 1
+    else:
+        length = min(rfc822.header_length(data[start:end]), end - start)
+    headers = _parse_headers(data[start:start + length])
+    if 'content-type' not in headers:
+        headers.set_default_type(default)
+    _scan(data, start, start + length, end, headers, path, parts)
+
+def _split(data, start, end, boundary):
+    """
+    Return the (start, end) of each part of a multipart body between
+    start and end.
+    """
+    delimiter = '--' + boundary
+    result = []
+    part_start = None
+    pos = start
+    while pos < end:
+        i = data.find(delimiter, pos, end)
+        if i < 0:
+            break
+        after = data[i + len(delimiter):i + len(delimiter) + 1]
+        if (i != start and data[i - 1] != '\n') or \
+                after not in ('-', '\r', '\n', ' ', '\t', ''):
+            # Not at the start of a line, or just the start of some
+            # longer string
+            pos = i + len(delimiter)
+            continue
+        # The line break before the delimiter belongs to it
+        part_end = i
+        if part_end > start and data[part_end - 1] == '\n':
+            part_end -= 1
+            if part_end > start and data[part_end - 1] == '\r':
+                part_end -= 1
+        if part_start is not None:
+            result.append((part_start, max(part_start, part_end)))
+        if data.startswith('--', i + len(delimiter)):
+            # The close delimiter
+            part_start = None
+            break
+        eol = data.find('\n', i, end)
+        if eol < 0:
+            part_start = None
+            break
+        part_start = pos = eol + 1
+    if part_start is not None:
+        # No close delimiter; the last part runs to the end
+        result.append((part_start, end))
+    return result
+
+def scan(headers, body):
+    """
+    Work out the structure of a message with the given headers (a list
+    of (field, value) pairs) and body (bytes).
+
+    Returns a list of dicts with the columns of each MimePart, in
+    order.
+    """
+    parsed = email.message.Message()
+    for field, value in headers:
+        parsed[field] = value
+    parts = []
+    _scan(body, 0, 0, len(body), parsed, '', parts)
+    return parts
+
+def index(message, body=None):
+    """
+    Index the structure of message, replacing anything it had before.
+
+    body is the bytes of its body, if the caller already has them.
+    """
+    if body is None:
+        body = message.getBodyFile().read()
+    headers = [(h.field.encode('utf-8'), h.value.encode('utf-8'))
+               for h in message.headers]
+    message.mime_parts = [MimePart(**part) for part in scan(headers, body)]
+
+class PartFile(object):
+    """
+    A read-only file over a range of another file.
+    """
+
+    def __init__(self, f, start, length):
+        self.file = f
+        self.start = start
+        self.length = length
+        self.seek(0)
+
+    def read(self, size=-1):
+        left = self.length - self.position
+        if size < 0 or size > left:
+            size = left
+        data = self.file.read(size)
+        self.position += len(data)
+        return data
+
+    def readline(self):
+        line = self.file.readline()
+        left = self.length - self.position
+        if len(line) > left:
+            line = line[:left]
+            self.file.seek(self.start + self.position + left)
+        self.position += len(line)
+        return line
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.length
+        self.position = max(0, min(offset, self.length))
+        self.file.seek(self.start + self.position)
+
+    def close(self):
+        self.file.close()
+
+class IndexedPart(object):
+    """
+    An IMessagePart for a part of a message, answered from its
+    MimePart rows.
+    """
+    implements(imap4.IMessagePart)
+
+    def __init__(self, message, part):
+        self.message = message
+        self.part = part
+
+    def getHeaders(self, negate, *names):
+        if self.part.path == '':
+            items = [(h.field, h.value) for h in self.message.headers]
+        elif self.part.headers is not None:
+            items = _parse_headers(str(self.part.headers)).items()
+        else:
+            # Indexed before parts' headers were stored
+            f = self.message.getBodyFile()
+            f.seek(self.part.header_start)
+            items = _parse_headers(
+                f.read(self.part.body_start - self.part.header_start)).items()
+
+        return Headers(items).select(names, negate)
+
+    def getBodyFile(self):
+        return PartFile(self.message.getBodyFile(), self.part.body_start,
+                        self.part.size)
+
+    def getSize(self):
+        return self.part.size
+
+    def isMultipart(self):
+        return self.part.content_type.startswith('multipart/')
+
+    def getSubPart(self, part):
+        path = (self.part.path and self.part.path + '.' or '') + str(part + 1)
+        for p in self.message.mime_parts:
+            if p.path == path:
+                return IndexedPart(self.message, p)
+        raise IndexError(part)
+
+    def getBodyStructure(self, extended=False):
+        return getBodyStructure(self, extended)
+
+def _disposition(disp):
+    # Parsed the same questionable way twisted does
+    if disp:
+        disp = disp.split('; ')
+        if len(disp) == 1:
+            disp = (disp[0].lower(), None)
+        elif len(disp) > 1:
+            disp = (disp[0].lower(), [x.split('=') for x in disp[1:]])
+    return disp
+
+def getBodyStructure(part, extended=False):
+    """
+    Return the BODYSTRUCTURE (or BODY, if extended is False) of an
+    IndexedPart, the same as twisted.mail.imap4.getBodyStructure
+    would, but with line counts from the index instead of from reading
+    every text part.
+    """
+    attrs = {}
+    headers = part.getHeaders(False, 'content-type', 'content-id',
+                              'content-description',
+                              'content-transfer-encoding')
+    major = minor = None
+    mm = headers.get('content-type')
+    if mm:
+        mimetype = ''.join(mm.splitlines()).split(';')
+        major_minor = mimetype[0].split('/', 1)
+        if len(major_minor) == 1:
+            major = major_minor[0]
+        else:
+            major, minor = major_minor
+        attrs = dict([x.strip().lower().split('=', 1) for x in mimetype[1:]])
+
+    # The size of the message itself includes its headers
+    if part.part.path == '':
+        size = part.message.getSize()
+    else:
+        size = part.getSize()
+    result = [major, minor,
+              [(k, unquote(v)) for (k, v) in attrs.iteritems()],
+              headers.get('content-id'),
+              headers.get('content-description'),
+              headers.get('content-transfer-encoding'),
+              str(size)]
+
+    if major is not None:
+        if major.lower() == 'text':
+            result.append(str(part.part.lines))
+        elif (major.lower(), (minor or '').lower()) == ('message', 'rfc822'):
+            contained = part.getSubPart(0)
+            result.append(getEnvelope(contained))
+            result.append(getBodyStructure(contained, False))
+            result.append(str(contained.part.lines))
+
+    if not extended or major is None:
+        return result
+
+    if major.lower() != 'multipart':
+        headers = part.getHeaders(False, 'content-md5',
+                                  'content-disposition', 'content-language')
+        result.append(headers.get('content-md5'))
+        result.append(_disposition(headers.get('content-disposition')))
+        result.append(headers.get('content-language'))
+    else:
+        result = [result]
+        i = 0
+        while True:
+            try:
+                sub = part.getSubPart(i)
+            except IndexError:
+                break
+            result.append(getBodyStructure(sub))
+            i += 1
+        result.append(minor)
+        result.append(attrs.items())
+        headers = part.getHeaders(False, 'content-disposition',
+                                  'content-language')
+        result.append(_disposition(headers.get('content-disposition')))
+        result.append(headers.get('content-language'))
+
+    return result
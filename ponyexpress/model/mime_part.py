@@ -0,0 +1,44 @@
+import sqlalchemy as sa
+
+from ponyexpress.model.base import Base
+
+class MimePart(Base):
+    """
+    One entity in the MIME structure of a message, as found by
+    ponyexpress.model.mime when the message was added.
+
+    Offsets are in bytes from the start of the message's body (that
+    is, relative to Message.getBodyFile()), so they work however the
+    body is stored.
+    """
+    __tablename__ = 'mime_parts'
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = sa.Column(sa.types.Integer, primary_key=True)
+    message_id = sa.Column(sa.ForeignKey('messages.id', ondelete='CASCADE', onupdate='CASCADE'), nullable=False, index=True)
+    position = sa.Column(sa.types.Integer)
+    # Dotted, 1-based indexes of the part within its parents, as in
+    # IMAP's BODY[2.1]. The message itself is ''
+    path = sa.Column(sa.types.String(255), nullable=False)
+    # Lowercased, like 'text/plain'
+    content_type = sa.Column(sa.types.String(255), nullable=False)
+    charset = sa.Column(sa.types.String(255))
+    encoding = sa.Column(sa.types.String(255))
+    # Where the part's headers start, where its body starts, and where
+    # it ends. The message itself has no headers in the body, so for
+    # it, header_start == body_start == 0
+    header_start = sa.Column(sa.types.Integer, nullable=False)
+    body_start = sa.Column(sa.types.Integer, nullable=False)
+    body_end = sa.Column(sa.types.Integer, nullable=False)
+    # The number of lines in the part's body, counting a last line
+    # with no line break after it
+    lines = sa.Column(sa.types.Integer, nullable=False)
+    # The part's raw header block, so that BODYSTRUCTURE and
+    # BODY[2.1.HEADER] don't have to go to the body for it. It's NULL
+    # for the message itself, whose headers are Header rows, and for
+    # parts indexed before this column existed
+    headers = sa.Column(sa.types.Binary)
+
+    @property
+    def size(self):
+        return self.body_end - self.body_start
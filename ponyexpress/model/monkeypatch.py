@@ -9,9 +9,22 @@ explicitly specify a column as being PRIMARY KEY AUTOINCREMENT, it's
 possible for primary key values to be repeated. Unfortunately, because
 of how IMAP expects the UID and UIDVALIDITY and other fields to
 change, that's not acceptable for PonyExpress.
+
+We also have twisted's IMAP server ask messages for their own
+BODYSTRUCTURE, when they can work it out. twisted.mail.imap4.getBodyStructure
+counts the lines of every text part by reading it, which for a
+Message with a MIME index (see ponyexpress.model.mime) is already
+known.
+
+And we have it answer FETCH BODY[] from a message's raw file, when
+it has one (see ponyexpress.model.segments). Otherwise twisted puts
+the whole message back together with a MessageProducer, and it
+ignores the range of a partial FETCH like BODY[]<0.1024> entirely,
+sending everything instead.
 """
 
 import sqlalchemy
+from twisted.mail import imap4
 
 # I'm monkey patching the sqlite dialect to always set AUTOINCREMENT
 # on single-column primary key fields, because I need the semantics of
@@ -56,3 +69,37 @@ if sqlalchemy.__version__.startswith('0.5'):
             return super(PonySQLiteDDLCompile, self).visit_primary_key_constraint(constraint)
 
     sqlite.dialect.schemagenerator = PonySQLiteDDLCompile
+
+# The server calls getBodyStructure through the module's globals, so
+# replacing it there is enough
+_getBodyStructure = imap4.getBodyStructure
+
+def getBodyStructure(msg, extended=False):
+    if hasattr(msg, 'getBodyStructure'):
+        return msg.getBodyStructure(extended)
+    return _getBodyStructure(msg, extended)
+
+imap4.getBodyStructure = getBodyStructure
+
+_spew_body = imap4.IMAP4Server.spew_body
+
+def spew_body(self, part, id, msg, _w=None, _f=None):
+    raw = None
+    if part.empty and not part.part and hasattr(msg, 'getRawFile'):
+        raw = msg.getRawFile()
+    if raw is None:
+        return _spew_body(self, part, id, msg, _w, _f)
+
+    if _w is None:
+        _w = self.transport.write
+    if part.partialBegin is None:
+        _w(str(part) + ' ')
+        _f()
+        return imap4.FileProducer(raw).beginProducing(self.transport)
+    # Only read the range that was asked for. The response names
+    # just the origin octet (RFC 3501 section 7.4.2)
+    raw.seek(part.partialBegin)
+    data = raw.read(part.partialLength)
+    _w('BODY[]<%d> %s' % (part.partialBegin, imap4._literal(data)))
+
+imap4.IMAP4Server.spew_body = spew_body
@@ -0,0 +1,227 @@
+"""
+Change notifications for selected folders
+
+Without notifications, the only way for a client to find out about new
+mail or flags changed by another client is to keep sending NOOP or
+STATUS, and every one of those costs a trip to the database. With
+them, a client can IDLE, and a selected folder costs nothing at all
+until something actually happens to it.
+
+Tag and Mailbox register their IMailboxListeners with the Notifier
+(see addListener). Code that changes which tags messages have, or
+their \\Deleted flags, records which messages it touched. The ORM is
+covered by NotifyExtension; code that changes messages_tags directly
+(such as ponyexpress.model.store) has to record its changes itself.
+
+Like the tag index, changes are held per session and thrown away if
+the session rolls back. Once it commits, they're merged with anything
+else waiting, and on the next turn of the reactor each registered
+folder works out what the changes mean for it - its new EXISTS count,
+and the new flags of the messages it shows - and tells its listeners
+once. Any number of commits in between are coalesced into a single
+round of callbacks per listener.
+
+Nothing is recorded while nobody is listening.
+
+The Notifier belongs to the thread that created it, which should be
+the reactor's. Sessions in other threads (see
+ponyexpress.model.threads) can record and commit changes, and they're
+handed over to the Notifier's thread to be merged. The registered
+folders and each session's changes are kept under a lock, since any
+thread can be looking at them; listeners are always called from the
+Notifier's thread, outside it.
+
+Notifications only cover changes made by this process, and there's no
+way to tell a twisted IMailboxListener that a message has gone away,
+so messages that leave a folder aren't reported.
+"""
+
+import threading
+from weakref import WeakKeyDictionary
+
+import sqlalchemy as sa
+from sqlalchemy.orm.interfaces import SessionExtension
+from twisted.internet import reactor
+
+from ponyexpress.model.message_tag import MessageTag
+from ponyexpress.model import meta
+from ponyexpress.model.idsets import match
+
+messages_tags = MessageTag.__table__
+
+class Changes(object):
+    """
+    What's happened since listeners were last told.
+
+    messages is the set of ids of messages whose tags changed
+    (including being tagged for the first time). deleted is the set
+    of (message_id, tag_id) pairs whose \\Deleted flag changed.
+    """
+
+    def __init__(self):
+        self.messages = set()
+        self.deleted = set()
+
+    def __nonzero__(self):
+        return bool(self.messages or self.deleted)
+
+    def merge(self, other):
+        self.messages |= other.messages
+        self.deleted |= other.deleted
+
+class Notifier(object):
+    """
+    The listeners on every selected folder, and the changes they
+    haven't heard about yet.
+    """
+
+    def __init__(self, clock=reactor):
+        self.clock = clock
+        self._thread = threading.currentThread()
+        self._lock = threading.RLock()
+        # Maps each folder (a Tag, Mailbox or ThreadedFolder) to its
+        # listeners
+        self.folders = {}
+        self._pending = WeakKeyDictionary()
+        self._committed = Changes()
+        self._call = None
+
+    @property
+    def listening(self):
+        with self._lock:
+            return bool(self.folders)
+
+    def subscribe(self, folder, listener):
+        with self._lock:
+            self.folders.setdefault(folder, set()).add(listener)
+
+    def unsubscribe(self, folder, listener):
+        with self._lock:
+            listeners = self.folders.get(folder, set())
+            listeners.discard(listener)
+            if not listeners:
+                self.folders.pop(folder, None)
+
+    # Recording changes. Each of these takes effect when the current
+    # session commits
+
+    def _changes(self):
+        # Only called with the lock held
+        session = meta.Session()
+        if session not in self._pending:
+            self._pending[session] = Changes()
+        return self._pending[session]
+
+    def tags_changed(self, message_ids):
+        """
+        Record that the tags of the messages in message_ids changed.
+        """
+        with self._lock:
+            if self.folders:
+                self._changes().messages.update(message_ids)
+
+    def deleted_changed(self, message_ids, tag_id):
+        """
+        Record that the \\Deleted flag of the messages in message_ids
+        changed in the folder for tag_id.
+        """
+        with self._lock:
+            if self.folders:
+                self._changes().deleted.update((m, tag_id)
+                                               for m in message_ids)
+
+    def commit(self, session):
+        with self._lock:
+            changes = self._pending.pop(session, None)
+        if not changes:
+            return
+        if threading.currentThread() is not self._thread:
+            self.clock.callFromThread(self._merge, changes)
+        else:
+            self._merge(changes)
+
+    def _merge(self, changes):
+        self._committed.merge(changes)
+        if self._call is None:
+            self._call = self.clock.callLater(0, self.flush)
+
+    def rollback(self, session):
+        with self._lock:
+            self._pending.pop(session, None)
+
+    def flush(self):
+        """
+        Tell every listener about the changes committed since the last
+        flush.
+        """
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        changes, self._committed = self._committed, Changes()
+        if not changes:
+            return
+        with self._lock:
+            folders = [(folder, list(listeners))
+                       for folder, listeners in self.folders.items()]
+        for folder, listeners in folders:
+            folder._notify(listeners, changes)
+
+def flags(message_ids):
+    """
+    Return a dict mapping each message id in message_ids to the names
+    of its tags, which are its flags in every folder (apart from
+    \\Deleted, which is per-folder).
+    """
+    from ponyexpress.model.tag import Tag
+    tags = Tag.__table__
+
+    result = dict((m, []) for m in message_ids)
+    if result:
+        for m, name in meta.Session.execute(
+            sa.select([messages_tags.c.message_id, tags.c.name],
+                      sa.and_(match(messages_tags.c.message_id,
+                                    result.keys()),
+                              messages_tags.c.tag_id==tags.c.id))):
+            result[m].append(name)
+    return result
+
+def tell(listeners, exists, changed):
+    """
+    Call newMessages on listeners if exists isn't None, and
+    flagsChanged if changed (a dict mapping sequence numbers to
+    flags) isn't empty.
+    """
+    for listener in listeners:
+        if exists is not None:
+            listener.newMessages(exists, None)
+        if changed:
+            listener.flagsChanged(changed)
+
+class NotifyExtension(SessionExtension):
+    """
+    Record changes to tags made through the ORM, and hand them to the
+    Notifier when they're committed.
+    """
+
+    def after_flush(self, session, flush_context):
+        notifier = meta.notifier
+        if notifier is None or not notifier.listening:
+            return
+
+        for obj in session.new:
+            if isinstance(obj, MessageTag):
+                notifier.tags_changed([obj.message_id])
+        for obj in session.deleted:
+            if isinstance(obj, MessageTag):
+                notifier.tags_changed([obj.message_id])
+        for obj in session.dirty:
+            if isinstance(obj, MessageTag) and session.is_modified(obj):
+                notifier.deleted_changed([obj.message_id], obj.tag_id)
+
+    def after_commit(self, session):
+        if meta.notifier is not None:
+            meta.notifier.commit(session)
+
+    def after_rollback(self, session):
+        if meta.notifier is not None:
+            meta.notifier.rollback(session)
@@ -0,0 +1,356 @@
+"""
+IMAP SEARCH, executed in the database
+
+Without ISearchableMailbox, twisted answers SEARCH by fetching every
+message in the folder and checking each one in Python, which means
+loading all of their headers and bodies. Instead, the parsed search
+keys are compiled into one SELECT over the folder's contents, with
+each key becoming a condition on messages, headers or messages_tags:
+
+ - FROM, TO, CC, BCC, SUBJECT and HEADER become EXISTS subqueries
+   against headers, looked up by message_id. SUBJECT is also narrowed
+   down with the full-text index, if there is one
+
+ - KEYWORD and the flag keys (SEEN, FLAGGED, ...) become IN
+   subqueries against messages_tags, looked up by tag name
+
+ - BODY and TEXT use the full-text index (see
+   ponyexpress.model.fulltext), falling back to LIKE conditions on the
+   messages row and headers. Bodies that aren't stored as plain text
+   in messages.body (compressed, in the blob store or in a segment)
+   can't be matched with LIKE, so unless the index gives an exact
+   answer, the ones in the folder are decoded and checked while the
+   query is being compiled
+
+ - LARGER, SMALLER, BEFORE, ON and SINCE are conditions on the
+   messages row
+
+ - UID and sequence sets become ranges of UIDs, using the folder's
+   SequenceMap to translate sequence numbers
+
+ - NOT, OR and parenthesized lists combine those conditions
+
+Messages don't have a \\Recent flag (see Tag.getRecentCount), so
+RECENT and NEW never match and OLD always does. The SENT* keys would
+need the Date header parsed, which can't be done in SQL, so they
+aren't supported.
+
+A folder describes itself to run() with the columns holding each
+candidate's message id and UID, a condition selecting its rows, and an
+expression for whether a row is \\Deleted.
+"""
+
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+from twisted.mail import imap4
+
+from ponyexpress.model.header import Header
+from ponyexpress.model.message import Message
+from ponyexpress.model.message_tag import MessageTag
+from ponyexpress.model import meta
+from ponyexpress.model import fulltext
+from ponyexpress.model.idsets import match
+
+headers = Header.__table__
+messages = Message.__table__
+messages_tags = MessageTag.__table__
+
+# Conditions that always or never hold. The primary key is never NULL
+TRUE = messages.c.id != None
+FALSE = messages.c.id == None
+
+# Search keys that test a single header
+HEADER_KEYS = {'FROM': u'from',
+               'TO': u'to',
+               'CC': u'cc',
+               'BCC': u'bcc'}
+
+# Search keys that test for a flag being set or unset
+FLAG_KEYS = {'ANSWERED': (ur'\Answered', True),
+             'UNANSWERED': (ur'\Answered', False),
+             'DRAFT': (ur'\Draft', True),
+             'UNDRAFT': (ur'\Draft', False),
+             'FLAGGED': (ur'\Flagged', True),
+             'UNFLAGGED': (ur'\Flagged', False),
+             'SEEN': (ur'\Seen', True),
+             'UNSEEN': (ur'\Seen', False)}
+
+def _text(s):
+    if isinstance(s, str):
+        return s.decode('utf-8', 'replace')
+    return s
+
+def _contains(column, s):
+    """
+    Return a case-insensitive substring test of column against s.
+    """
+    s = _text(s).replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return column.ilike(u'%' + s + u'%', escape='\\')
+
+def _date(s):
+    try:
+        return datetime(*imap4.parseTime(s)[:3])
+    except ValueError:
+        raise imap4.IllegalQueryError('Invalid date: %s' % s)
+
+def _number(s):
+    try:
+        return int(s)
+    except ValueError:
+        raise imap4.IllegalQueryError('Invalid number: %s' % s)
+
+class SearchCompiler(object):
+    """
+    Turns a list of parsed search keys into a SQL condition.
+
+    Keys are consumed from the front of the list the same way twisted's
+    own search implementation does, so that NOT and OR can take their
+    arguments from whatever follows them.
+    """
+
+    def __init__(self, message_id, uid, sequence, deleted=None, where=None):
+        self.message_id = message_id
+        self.uid = uid
+        self.sequence = sequence
+        if deleted is None:
+            deleted = FALSE
+        self.deleted = deleted
+        if where is None:
+            where = TRUE
+        self.where = where
+
+    def compile(self, query):
+        """
+        Compile every key in query, which must all match.
+        """
+        query = list(query)
+        clauses = []
+        while query:
+            clauses.append(self.step(query))
+        if not clauses:
+            return TRUE
+        elif len(clauses) == 1:
+            return clauses[0]
+        return sa.and_(*clauses)
+
+    def step(self, query):
+        """
+        Compile the first key in query, removing it and its arguments.
+        """
+        q = query.pop(0)
+        if isinstance(q, list):
+            return self.compile(q)
+        key = q.upper()
+        if not key[:1].isalpha():
+            return self.sequence_set(q)
+        method = getattr(self, 'search_' + key, None)
+        if method is None:
+            raise imap4.IllegalQueryError('Unsupported search key: %s' % q)
+        return method(query)
+
+    def arg(self, query):
+        if not query:
+            raise imap4.IllegalQueryError('Missing search argument')
+        return query.pop(0)
+
+    def sequence_set(self, s):
+        """
+        A set of sequence numbers, which map onto contiguous ranges of
+        UIDs.
+        """
+        count = len(self.sequence)
+        if not count:
+            return FALSE
+        clauses = []
+        for lo, hi in imap4.parseIdList(s, count).ranges:
+            hi = min(hi, count)
+            if lo <= hi:
+                clauses.append(self.uid.between(self.sequence.getUID(lo),
+                                                self.sequence.getUID(hi)))
+        if not clauses:
+            return FALSE
+        return sa.or_(*clauses)
+
+    def header(self, field, value):
+        """
+        Whether the message has a header field containing value.
+        """
+        return sa.exists([headers.c.id],
+                         sa.and_(headers.c.message_id==self.message_id,
+                                 headers.c.field_lower==field.lower(),
+                                 _contains(headers.c.value, value)))
+
+    def keyword(self, name):
+        """
+        Whether the message is tagged with name.
+        """
+        from ponyexpress.model.tag import Tag
+        tags = Tag.__table__
+        mt = messages_tags.alias()
+        return self.message_id.in_(
+            sa.select([mt.c.message_id],
+                      sa.and_(mt.c.tag_id==tags.c.id,
+                              tags.c.name==_text(name))))
+
+    def __getattr__(self, name):
+        # The keys that only differ by which header or flag they look
+        # at are handled here
+        if name.startswith('search_'):
+            key = name[len('search_'):]
+            if key in HEADER_KEYS:
+                return lambda query: self.header(HEADER_KEYS[key],
+                                                 self.arg(query))
+            elif key in FLAG_KEYS:
+                flag, value = FLAG_KEYS[key]
+                if value:
+                    return lambda query: self.keyword(flag)
+                return lambda query: sa.not_(self.keyword(flag))
+        raise AttributeError(name)
+
+    def search_ALL(self, query):
+        return TRUE
+
+    def search_NEW(self, query):
+        return FALSE
+
+    def search_RECENT(self, query):
+        return FALSE
+
+    def search_OLD(self, query):
+        return TRUE
+
+    def search_DELETED(self, query):
+        return self.deleted
+
+    def search_UNDELETED(self, query):
+        return sa.not_(self.deleted)
+
+    def search_KEYWORD(self, query):
+        return self.keyword(self.arg(query))
+
+    def search_UNKEYWORD(self, query):
+        return sa.not_(self.keyword(self.arg(query)))
+
+    def search_HEADER(self, query):
+        field = _text(self.arg(query))
+        return self.header(field, self.arg(query))
+
+    def fulltext(self, fields, value, condition):
+        """
+        Narrow down a substring test of fields with the full-text
+        index, if there is one. condition is the test itself.
+        """
+        if meta.fulltext is None:
+            return condition
+        return meta.fulltext.match(self.message_id, fields, value, condition)
+
+    def search_SUBJECT(self, query):
+        value = self.arg(query)
+        return self.fulltext(('subject',), value,
+                             self.header(u'subject', value))
+
+    def body(self, value):
+        """
+        Whether the message's body contains value.
+
+        LIKE only works on plain bodies. Unless the full-text index
+        can answer exactly, every other body in the folder that might
+        match is loaded and checked here, and the ones that do match
+        become a list of message ids.
+        """
+        index = meta.fulltext
+        candidates = None
+        if index is not None:
+            candidates = index.candidates(self.message_id, ('body',), value)
+            if candidates is not None and index.exact:
+                return candidates
+
+        conditions = [self.where, messages.c.id==self.message_id,
+                      messages.c.body==None]
+        if candidates is not None:
+            conditions.append(candidates)
+        message_ids = [r[0] for r in meta.Session.execute(
+                sa.select([messages.c.id], sa.and_(*conditions)))]
+        wanted = _text(value).lower()
+        found = [m for m, body in fulltext.body_texts(message_ids)
+                 if wanted in body.lower()]
+
+        plain = _contains(messages.c.body, value)
+        if candidates is not None:
+            plain = sa.and_(candidates, plain)
+        return sa.or_(sa.and_(messages.c.body!=None, plain),
+                      match(self.message_id, found))
+
+    def search_BODY(self, query):
+        return self.body(self.arg(query))
+
+    def search_TEXT(self, query):
+        value = self.arg(query)
+        return sa.or_(
+            self.fulltext(('headers',), value,
+                sa.exists([headers.c.id],
+                          sa.and_(headers.c.message_id==self.message_id,
+                                  _contains(headers.c.value, value)))),
+            self.body(value))
+
+    def search_BEFORE(self, query):
+        return messages.c.created_at < _date(self.arg(query))
+
+    def search_ON(self, query):
+        date = _date(self.arg(query))
+        return sa.and_(messages.c.created_at >= date,
+                       messages.c.created_at < date + timedelta(days=1))
+
+    def search_SINCE(self, query):
+        return messages.c.created_at >= _date(self.arg(query))
+
+    def search_LARGER(self, query):
+        return messages.c.length > _number(self.arg(query))
+
+    def search_SMALLER(self, query):
+        return messages.c.length < _number(self.arg(query))
+
+    def search_NOT(self, query):
+        return sa.not_(self.step(query))
+
+    def search_OR(self, query):
+        return sa.or_(self.step(query), self.step(query))
+
+    def search_UID(self, query):
+        last = self.sequence.last()
+        s = self.arg(query)
+        if last is None:
+            return FALSE
+        return sa.or_(*[self.uid.between(lo, hi) for lo, hi in \
+                            imap4.parseIdList(s, last).ranges])
+
+def compile_search(query, message_id, uid, where, sequence, deleted=None):
+    """
+    Compile a parsed search query into a SELECT of the matching UIDs,
+    in ascending order.
+
+    message_id and uid are the columns holding each candidate's
+    message id and UID, and where selects the candidates in the
+    folder. sequence is the folder's SequenceMap, and deleted, if
+    given, is an expression for whether a candidate is \\Deleted.
+    """
+    compiler = SearchCompiler(message_id, uid, sequence, deleted, where)
+    criteria = compiler.compile(query)
+    return sa.select([uid],
+                     sa.and_(where, messages.c.id==message_id, criteria),
+                     order_by=[uid])
+
+def run(query, message_id, uid, where, sequence, deleted=None):
+    """
+    Run a parsed search query against a folder, returning the sequence
+    numbers of the matching messages.
+
+    The arguments are the same as for compile_search.
+    """
+    statement = compile_search(query, message_id, uid, where, sequence,
+                               deleted)
+    # Anything that's shown up in the folder since the client last
+    # looked at it doesn't have a sequence number yet
+    return [sequence.getSequence(r[0]) for r in \
+                meta.Session.execute(statement) if r[0] in sequence]
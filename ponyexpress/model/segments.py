@@ -0,0 +1,172 @@
+"""
+Raw messages in memory-mapped segment files
+
+Storing a message as a body column plus a row per header means that
+sending it back to a client in RFC 2822 form involves putting it back
+together again, and a partial FETCH like BODY[]<0.1024> pays for the
+whole message just to send the first kilobyte of it.
+
+With a SegmentStore (see init_model), Message.fromString appends the
+message's raw bytes to the end of a segment file instead, and the
+Message records where they ended up: the segment number, the offset
+within it, and how much of that is headers (the length of the whole
+thing is the Message's length, as always). The headers are still
+parsed into Header rows so that they can be searched.
+
+Reads go through an mmap of the segment, so getBodyFile() and
+getRawFile() return file-like objects that copy out only the bytes
+that are asked for (which is how FETCH BODY[] is answered; see
+ponyexpress.model.monkeypatch), and buffer() on those returns a view of the
+message without copying it at all.
+
+As with compressed bodies, searches for BODY and TEXT on these
+messages depend on the full-text index (see ponyexpress.model.fulltext).
+
+Segments are append-only. Nothing is ever removed from them, so the
+bytes of deleted messages (or of messages added by a transaction that
+was rolled back) stay behind until
+ponyexpress.model.expunge.compact_segments copies the messages that
+are left in a mostly-empty segment onto the end of the newest one and
+deletes the old file.
+"""
+
+import fcntl
+import mmap
+import os
+
+# The largest a segment gets before we start a new one
+segment_size = 64 * 1048576
+
+class SegmentFile(object):
+    """
+    A read-only file over a range of a memory-mapped segment.
+    """
+
+    def __init__(self, map, start, length):
+        self.map = map
+        self.start = start
+        self.end = start + length
+        self.position = start
+
+    def read(self, size=-1):
+        if size < 0 or self.position + size > self.end:
+            size = self.end - self.position
+        data = self.map[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    def readline(self):
+        i = self.map.find('\n', self.position, self.end)
+        if i < 0:
+            return self.read()
+        return self.read(i + 1 - self.position)
+
+    def tell(self):
+        return self.position - self.start
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.tell()
+        elif whence == 2:
+            offset += self.end - self.start
+        self.position = self.start + max(0, min(offset, self.end - self.start))
+
+    def buffer(self):
+        """
+        Return the whole range as a buffer, without copying it.
+        """
+        # Python 2's mmap objects don't support memoryview, but the
+        # old-style buffer works just as well for this
+        return buffer(self.map, self.start, self.end - self.start)
+
+    def close(self):
+        pass
+
+class SegmentStore(object):
+    """
+    A directory of segment files.
+    """
+
+    def __init__(self, directory, segment_size=segment_size):
+        self.directory = directory
+        self.segment_size = segment_size
+        # Maps of each segment we've read from, by segment number.
+        # Segments only ever grow, so a map is good for as long as it
+        # covers the range we're after
+        self._maps = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def filename(self, segment):
+        return os.path.join(self.directory, 'segment-%08d' % segment)
+
+    def segments(self):
+        """
+        Return the numbers of the segments in the store, in order.
+        """
+        return sorted(int(name.split('-', 1)[1])
+                      for name in os.listdir(self.directory)
+                      if name.startswith('segment-'))
+
+    def _last(self):
+        return max(self.segments() or [0])
+
+    def append(self, data):
+        """
+        Write data to the end of the current segment, and return the
+        (segment, offset) it was written at.
+        """
+        segment = self._last()
+        while True:
+            f = open(self.filename(segment), 'ab')
+            try:
+                # Keep other processes from appending at the same
+                # time, since we need to know where we wrote to
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0, 2)
+                offset = f.tell()
+                if offset and offset + len(data) > self.segment_size:
+                    segment += 1
+                    continue
+                f.write(data)
+                f.flush()
+                # The Message that points here is about to be
+                # committed, so the bytes have to be on disk first
+                os.fsync(f.fileno())
+                return segment, offset
+            finally:
+                f.close()
+
+    def _map(self, segment, end):
+        m = self._maps.get(segment)
+        if m is None or len(m) < end:
+            f = open(self.filename(segment), 'rb')
+            try:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+            self._maps[segment] = m
+        return m
+
+    def open(self, segment, offset, length):
+        """
+        Return a SegmentFile for length bytes at offset in segment.
+        """
+        if length <= 0:
+            # mmap can't map an empty file, and there's nothing to
+            # read anyway
+            return SegmentFile('', 0, 0)
+        return SegmentFile(self._map(segment, offset + length), offset, length)
+
+    def remove(self, segment):
+        """
+        Delete a segment's file. Anything already reading from it can
+        carry on, since its map outlives the file.
+        """
+        self._maps.pop(segment, None)
+        os.unlink(self.filename(segment))
+
+    def close(self):
+        for m in self._maps.itervalues():
+            m.close()
+        self._maps.clear()
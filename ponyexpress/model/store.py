@@ -0,0 +1,182 @@
+"""
+Bulk flag storage for the PonyExpress model
+
+An IMAP STORE routinely touches every message in a folder, so instead
+of creating one MessageTag object per (message, tag) pair, these
+functions work directly against the messages_tags table: adding tags
+costs one query to find the pairs that already exist and one
+executemany INSERT for the ones that don't. Nothing here goes through
+the ORM identity map; objects already loaded into the session will see
+the changes once they're expired, which happens on commit.
+"""
+
+import sqlalchemy as sa
+
+from ponyexpress.model.message_tag import MessageTag
+from ponyexpress.model import meta
+from ponyexpress.model import contents
+from ponyexpress.model import counters
+from ponyexpress.model.idsets import match
+
+messages_tags = MessageTag.__table__
+
+def add_tags(message_ids, tag_ids):
+    """
+    Tag each message in message_ids with each tag in tag_ids.
+
+    Pairs that already exist are left alone. Returns the number of
+    rows that were inserted.
+    """
+    message_ids = list(message_ids)
+    tag_ids = list(tag_ids)
+    if not message_ids or not tag_ids:
+        return 0
+
+    # Find the pairs that already exist in a single query
+    existing = set((r[0], r[1]) for r in meta.Session.execute(
+            sa.select([messages_tags.c.message_id, messages_tags.c.tag_id],
+                      sa.and_(messages_tags.c.tag_id.in_(tag_ids),
+                              match(messages_tags.c.message_id,
+                                    message_ids)))))
+
+    # Insert tag by tag so that, within a tag, UIDs get assigned in
+    # the same order as the messages
+    missing = [{'message_id': m, 'tag_id': t, 'deleted': False}
+               for t in tag_ids
+               for m in message_ids
+               if (m, t) not in existing]
+    if missing:
+        meta.Session.execute(messages_tags.insert(), missing)
+        changed = set(r['message_id'] for r in missing)
+        contents.update(changed, tag_ids)
+
+        after = counters.snapshot(changed)
+        before = dict((m, set(tags)) for m, tags in after.iteritems())
+        for r in missing:
+            before[r['message_id']].discard(r['tag_id'])
+        counters.update(before, after)
+        if meta.index is not None:
+            meta.index.add_tags((r['message_id'], r['tag_id'])
+                                for r in missing)
+        meta.notifier.tags_changed(changed)
+    return len(missing)
+
+def _delete(where):
+    """
+    Delete the messages_tags rows matching where, and return them as
+    (uid, message_id, tag_id), which is what counters.update wants to
+    know about rows that vanished.
+    """
+    rows = meta.Session.execute(
+        sa.select([messages_tags.c.id, messages_tags.c.message_id,
+                   messages_tags.c.tag_id], where)).fetchall()
+    if rows:
+        meta.Session.execute(messages_tags.delete(where))
+    return [tuple(r) for r in rows]
+
+def remove_tags(message_ids, tag_ids):
+    """
+    Remove each tag in tag_ids from each message in message_ids.
+    """
+    tag_ids = list(tag_ids)
+    if not tag_ids:
+        return
+    message_ids = list(message_ids)
+    before = counters.snapshot(message_ids)
+    vanished = _delete(sa.and_(match(messages_tags.c.message_id, message_ids),
+                               messages_tags.c.tag_id.in_(tag_ids)))
+    contents.update(message_ids, tag_ids)
+    counters.update(before, dict((m, tags - set(tag_ids))
+                                 for m, tags in before.iteritems()),
+                    vanished=vanished)
+    if meta.index is not None:
+        meta.index.remove_tags(message_ids, tag_ids)
+    meta.notifier.tags_changed(message_ids)
+
+def replace_tags(message_ids, tag_ids, keep=None):
+    """
+    Remove every tag from each message in message_ids except for those
+    in tag_ids and the tag keep.
+    """
+    tag_ids = list(tag_ids)
+    if keep is not None:
+        tag_ids.append(keep)
+    message_ids = list(message_ids)
+    before = counters.snapshot(message_ids)
+    where = match(messages_tags.c.message_id, message_ids)
+    if tag_ids:
+        where = sa.and_(where, ~messages_tags.c.tag_id.in_(tag_ids))
+    vanished = _delete(where)
+    # We don't know which tags were removed
+    contents.update(message_ids)
+    counters.update(before, dict((m, tags & set(tag_ids))
+                                 for m, tags in before.iteritems()),
+                    vanished=vanished)
+    if meta.index is not None:
+        meta.index.retain_tags(message_ids, tag_ids)
+    meta.notifier.tags_changed(message_ids)
+
+def set_deleted(message_ids, tag_id, deleted):
+    """
+    Set or clear the \Deleted flag on each message in message_ids,
+    within the folder for tag_id.
+    """
+    meta.Session.execute(messages_tags.update(
+            sa.and_(match(messages_tags.c.message_id, message_ids),
+                    messages_tags.c.tag_id==tag_id),
+            values={'deleted': deleted}))
+    counters.touch([tag_id], [(m, tag_id) for m in message_ids])
+    meta.notifier.deleted_changed(message_ids, tag_id)
+
+def store(message_ids, flags, mode, tag_id):
+    """
+    Apply an IMAP STORE to a set of messages.
+
+    flags and mode are as passed to IMailbox.store. tag_id is the tag
+    for the folder the STORE is happening in, which is where the
+    \Deleted flag gets recorded, and which is never removed by
+    replacing a message's flags - that would make the message vanish
+    from the folder it's being looked at in.
+
+    Flags that don't correspond to an existing tag are ignored.
+    """
+    from ponyexpress.model.tag import Tag
+
+    # The ids get used several times over, so make sure we can
+    # iterate over them more than once
+    message_ids = list(message_ids)
+
+    # \Deleted is the special case flag - it's not treated as a normal
+    # tag, but instead it's stored on the messages_tags secondary
+    # table
+    flags = list(flags)
+    deleted = '\Deleted' in flags
+    if deleted:
+        flags.remove('\Deleted')
+
+    if flags:
+        tags = [r[0] for r in \
+                    meta.Session.query(Tag.id).filter(Tag.name.in_(flags))]
+    else:
+        tags = []
+
+    if mode == -1:
+        remove_tags(message_ids, tags)
+        # If we're unsetting flags and \Deleted is one of the ones to
+        # unset
+        if deleted:
+            set_deleted(message_ids, tag_id, False)
+    else:
+        if mode == 0:
+            # Clear all of the flags that we're not about to set
+            replace_tags(message_ids, tags, keep=tag_id)
+            # If we're not setting \Deleted, then we need to unset it
+            if not deleted:
+                set_deleted(message_ids, tag_id, False)
+
+        # At this point, we know that we're not removing flags, so for
+        # both mode 0 and 1, we need to set all of the flags that were
+        # passed in
+        add_tags(message_ids, tags)
+        if deleted:
+            set_deleted(message_ids, tag_id, True)
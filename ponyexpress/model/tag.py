@@ -1,12 +1,23 @@
 import sqlalchemy as sa
-from sqlalchemy.orm import relation
+from sqlalchemy.orm import relation, eagerload_all
 from sqlalchemy.ext.associationproxy import association_proxy
 
 from ponyexpress.model.base import Base
 from ponyexpress.model.message_tag import MessageTag
+from ponyexpress.model.vanished_uid import VanishedUID
 from ponyexpress.model.message import Message
 from ponyexpress.model import meta
 from ponyexpress.model.decorators import in_transaction
+from ponyexpress.model import store
+from ponyexpress.model import counters
+from ponyexpress.model import search
+from ponyexpress.model import envelopes
+from ponyexpress.model import notify
+from ponyexpress.model import expunge as _expunge
+from ponyexpress.model import idsets
+from ponyexpress.model.idsets import match
+from ponyexpress.util.seqmap import SequenceMap, covers
+from ponyexpress.util.chunks import chunked
 
 from zope.interface import implements
 from twisted.mail import imap4
@@ -21,13 +32,48 @@ class Tag(Base):
     id = sa.Column(sa.types.Integer, primary_key=True)
     name = sa.Column(sa.types.Unicode(255), nullable=False, index=True,
                      unique=True)
+    # A list rather than a set, so that messages tagged in the same
+    # flush are inserted, and so given UIDs, in the order they were
+    # tagged
     tag_messages = relation(MessageTag,
                             backref='tag',
-                            collection_class=set,
                             cascade='all, delete-orphan')
     messages = association_proxy('tag_messages', 'message',
                                  creator=(lambda x: MessageTag(message=x)))
 
+    # The maximum number of messages to load in a single query when
+    # fetching
+    fetch_chunk_size = 500
+
+    # The SequenceMap for this folder. It's loaded the first time it's
+    # needed and then kept up to date for as long as this instance
+    # lives in the session, which is as long as the folder is
+    # selected
+    _sequence = None
+
+    def _getSequenceMap(self, refresh=True):
+        """
+        Return the SequenceMap for this folder.
+
+        If refresh is True, first add any messages that have been
+        tagged since the map was last used. Since UIDs are assigned in
+        increasing order, that's just the rows with an id higher than
+        the last one we know about.
+        """
+        if self._sequence is not None and not refresh:
+            return self._sequence
+
+        q = meta.Session.query(MessageTag.id).\
+            filter(MessageTag.tag_id==self.id)
+        if self._sequence is None:
+            self._sequence = SequenceMap()
+        else:
+            last = self._sequence.last()
+            if last is not None:
+                q = q.filter(MessageTag.id > last)
+        self._sequence.extend(r[0] for r in q.order_by(MessageTag.id))
+        return self._sequence
+
     def __parseSet(self, messages, uid):
         """
         Convert any MessageSet to something more generally usable
@@ -41,31 +87,9 @@ class Tag(Base):
         @param uid: Whether the IDs in messages are UIDs or message
         sequence IDs.
 
-        @rtype: An iterable of UIDs
+        @rtype: A list of UIDs
         """
-        if uid:
-            last = meta.Session.query(sa.func.max(MessageTag.id)).\
-                filter(MessageTag.tag_id==self.id).scalar()
-            if last is None:
-                return
-            else:
-                messages.last = last
-                for m in messages:
-                    yield m
-        else:
-            last = meta.Session.query(MessageTag).\
-                filter(MessageTag.tag_id==self.id).\
-                count()
-            if last is 0:
-                return
-            else:
-                messages.last = last
-                # TODO: Make this not as retardedly inefficient
-                #
-                # It'll currently generate one query per message
-                # sequence number.
-                for m in messages:
-                    yield self.getUID(m)
+        return self._getSequenceMap().resolve(messages, uid)
 
     # The twisted.mail.imap4.IMailboxInfo interface (inherited by IMailbox)
 
@@ -113,13 +137,13 @@ class Tag(Base):
             return 1
 
     def getUID(self, message):
-        return meta.Session.query(MessageTag.id).\
-            filter(MessageTag.tag_id==self.id).\
-            offset(message - 1).\
-            scalar()
+        # This gets called once per message in a response, so don't
+        # go back to the database - the map was brought up to date
+        # when the command's message set was parsed
+        return self._getSequenceMap(refresh=False).getUID(message)
 
     def getMessageCount(self):
-        return len(self.messages)
+        return len(self._getSequenceMap())
 
     def getRecentCount(self):
         # For the time being, PonyExpress never sets the \Recent flag
@@ -131,6 +155,13 @@ class Tag(Base):
         return 0
 
     def getUnseenCount(self):
+        if meta.index is not None:
+            seen = meta.Session.query(Tag.id).\
+                filter_by(name=ur'\Seen').scalar()
+            unseen = meta.index.get(self.id)
+            if seen is not None:
+                unseen = unseen - meta.index.get(seen)
+            return len(unseen)
         return meta.Session.query(Message).\
             filter(Message.message_tags.any(MessageTag.tag==self)).\
             filter(~Message.message_tags.any(MessageTag.tag.has(name=ur'\Seen'))).\
@@ -149,100 +180,209 @@ class Tag(Base):
         pass
 
     def requestStatus(self, names):
-        return imap4.statusRequestHelper(self, names)
+        # Clients poll STATUS on every folder constantly, so this is
+        # answered from the cached counters, which is a single query.
+        # It only needs what's been committed, so it can go to the
+        # read session, unless the folder has never changed and the
+        # counters have to be counted
+        counts = counters.read(self.id) or counters.get(self.id)
+        status = {}
+        for name in names:
+            key = name.upper()
+            if key == 'MESSAGES':
+                status[name] = counts['messages']
+            elif key == 'RECENT':
+                status[name] = self.getRecentCount()
+            elif key == 'UIDNEXT':
+                status[name] = counts['uidnext']
+            elif key == 'UIDVALIDITY':
+                status[name] = self.getUIDValidity()
+            elif key == 'UNSEEN':
+                status[name] = counts['unseen']
+            elif key == 'HIGHESTMODSEQ':
+                status[name] = counts['modseq']
+        return status
 
     def addListener(self, listener):
-        raise NotImplementedError
+        # Make sure the sequence map is loaded, so that there's a
+        # message count to compare against when something changes
+        self._getSequenceMap()
+        meta.notifier.subscribe(self, listener)
 
     def removeListener(self, listener):
-        raise NotImplementedError
+        meta.notifier.unsubscribe(self, listener)
+
+    def _notify(self, listeners, changes):
+        """
+        Tell listeners what changes (a ponyexpress.model.notify.Changes)
+        mean for this folder.
+        """
+        message_ids = changes.messages | \
+            set(m for m, t in changes.deleted if t == self.id)
+        if not message_ids:
+            return
+
+        known = len(self._getSequenceMap(refresh=False))
+        sequence = self._getSequenceMap()
+        exists = None
+        if len(sequence) > known:
+            exists = len(sequence)
+
+        # Messages that are new to the client will have their flags
+        # fetched anyway, so only report the ones it already knows
+        # about
+        rows = meta.Session.query(MessageTag.id, MessageTag.message_id,
+                                  MessageTag.deleted).\
+            filter(MessageTag.tag_id==self.id).\
+            filter(match(MessageTag.message_id, message_ids))
+        rows = [r for r in rows
+                if r[0] in sequence and sequence.getSequence(r[0]) <= known]
+        tags = notify.flags(r[1] for r in rows)
+        changed = {}
+        for uid, message_id, deleted in rows:
+            changed[sequence.getSequence(uid)] = tags[message_id] + \
+                (deleted and ['\Deleted'] or [])
+        notify.tell(listeners, exists, changed)
 
     def addMessage(self, message, flags={}, date=None):
         raise NotImplementedError
 
+    @in_transaction
     def expunge(self):
-        raise NotImplementedError
+        # The client knows the messages by their sequence numbers from
+        # before the expunge, so make sure the map is loaded first
+        sequence = self._getSequenceMap()
+        _expunge.expunge(self.id)
+        # Messages taken out of the folder some other way (like
+        # STORE -FLAGS with this folder's tag) have kept their place in
+        # the sequence until now, so they go along with the expunged
+        # ones
+        uids = list(sequence)
+        current = set(r[0] for r in meta.Session.query(MessageTag.id).\
+                          filter(MessageTag.tag_id==self.id).\
+                          filter(match(MessageTag.id, uids)))
+        return sequence.remove(u for u in uids if u not in current)
 
     def fetch(self, messages, uid):
         messages = self.__parseSet(messages, uid)
-        for m in messages:
-            yield meta.Session.query(MessageTag).get(m).message
+        # Pull the messages (and their headers, which the client is
+        # almost certainly going to want) a chunk at a time, so that
+        # both the number of queries and the amount of memory used
+        # stay bounded
+        for chunk in chunked(messages, self.fetch_chunk_size):
+            rows = meta.Session.query(MessageTag).\
+                options(eagerload_all('message.headers')).\
+                filter(MessageTag.id.in_(chunk))
+            found = dict((mt.id, mt.message) for mt in rows)
+            for m in chunk:
+                if m in found:
+                    yield found[m]
+
+    def fetchSummaries(self, messages, uid):
+        """
+        Like fetch, but yield the Summary of each message (see
+        ponyexpress.model.envelopes) instead of the message itself,
+        which is everything a client's message list asks for.
+        """
+        messages = self.__parseSet(messages, uid)
+        for chunk in chunked(messages, self.fetch_chunk_size):
+            found = envelopes.summaries(chunk, MessageTag.__table__.c.id)
+            for m in chunk:
+                if m in found:
+                    yield found[m]
 
     @in_transaction
     def store(self, messages, flags, mode, uid):
-        # TODO: Figure out what the hell the semantics are if you try
-        # to change the flag corresponding to this folder
-        #
-        # Also how we notify all of the appropriate listeners that
-        # we're mucking with the flags
-
+        # Listeners hear about the new flags from
+        # ponyexpress.model.notify once this commits
         messages = self.__parseSet(messages, uid)
 
-        # \Deleted is the special case flag - it's not treated as a
-        # normal tag, but instead it's stored on the messages_tags
-        # secondary table
-        try:
-            flags.remove('\Deleted')
-            deleted = True
-        except ValueError:
-            deleted = False
+        # Our UIDs are messages_tags ids, but flags get stored against
+        # message ids
+        message_ids = dict(
+            meta.Session.query(MessageTag.id, MessageTag.message_id).\
+                filter(MessageTag.tag_id==self.id).\
+                filter(match(MessageTag.id, messages)))
+        message_ids = [message_ids[m] for m in messages if m in message_ids]
 
-        # Get tag IDs, because we'll generally want to use those
-        #
-        # SQLAlchemy doesn't seem to be able to give me just a list of
-        # ints instead of a list of tuples, so let's just go ahead and
-        # get the first (and only) element of each tuple
-        tags = [r[0] for r in \
-                    meta.Session.query(Tag.id).filter(Tag.name.in_(flags))]
-
-        if mode == -1:
-            meta.Session.query(MessageTag).\
-                filter(MessageTag.message_id.in_(messages)).\
-                filter(MessageTag.tag_id.in_(tags)).\
-                delete()
-            # If we're unsetting flags and \Deleted is one of the ones
-            # to unset
-            if deleted:
-                meta.Session.query(MessageTag).\
-                    filter(MessageTag.message_id.in_(messages)).\
-                    filter(MessageTag.tag==self).\
-                    update({'deleted': False})
-        else:
-            if mode == 0:
-                # Clear all of the flags that we're not about to
-                # set
-                meta.Session.query(MessageTag).\
-                    filter(MessageTag.message_id.in_(messages)).\
-                    filter(~MessageTag.tag_id.in_(tags)).\
-                    delete()
-                # If we're not setting \Deleted, then we need to
-                # unset it
-                if not deleted:
-                    meta.Session.query(MessageTag).\
-                        filter(MessageTag.message_id.in_(messages)).\
-                        filter(MessageTag.tag==self).\
-                        update({'deleted': False})
-
-            # At this point, we know that we're not removing flags, so
-            # for both mode 0 and 1, we need to set all of the flags
-            # that were passed in
-            #
-            # Unfortunately, there's not a particularly efficient way
-            # to generate this
-            for tag in tags:
-                for message in messages:
-                    meta.Session.add(MessageTag(message_id=message,
-                                                tag_id=tag))
-            if deleted:
-                meta.Session.query(MessageTag).\
-                    filter(MessageTag.message_id.in_(messages)).\
-                    filter(MessageTag.tag==self).\
-                    update({'deleted': True})
+        # Removing the flag corresponding to this folder takes
+        # messages out of it, but they keep their sequence numbers
+        # until the next EXPUNGE, since nothing else is allowed to
+        # change them
+        store.store(message_ids, flags, mode, self.id)
+
+    # CONDSTORE and QRESYNC (RFC 4551 and RFC 5162). twisted's IMAP
+    # server doesn't speak either of them, but a server that does can
+    # use these to let a reconnecting client catch up by fetching only
+    # what changed
+
+    def getHighestModSeq(self):
+        return counters.get(self.id)['modseq']
+
+    def fetchChanged(self, messages, uid, since):
+        """
+        FETCH (CHANGEDSINCE since): return (uid, modseq, flags) for
+        each of messages whose flags changed after modseq since, in
+        sequence order.
+        """
+        messages = self.__parseSet(messages, uid)
+        q = meta.Session.query(MessageTag.id, MessageTag.message_id,
+                               MessageTag.modseq, MessageTag.deleted).\
+            filter(MessageTag.tag_id==self.id).\
+            filter(MessageTag.modseq > since)
+        # Only the rows that changed come back, so a resync costs as
+        # much as what changed; for a big set of messages, it's
+        # cheaper to pick out the ones asked for here than to send the
+        # whole set to the database
+        if len(messages) <= idsets.threshold:
+            q = q.filter(MessageTag.id.in_(messages))
+        wanted = set(messages)
+        rows = sorted(r for r in q if r[0] in wanted)
+        tags = notify.flags(r[1] for r in rows)
+        return [(uid, modseq, tags[message_id] +
+                 (deleted and ['\Deleted'] or []))
+                for uid, message_id, modseq, deleted in rows]
+
+    def vanishedSince(self, since, messages=None):
+        """
+        Return the UIDs of messages that left this folder after modseq
+        since, in order. If messages (a MessageSet of UIDs) is given,
+        only those UIDs are considered.
+        """
+        uids = [r[0] for r in meta.Session.query(VanishedUID.uid).\
+                    filter(VanishedUID.tag_id==self.id).\
+                    filter(VanishedUID.modseq > since).\
+                    order_by(VanishedUID.uid)]
+        if messages is not None:
+            uids = [u for u in uids if covers(messages, u)]
+        return uids
+
+    def resync(self, uidvalidity, since, messages=None):
+        """
+        SELECT ... (QRESYNC (uidvalidity since [messages])): return
+        the UIDs that have vanished and the (uid, modseq, flags) of
+        the messages that changed since modseq since, or None if
+        uidvalidity is out of date and the client has to start over.
+        """
+        if uidvalidity != self.getUIDValidity():
+            return None
+        if messages is None:
+            messages = imap4.MessageSet(1, None)
+        return (self.vanishedSince(since, messages),
+                self.fetchChanged(messages, True, since))
 
     # The twisted.mail.imap4.ISearchableMailbox interface
 
     def search(self, query, uid):
-        raise NotImplementedError
+        # The whole search runs as one query over our messages_tags
+        # rows; see ponyexpress.model.search
+        messages_tags = MessageTag.__table__
+        return search.run(query,
+                          messages_tags.c.message_id,
+                          messages_tags.c.id,
+                          messages_tags.c.tag_id==self.id,
+                          self._getSequenceMap(),
+                          messages_tags.c.deleted==True)
 
     # The twisted.mail.imap4.IMessageCopier interface
 
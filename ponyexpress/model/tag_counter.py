@@ -0,0 +1,16 @@
+import sqlalchemy as sa
+
+from ponyexpress.model.base import Base
+
+class TagCounter(Base):
+    """
+    Cached STATUS values for the folder corresponding to a tag. These
+    rows are maintained by ponyexpress.model.counters.
+    """
+    __tablename__ = 'tag_counters'
+
+    tag_id = sa.Column(sa.ForeignKey('tags.id', ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
+    messages = sa.Column(sa.types.Integer, nullable=False, default=0)
+    unseen = sa.Column(sa.types.Integer, nullable=False, default=0)
+    uidnext = sa.Column(sa.types.Integer, nullable=False, default=1)
+    modseq = sa.Column(sa.types.Integer, nullable=False, default=1)
@@ -0,0 +1,432 @@
+"""
+Running the model off the reactor thread
+
+Everything in the model talks to the database synchronously, so
+calling a Tag or Mailbox straight from the reactor means that one
+slow FETCH or STORE holds up every other connection until it's done.
+
+A DatabasePool runs that work on a fixed number of threads instead,
+and hands the results back to the reactor as Deferreds. meta.Session
+is a scoped_session, so each thread gets a session (and a database
+connection) of its own. What the sessions share - the tag index and
+the Notifier - takes a lock of its own (see ponyexpress.model.index
+and ponyexpress.model.notify), so both can be used with a pool.
+
+Each connection to the server should wrap the folder it has selected
+in a ThreadedFolder, which is bound to one of the pool's Workers. A
+Worker runs its jobs one at a time, in the order they were queued, so
+the commands from one connection are answered in order, and the
+folder (with its sequence numbers) is only ever used from the one
+thread. Every method of a ThreadedFolder returns a Deferred, even the
+IMailboxInfo ones that twisted's IMAP server expects to answer
+straight away, so a server using them has to wait on those too.
+
+Results have to be safe to use from the reactor, so a ThreadedFolder
+turns generators into lists, and loads everything a fetched Message
+needs and detaches it from the worker's session before handing it
+over.
+
+The pool only queues up to max_queue jobs that haven't started yet;
+past that, new jobs fail straight away with PoolFull rather than
+piling up behind a stuck database. PoolMetrics (and a LagMonitor, for
+how late the reactor is running) show how close it's getting.
+"""
+
+import threading
+import time
+import Queue
+
+from zope.interface import implements
+from twisted.internet import defer, reactor
+from twisted.mail import imap4
+from twisted.python import failure, log
+
+from ponyexpress.model.message import Message
+from ponyexpress.model import meta
+
+class PoolFull(Exception):
+    """
+    The DatabasePool already has as many jobs waiting as it allows.
+    """
+
+class PoolMetrics(object):
+    """
+    Counters for how busy a DatabasePool is. Wait is the time from a
+    job being queued to it starting, and lag is how late a LagMonitor
+    found the reactor running.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.busy = 0
+        self.max_queued = 0
+        self.jobs = 0
+        self.failures = 0
+        self.rejected = 0
+        self.max_wait = 0.0
+        self._wait_total = 0.0
+        self.lag = 0.0
+        self.max_lag = 0.0
+
+    def queue(self, limit):
+        """
+        Count a new job, unless there are already limit jobs waiting.
+        Returns whether it was counted.
+        """
+        with self._lock:
+            if self.queued >= limit:
+                self.rejected += 1
+                return False
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+            return True
+
+    def start(self, wait):
+        with self._lock:
+            self.queued -= 1
+            self.busy += 1
+            self.max_wait = max(self.max_wait, wait)
+            self._wait_total += wait
+
+    def finish(self, ok):
+        with self._lock:
+            self.busy -= 1
+            self.jobs += 1
+            if not ok:
+                self.failures += 1
+
+    def lagged(self, lag):
+        self.lag = lag
+        self.max_lag = max(self.max_lag, lag)
+
+    def snapshot(self):
+        """
+        Return the metrics as a dict.
+        """
+        with self._lock:
+            return {'queued': self.queued,
+                    'busy': self.busy,
+                    'max_queued': self.max_queued,
+                    'jobs': self.jobs,
+                    'failures': self.failures,
+                    'rejected': self.rejected,
+                    'mean_wait': self.jobs and
+                        self._wait_total / self.jobs or 0.0,
+                    'max_wait': self.max_wait,
+                    'lag': self.lag,
+                    'max_lag': self.max_lag}
+
+class Worker(object):
+    """
+    A thread that runs jobs one at a time, in order.
+    """
+
+    def __init__(self, pool, name):
+        self.pool = pool
+        self.name = name
+        # The number of jobs queued or running
+        self.pending = 0
+        self._queue = Queue.Queue()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name=self.name)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Finish everything that's queued, and then stop.
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def run(self, f, *args, **kwargs):
+        """
+        Call f(*args, **kwargs) in this worker's thread. Returns a
+        Deferred that fires with its result in the reactor thread.
+
+        The session is committed once f returns, or rolled back if it
+        raises, so no transaction is left open between jobs.
+        """
+        if not self.pool.metrics.queue(self.pool.max_queue):
+            return defer.fail(PoolFull())
+        d = defer.Deferred()
+        self.pending += 1
+        d.addBoth(self._done)
+        self._queue.put((time.time(), d, f, args, kwargs))
+        return d
+
+    def _done(self, result):
+        self.pending -= 1
+        return result
+
+    def _loop(self):
+        metrics = self.pool.metrics
+        callFromThread = self.pool.reactor.callFromThread
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            queued, d, f, args, kwargs = job
+            metrics.start(time.time() - queued)
+            try:
+                result = f(*args, **kwargs)
+                meta.Session.commit()
+            except:
+                result = failure.Failure()
+                meta.Session.rollback()
+                metrics.finish(False)
+                callFromThread(d.errback, result)
+            else:
+                metrics.finish(True)
+                callFromThread(d.callback, result)
+            # Don't hang on to the job until the next one comes along
+            del job, d, f, args, kwargs, result
+        meta.Session.remove()
+
+class DatabasePool(object):
+    """
+    A fixed set of Workers to run database work on.
+
+    size is the number of threads, and max_queue the number of jobs
+    that can be waiting to start across all of them. Results are
+    handed back through reactor.
+    """
+
+    def __init__(self, size=4, max_queue=100, reactor=reactor):
+        self.size = size
+        self.max_queue = max_queue
+        self.reactor = reactor
+        self.metrics = PoolMetrics()
+        self.workers = [Worker(self, 'ponyexpress-db-%d' % i)
+                        for i in xrange(size)]
+        self.started = False
+        self._next = 0
+
+    def start(self):
+        if not self.started:
+            for w in self.workers:
+                w.start()
+            self.started = True
+
+    def stop(self):
+        if self.started:
+            for w in self.workers:
+                w.stop()
+            self.started = False
+
+    def worker(self):
+        """
+        Return the Worker with the least to do, for a new connection
+        to use for all its commands.
+        """
+        # Take turns between the ones that are equally busy, so that
+        # connections that are idle now still get spread out
+        self._next = (self._next + 1) % len(self.workers)
+        workers = self.workers[self._next:] + self.workers[:self._next]
+        return min(workers, key=lambda w: w.pending)
+
+    def run(self, f, *args, **kwargs):
+        """
+        Run a one-off job on whichever Worker is least busy (see
+        Worker.run).
+        """
+        return self.worker().run(f, *args, **kwargs)
+
+class LagMonitor(object):
+    """
+    Check every interval seconds how much later than asked for the
+    reactor got around to it, and record that in metrics.
+    """
+
+    def __init__(self, metrics, interval=1.0, clock=reactor):
+        self.metrics = metrics
+        self.interval = interval
+        self.clock = clock
+        self._call = None
+
+    def start(self):
+        self._schedule()
+
+    def stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def _schedule(self):
+        self._call = self.clock.callLater(self.interval, self._check,
+                                          self.clock.seconds())
+
+    def _check(self, scheduled):
+        self.metrics.lagged(
+            max(0.0, self.clock.seconds() - scheduled - self.interval))
+        self._schedule()
+
+def detach(messages):
+    """
+    Load everything that answering a FETCH might need from each of
+    messages, and take them out of the session, so that they can be
+    used from another thread.
+    """
+    session = meta.Session()
+    for m in messages:
+        m.headers, m.mime_parts
+        if m.blob_id is not None:
+            m.blob._body
+            if m.blob in session:
+                session.expunge(m.blob)
+        elif m.segment is None:
+            m._body
+        session.expunge(m)
+    return messages
+
+class Relay(object):
+    """
+    An IMailboxListener that passes everything on to listener in the
+    reactor thread.
+    """
+
+    def __init__(self, listener, reactor):
+        self.listener = listener
+        self.reactor = reactor
+
+    def modeChanged(self, writeable):
+        self.reactor.callFromThread(self.listener.modeChanged, writeable)
+
+    def flagsChanged(self, newFlags):
+        self.reactor.callFromThread(self.listener.flagsChanged, newFlags)
+
+    def newMessages(self, exists, recent):
+        self.reactor.callFromThread(self.listener.newMessages, exists, recent)
+
+class ThreadedFolder(object):
+    """
+    A Tag or Mailbox whose methods all run on worker, and return
+    Deferreds.
+    """
+    implements(imap4.IMailbox, imap4.ISearchableMailbox, imap4.IMessageCopier)
+
+    def __init__(self, folder, worker):
+        # The folder is loaded again in the worker's own session, and
+        # only ever touched from there
+        self._class = type(folder)
+        self._id = folder.id
+        self._folder = None
+        self.worker = worker
+
+    def _load(self):
+        if self._folder is None:
+            self._folder = meta.Session.query(self._class).get(self._id)
+        return self._folder
+
+    def _call(self, name, *args, **kwargs):
+        return self.worker.run(
+            lambda: getattr(self._load(), name)(*args, **kwargs))
+
+    # The twisted.mail.imap4.IMailboxInfo interface
+
+    def getFlags(self):
+        return self._call('getFlags')
+
+    def getHierarchialDelimiter(self):
+        return self._call('getHierarchialDelimiter')
+
+    # The twisted.mail.imap4.IMailbox interface
+
+    def getUIDValidity(self):
+        return self._call('getUIDValidity')
+
+    def getUIDNext(self):
+        return self._call('getUIDNext')
+
+    def getUID(self, message):
+        return self._call('getUID', message)
+
+    def getMessageCount(self):
+        return self._call('getMessageCount')
+
+    def getRecentCount(self):
+        return self._call('getRecentCount')
+
+    def getUnseenCount(self):
+        return self._call('getUnseenCount')
+
+    def isWriteable(self):
+        return self._call('isWriteable')
+
+    def destroy(self):
+        return self._call('destroy')
+
+    def requestStatus(self, names):
+        return self._call('requestStatus', names)
+
+    def addListener(self, listener):
+        # This subscribes, rather than the folder, so that _notify
+        # gets called here, and can pass it on to the worker. Loading
+        # the message count first gives the folder something to
+        # compare against when it's told about changes
+        d = self._call('getMessageCount')
+        d.addCallback(lambda _: meta.notifier.subscribe(self, listener))
+        return d
+
+    def removeListener(self, listener):
+        # Going through the worker keeps this in order with
+        # addListener
+        d = self.worker.run(lambda: None)
+        d.addCallback(lambda _: meta.notifier.unsubscribe(self, listener))
+        return d
+
+    def _notify(self, listeners, changes):
+        reactor = self.worker.pool.reactor
+        relays = [Relay(l, reactor) for l in listeners]
+        d = self._call('_notify', relays, changes)
+        d.addErrback(log.err, 'Notifying listeners failed')
+        return d
+
+    def addMessage(self, message, flags=(), date=None):
+        return self._call('addMessage', message, flags, date)
+
+    def expunge(self):
+        return self._call('expunge')
+
+    def fetch(self, messages, uid):
+        return self.worker.run(
+            lambda: detach(list(self._load().fetch(messages, uid))))
+
+    def fetchSummaries(self, messages, uid):
+        return self.worker.run(
+            lambda: list(self._load().fetchSummaries(messages, uid)))
+
+    def store(self, messages, flags, mode, uid):
+        return self._call('store', messages, flags, mode, uid)
+
+    # CONDSTORE and QRESYNC; see Tag
+
+    def getHighestModSeq(self):
+        return self._call('getHighestModSeq')
+
+    def fetchChanged(self, messages, uid, since):
+        return self._call('fetchChanged', messages, uid, since)
+
+    def vanishedSince(self, since, messages=None):
+        return self._call('vanishedSince', since, messages)
+
+    def resync(self, uidvalidity, since, messages=None):
+        return self._call('resync', uidvalidity, since, messages)
+
+    # The twisted.mail.imap4.ISearchableMailbox interface
+
+    def search(self, query, uid):
+        return self._call('search', query, uid)
+
+    # The twisted.mail.imap4.IMessageCopier interface
+
+    def copy(self, msg):
+        # msg came from fetch, so it's been detached; copy the one in
+        # the worker's session instead
+        return self.worker.run(
+            lambda: self._load().copy(meta.Session.query(Message).get(msg.id)))
@@ -0,0 +1,161 @@
+"""
+Database settings for running a mail server
+
+Out of the box, SQLite keeps a rollback journal, which means that
+while a delivery is committing, every IMAP client trying to read has
+to wait for it. tune() sets up each connection an engine opens for
+serving mail instead:
+
+ - SQLite goes into WAL mode, where readers carry on reading the last
+   committed state while a writer works. With WAL, synchronous=NORMAL
+   is still safe against corruption, and only has to sync at
+   checkpoints. Reads come out of a bigger page cache and a
+   memory-mapped file, temporary tables (like id_sets) stay in memory,
+   and anyone who does hit a lock waits busy_timeout for it rather
+   than failing.
+ - Other databases get their connections checked before they're
+   handed out ("pre-ping"), so that one the server has dropped is
+   replaced instead of failing the next command.
+
+create_engine() also sizes the connection pool for a server database,
+and the statement cache for SQLite.
+
+Read-only work (STATUS, and the list-view FETCH of fetchSummaries) can
+go through a separate engine from read_engine(), used by
+meta.ReadSession. Its sessions autocommit, so every read sees the
+latest committed state and never holds a transaction open, and on
+SQLite its connections refuse to write at all.
+"""
+
+import sqlalchemy
+from sqlalchemy import exc
+from sqlalchemy.interfaces import PoolListener
+
+# SQLite PRAGMAs for every connection, in the order they're set
+sqlite_pragmas = [('journal_mode', 'WAL'),
+                  ('synchronous', 'NORMAL'),
+                  ('busy_timeout', 5000),
+                  # 64 MB, in KB
+                  ('cache_size', -65536),
+                  ('mmap_size', 256 * 1024 * 1024),
+                  ('temp_store', 'MEMORY')]
+
+# How many prepared statements pysqlite keeps per connection
+statement_cache = 256
+
+# Connection pooling for server databases
+pool_size = 10
+max_overflow = 20
+# Drop connections older than this many seconds, before the server
+# times them out
+pool_recycle = 3600
+
+def is_memory(url):
+    """
+    Whether url is an in-memory SQLite database, which only exists
+    for the connection that made it.
+    """
+    url = sqlalchemy.engine.url.make_url(url)
+    return url.drivername.startswith('sqlite') and url.database in (None, '',
+                                                                    ':memory:')
+
+def create_engine(url, **kwargs):
+    """
+    Like sqlalchemy.create_engine, but with pool and statement cache
+    settings for a server. Anything in kwargs overrides them.
+    """
+    url = sqlalchemy.engine.url.make_url(url)
+    if url.drivername.startswith('sqlite'):
+        options = {'connect_args': {'timeout': busy_timeout(),
+                                    'cached_statements': statement_cache}}
+    else:
+        options = {'pool_size': pool_size,
+                   'max_overflow': max_overflow,
+                   'pool_recycle': pool_recycle}
+    options.update(kwargs)
+    return sqlalchemy.create_engine(url, **options)
+
+def read_engine(engine):
+    """
+    Return a second engine for the same database as engine, for read
+    sessions, or None if it can't have one (an in-memory SQLite
+    database can't be shared between connections).
+    """
+    if is_memory(engine.url):
+        return None
+    return create_engine(engine.url)
+
+def busy_timeout():
+    """
+    The busy timeout in sqlite_pragmas, in seconds.
+    """
+    return dict(sqlite_pragmas).get('busy_timeout', 5000) / 1000.0
+
+def tune(engine, read_only=False):
+    """
+    Set up every connection engine opens for serving mail. If
+    read_only is True, SQLite connections won't be allowed to write.
+    """
+    pool = engine.pool
+    if any(isinstance(l, TuningListener) for l in pool.listeners):
+        return
+    listener = TuningListener(engine.name, read_only)
+    pool.add_listener(listener)
+    # Connections that are already open have missed their chance
+    conn = engine.raw_connection()
+    try:
+        listener.connect(conn, None)
+    finally:
+        conn.close()
+
+def settings(engine):
+    """
+    Return the current value of each of sqlite_pragmas on one of
+    engine's connections, as a dict.
+    """
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        result = {}
+        for name, value in sqlite_pragmas:
+            cursor.execute('PRAGMA %s' % name)
+            result[name] = cursor.fetchone()[0]
+        cursor.close()
+        return result
+    finally:
+        conn.close()
+
+class TuningListener(PoolListener):
+    """
+    Set PRAGMAs on each new SQLite connection, or ping connections to
+    other databases as they're checked out.
+    """
+
+    def __init__(self, name, read_only=False):
+        self.sqlite = name == 'sqlite'
+        self.read_only = read_only
+
+    def connect(self, dbapi_con, con_record):
+        if not self.sqlite:
+            return
+        cursor = dbapi_con.cursor()
+        for name, value in sqlite_pragmas:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+            cursor.fetchall()
+        if self.read_only:
+            cursor.execute('PRAGMA query_only = 1')
+        cursor.close()
+
+    def checkout(self, dbapi_con, con_record, con_proxy):
+        if self.sqlite:
+            return
+        cursor = dbapi_con.cursor()
+        try:
+            cursor.execute('SELECT 1')
+            cursor.fetchall()
+        except Exception:
+            # The pool will throw this connection away and try
+            # another
+            raise exc.DisconnectionError()
+        finally:
+            cursor.close()
@@ -17,10 +17,14 @@ class GzipBinary(types.TypeDecorator):
         super(GzipBinary, self).__init__(*args, **kwargs)
 
     def process_bind_param(self, value, engine):
+        if value is None:
+            return None
         return zlib.compress(value, self.compresslevel)
 
-    def convert_result_value(self, value, engine):
-        return zlib.decompress(value)
+    def process_result_value(self, value, engine):
+        if value is None:
+            return None
+        return zlib.decompress(str(value))
 
     def copy(self):
         return GzipBinary(self.compresslevel)
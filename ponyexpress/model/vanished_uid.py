@@ -0,0 +1,20 @@
+import sqlalchemy as sa
+
+from ponyexpress.model.base import Base
+
+class VanishedUID(Base):
+    """
+    A tombstone for a message that left a folder, so that a client
+    resynchronizing with QRESYNC can be told which of the UIDs it knows
+    about are gone. These rows are written by
+    ponyexpress.model.counters.
+    """
+    __tablename__ = 'vanished_uids'
+
+    # The messages_tags id the message had in the folder, which is
+    # unique across every folder
+    uid = sa.Column(sa.types.Integer, primary_key=True, autoincrement=False)
+    tag_id = sa.Column(sa.ForeignKey('tags.id', ondelete='CASCADE', onupdate='CASCADE'), nullable=False, index=True)
+    message_id = sa.Column(sa.types.Integer, nullable=False)
+    # The folder's modseq when the message left it
+    modseq = sa.Column(sa.types.Integer, nullable=False)
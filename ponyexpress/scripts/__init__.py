@@ -0,0 +1,3 @@
+"""
+Scripts for managing messages from the command line or procmail
+"""
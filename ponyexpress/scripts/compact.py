@@ -0,0 +1,63 @@
+"""
+Give the space freed by expunged messages back to the filesystem (see
+ponyexpress.model.expunge.compact)
+
+    python -m ponyexpress.scripts.compact -d sqlite:///mail.db
+
+This is safe to run from cron while the server is up. Run it once
+with --full to switch an existing SQLite database over to incremental
+auto-vacuum; that one run locks the database until it's done.
+
+With --blobs, it also removes files from the blob store's directory
+that no blob uses any more (see ponyexpress.model.blobs.sweep). With
+--segments, it rewrites mostly-empty segment files and removes unused
+ones (see ponyexpress.model.expunge.compact_segments).
+"""
+
+import optparse
+import sys
+
+from ponyexpress import model
+from ponyexpress.model import tuning
+from ponyexpress.model import expunge
+from ponyexpress.model.blobs import BlobStore
+from ponyexpress.model.segments import SegmentStore
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog -d DATABASE [options]')
+    parser.add_option('-d', '--database', help='SQLAlchemy database URL')
+    parser.add_option('-p', '--pages', type='int', default=256,
+                      help='pages to free per step')
+    parser.add_option('-w', '--pause', type='float', default=0.05,
+                      help='seconds to wait between steps')
+    parser.add_option('--full', action='store_true', default=False,
+                      help='VACUUM the whole database if it can\'t be '
+                      'done incrementally')
+    parser.add_option('-b', '--blobs', metavar='DIRECTORY',
+                      help='remove unused files from the blob store '
+                      'in DIRECTORY')
+    parser.add_option('-s', '--segments', metavar='DIRECTORY',
+                      help='reclaim the space of deleted messages in '
+                      'the segment store in DIRECTORY')
+    options, args = parser.parse_args(argv)
+    if not options.database:
+        parser.error('a database is required')
+
+    engine = tuning.create_engine(options.database)
+    blobs = options.blobs and BlobStore(options.blobs) or None
+    segments = options.segments and SegmentStore(options.segments) or None
+    model.init_model(engine, blobs=blobs, segments=segments)
+
+    freed = expunge.compact(options.pages, options.pause, options.full)
+    if freed is None:
+        sys.stderr.write('nothing to do; use --full to VACUUM\n')
+    else:
+        sys.stderr.write('%d pages freed\n' % freed)
+    if blobs is not None:
+        sys.stderr.write('%d blob files removed\n' % blobs.sweep())
+    if segments is not None:
+        sys.stderr.write('%d segment files removed\n' %
+                         expunge.compact_segments())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Deliver a message from stdin through the local delivery service (see
+ponyexpress.delivery), e.g. from a procmail recipe:
+
+    :0
+    | python -m ponyexpress.scripts.deliver -s ~/.ponyexpress/deliver.sock
+
+This is run once per message, so it deliberately imports nothing
+beyond the standard library.
+
+Exits with EX_TEMPFAIL if the message couldn't be delivered, so that
+procmail will try again later.
+"""
+
+import optparse
+import socket
+import sys
+import urllib
+
+EX_TEMPFAIL = 75
+
+def deliver(sock, data, tags=()):
+    """
+    Send a message over a connected socket, and return the service's
+    answer.
+    """
+    request = ' '.join(['DELIVER', str(len(data))] +
+                       [urllib.quote(t) for t in tags])
+    sock.sendall(request + '\r\n' + data)
+    f = sock.makefile('rb')
+    try:
+        return f.readline().rstrip('\r\n')
+    finally:
+        f.close()
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog -s SOCKET [-t TAG...]')
+    parser.add_option('-s', '--socket', help='Unix socket of the service')
+    parser.add_option('-t', '--tag', action='append', dest='tags',
+                      default=[], help='tag the message with TAG (may be '
+                      'repeated; the default is up to the service)')
+    options, args = parser.parse_args(argv)
+    if not options.socket:
+        parser.error('a socket is required')
+
+    data = sys.stdin.read()
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(options.socket)
+        try:
+            answer = deliver(sock, data, options.tags)
+        finally:
+            sock.close()
+    except socket.error, e:
+        sys.stderr.write('deliver: %s\n' % e)
+        sys.exit(EX_TEMPFAIL)
+    if not answer.startswith('OK'):
+        sys.stderr.write('deliver: %s\n' % answer)
+        sys.exit(EX_TEMPFAIL)
+
+if __name__ == '__main__':
+    main()
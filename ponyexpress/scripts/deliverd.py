@@ -0,0 +1,53 @@
+"""
+Run the local delivery service (see ponyexpress.delivery)
+
+    python -m ponyexpress.scripts.deliverd -d sqlite:///mail.db \\
+        -s ~/.ponyexpress/deliver.sock \\
+        -r 'List-Id:ponyexpress-dev:Lists/dev'
+"""
+
+import optparse
+import sys
+
+from twisted.internet import reactor
+from twisted.python import log
+
+from ponyexpress import model
+from ponyexpress.model import tuning, migrations
+from ponyexpress import delivery
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog -d DATABASE -s SOCKET [options]')
+    parser.add_option('-d', '--database', help='SQLAlchemy database URL')
+    parser.add_option('-s', '--socket', help='Unix socket to listen on')
+    parser.add_option('-t', '--tag', action='append', dest='tags',
+                      help='tag messages that arrive without tags with TAG '
+                      '(may be repeated; the default is INBOX)')
+    parser.add_option('-r', '--rule', action='append', dest='rules',
+                      default=[],
+                      help='FIELD:PATTERN:TAG; tag messages whose FIELD '
+                      'header matches PATTERN with TAG (may be repeated)')
+    parser.add_option('-b', '--max-batch', type='int', default=100,
+                      help='most messages to commit at once')
+    parser.add_option('-w', '--max-delay', type='float', default=0.05,
+                      help='longest to hold a message before committing it, '
+                      'in seconds')
+    options, args = parser.parse_args(argv)
+    if not options.database or not options.socket:
+        parser.error('a database and a socket are required')
+
+    engine = tuning.create_engine(options.database)
+    model.init_model(engine)
+    model.Base.metadata.create_all(bind=engine)
+    migrations.upgrade()
+
+    committer = delivery.GroupCommitter(
+        options.max_batch, options.max_delay,
+        [delivery.Rule.parse(r) for r in options.rules],
+        [t.decode('utf-8') for t in options.tags or ['INBOX']])
+    log.startLogging(sys.stderr)
+    reactor.listenUNIX(options.socket, delivery.DeliveryFactory(committer))
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
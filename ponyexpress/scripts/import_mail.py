@@ -0,0 +1,52 @@
+"""
+Import mbox files and Maildirs into a PonyExpress database
+
+    python -m ponyexpress.scripts.import_mail -d sqlite:///mail.db \\
+        -t INBOX ~/mail/archive.mbox ~/Maildir
+
+Running the same import again picks up where it left off.
+"""
+
+import optparse
+import sys
+
+from ponyexpress import model
+from ponyexpress.model import tuning, migrations
+from ponyexpress.model import ingest
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage='%prog -d DATABASE [options] MBOX|MAILDIR...')
+    parser.add_option('-d', '--database', help='SQLAlchemy database URL')
+    parser.add_option('-t', '--tag', action='append', dest='tags',
+                      help='tag every message with TAG (may be repeated; '
+                      'the default is INBOX)')
+    parser.add_option('-j', '--processes', type='int',
+                      help='number of processes to parse messages with '
+                      '(the default is one per CPU)')
+    parser.add_option('-b', '--batch-size', type='int',
+                      help='number of messages per transaction')
+    options, args = parser.parse_args(argv)
+    if not options.database or not args:
+        parser.error('a database and at least one mailbox are required')
+
+    engine = tuning.create_engine(options.database)
+    model.init_model(engine)
+    model.Base.metadata.create_all(bind=engine)
+    migrations.upgrade()
+
+    def progress(count, elapsed):
+        sys.stderr.write('\r%d messages, %.0f messages/s' %
+                         (count, count / (elapsed or 1)))
+
+    tags = [t.decode('utf-8') for t in options.tags or ['INBOX']]
+    for path in args:
+        importer = ingest.Importer(tags, options.processes,
+                                   options.batch_size, progress)
+        importer.run(ingest.source(path))
+        sys.stderr.write('\r%s: %d messages in %.1fs, %.0f messages/s\n' %
+                         (path, importer.count, importer.elapsed,
+                          importer.rate))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""
+Bring an existing database's schema up to date (see
+ponyexpress.model.migrations)
+
+    python -m ponyexpress.scripts.migrate -d sqlite:///mail.db
+
+deliverd and import_mail do this themselves when they start, but the
+first migrations can take a while on a big database, so it may be
+better to run them ahead of time.
+"""
+
+import optparse
+import sys
+
+from ponyexpress import model
+from ponyexpress.model import tuning, migrations
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog -d DATABASE [options]')
+    parser.add_option('-d', '--database', help='SQLAlchemy database URL')
+    parser.add_option('-t', '--target', type='int',
+                      help='stop after migration TARGET')
+    options, args = parser.parse_args(argv)
+    if not options.database:
+        parser.error('a database is required')
+
+    engine = tuning.create_engine(options.database)
+    model.init_model(engine)
+    model.Base.metadata.create_all(bind=engine)
+
+    before = migrations.version()
+    applied = migrations.upgrade(options.target)
+    if applied:
+        sys.stderr.write('migrated from version %d to %d\n' %
+                         (before, applied[-1]))
+    else:
+        sys.stderr.write('already at version %d\n' % before)
+
+if __name__ == '__main__':
+    main()
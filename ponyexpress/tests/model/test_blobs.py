@@ -0,0 +1,137 @@
+"""
+Tests for the deduplicated body store
+"""
+
+import os
+import shutil
+import tempfile
+
+from ponyexpress.model import *
+from ponyexpress.model import blobs
+from ponyexpress.tests.model import ModelTest
+from nose import tools as n
+
+class TestBlobs(ModelTest):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        meta.blobs = blobs.BlobStore(self.directory, threshold=100)
+
+    def tearDown(self):
+        # Drop the messages first, so that their blobs get released
+        for m in meta.Session.query(Message):
+            meta.Session.delete(m)
+        meta.Session.commit()
+        meta.blobs = None
+        shutil.rmtree(self.directory)
+        ModelTest.tearDown(self)
+
+    def add(self, body):
+        m = Message(body=body, length=len(body))
+        meta.Session.add(m)
+        meta.Session.commit()
+        return m
+
+    def test_dedup(self):
+        m1 = self.add(u'hello')
+        m2 = self.add(u'hello')
+        m3 = self.add(u'goodbye')
+
+        n.eq_(m1.blob_id, m2.blob_id)
+        n.ok_(m1.blob_id != m3.blob_id)
+        n.eq_(m1._body, None)
+        n.eq_(m1.body, u'hello')
+        n.eq_(m1.getBodyFile().read(), 'hello')
+        n.eq_(meta.Session.query(Blob).count(), 2)
+
+        report = blobs.report()
+        n.eq_(report['messages'], 3)
+        n.eq_(report['blobs'], 2)
+        n.eq_(report['logical'], 17)
+        n.eq_(report['saved'], 5)
+
+        blob_id = m1.blob_id
+        meta.Session.delete(m1)
+        meta.Session.commit()
+        n.eq_(meta.Session.query(Blob).get(blob_id).refcount, 1)
+
+        meta.Session.delete(m2)
+        meta.Session.commit()
+        n.eq_(meta.Session.query(Blob).get(blob_id), None)
+
+    def test_change(self):
+        m = self.add(u'hello')
+        old = m.blob_id
+        m.body = u'changed'
+        n.eq_(m.body, u'changed')
+        meta.Session.commit()
+
+        n.eq_(m.body, u'changed')
+        n.eq_(meta.Session.query(Blob).get(old), None)
+
+    def test_files(self):
+        body = u'x' * 1000
+        m1 = self.add(body)
+        m2 = self.add(body)
+        blob = m1.blob
+        n.ok_(blob.path is not None)
+        filename = meta.blobs.filename(blob.path)
+        n.ok_(os.path.exists(filename))
+        n.eq_(m2.body, body)
+        n.eq_(m2.getBodyFile().read(1000), 'x' * 1000)
+        n.eq_(blobs.report()['on_disk'], 1000)
+
+        meta.Session.delete(m1)
+        meta.Session.commit()
+        n.ok_(os.path.exists(filename))
+
+        # The file only goes away once the deletion is committed
+        meta.Session.delete(m2)
+        meta.Session.flush()
+        n.ok_(os.path.exists(filename))
+        meta.Session.commit()
+        n.ok_(not os.path.exists(filename))
+
+    def test_sweep(self):
+        body = u'y' * 1000
+        self.add(body)
+        m = Message(body=u'z' * 1000, length=1000)
+        meta.Session.add(m)
+        meta.Session.flush()
+        meta.Session.rollback()
+
+        # The file's too new to be removed yet
+        n.eq_(meta.blobs.sweep(), 0)
+        n.eq_(meta.blobs.sweep(min_age=0), 1)
+        n.eq_(meta.Session.query(Message).one().body, body)
+
+    def test_reused_file(self):
+        body = u'w' * 1000
+        m = self.add(body)
+        filename = meta.blobs.filename(m.blob.path)
+        meta.Session.delete(m)
+        meta.Session.flush()
+
+        # Another transaction stores the same body before this one
+        # commits, and needs the file to stay
+        later = os.path.getmtime(filename) + 10
+        os.utime(filename, (later, later))
+        meta.Session.commit()
+        n.ok_(os.path.exists(filename))
+
+    def test_concurrent_insert(self):
+        m = self.add(u'hello')
+        # As if another transaction had inserted the same body first
+        n.eq_(meta.blobs._insert({'hash': m.blob.hash, 'refcount': 1,
+                                  'size': 5, 'body': None,
+                                  'compressed_body': None, 'path': None}),
+              None)
+        m2 = self.add(u'hello')
+        n.eq_(m2.blob_id, m.blob_id)
+        n.eq_(m2.blob.refcount, 2)
+
+    def test_search(self):
+        t = Tag(name=u'foo')
+        m = self.add(u'a deduplicated body')
+        m.tags.add(t)
+        meta.Session.commit()
+        n.eq_(t.search(['BODY', 'duplicated'], False), [1])
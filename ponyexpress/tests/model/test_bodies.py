@@ -0,0 +1,100 @@
+"""
+Tests for compressed message bodies
+"""
+
+from ponyexpress.model import *
+from ponyexpress.model import bodies
+from ponyexpress.tests.model import ModelTest
+from nose import tools as n
+
+BODY = u'\n'.join(u'Line %d of a message with some unicode: \u2603' % i
+                  for i in xrange(2000))
+
+class TestBodies(ModelTest):
+    def tearDown(self):
+        meta.compression = None
+        ModelTest.tearDown(self)
+
+    def roundtrip(self, codec, body=BODY):
+        meta.compression = codec
+        m = Message(body=body, length=len(body))
+        meta.Session.add(m)
+        meta.Session.commit()
+        m_id = m.id
+
+        meta.Session.expunge_all()
+        m = meta.Session.query(Message).get(m_id)
+        n.eq_(m._body, None)
+        n.eq_(m.body, body)
+        return m
+
+    def test_plain(self):
+        m = Message(body=BODY, length=len(BODY))
+        n.eq_(m._compressed_body, None)
+        n.eq_(m.body, BODY)
+        n.eq_(m.getBodyFile().read(), BODY.encode('utf-8'))
+
+    def test_zlib(self):
+        fast = len(str(self.roundtrip(bodies.Zlib(1))._compressed_body))
+        small = len(str(self.roundtrip(bodies.Zlib(9))._compressed_body))
+        n.ok_(small <= fast < len(BODY))
+
+    def test_dictionary(self):
+        samples = [u'From: list@example.com\nTo: everyone\n\n%d\n'
+                   u'-- \nThis message was sent to a mailing list\n' % i
+                   for i in xrange(10)]
+        dictionary_id = bodies.create_dictionary(samples)
+        meta.Session.commit()
+
+        body = samples[3]
+        primed = self.roundtrip(bodies.ZlibDictionary(dictionary_id), body)
+        primed = len(str(primed._compressed_body))
+        unprimed = len(str(self.roundtrip(bodies.Zlib(), body)._compressed_body))
+        n.ok_(primed < unprimed)
+
+        # Large bodies don't use the dictionary
+        m = self.roundtrip(bodies.ZlibDictionary(dictionary_id, threshold=100))
+        n.eq_(str(m._compressed_body)[0], bodies.ZLIB)
+
+    def test_getBodyFile(self):
+        m = self.roundtrip(bodies.Zlib())
+        data = BODY.encode('utf-8')
+
+        f = m.getBodyFile()
+        f.read_size = 100
+        n.eq_(f.read(10), data[:10])
+        n.eq_(f.readline(), data[10:data.index('\n') + 1])
+        n.eq_(f.tell(), data.index('\n') + 1)
+        f.seek(5000)
+        n.eq_(f.read(100), data[5000:5100])
+        f.seek(20)
+        n.eq_(f.read(), data[20:])
+        n.eq_(f.read(), '')
+
+    def test_recompress(self):
+        m = Message(body=BODY, length=len(BODY))
+        meta.Session.add(m)
+        meta.Session.commit()
+        m_id = m.id
+
+        n.eq_(bodies.recompress(bodies.Zlib(), batch_size=1), 1)
+        meta.Session.expunge_all()
+        m = meta.Session.query(Message).get(m_id)
+        n.eq_(m._body, None)
+        n.eq_(m.body, BODY)
+
+        bodies.recompress(None)
+        meta.Session.expunge_all()
+        m = meta.Session.query(Message).get(m_id)
+        n.eq_(m._compressed_body, None)
+        n.eq_(m.body, BODY)
+
+    def test_search(self):
+        t = Tag(name=u'foo')
+        meta.Session.add(t)
+        meta.Session.commit()
+        m = self.roundtrip(bodies.Zlib())
+        m.tags.add(t)
+        meta.Session.commit()
+
+        n.eq_(t.search(['BODY', 'line 1999'], False), [1])
@@ -0,0 +1,71 @@
+"""
+Tests for the PonyExpress Mailbox query compiler
+"""
+
+from ponyexpress.model import *
+from ponyexpress.model import compiler, store
+from ponyexpress.tests.model import ModelTest
+from nose import tools as n
+
+class TestCompiler(ModelTest):
+    def setUp(self):
+        self.tags = dict((name, Tag(name=name))
+                         for name in [u'foo', u'bar', u'baz'])
+        meta.Session.add_all(self.tags.values())
+
+        # Every combination of the three tags
+        self.messages = []
+        for i in xrange(8):
+            tags = [t for j, t in enumerate(sorted(self.tags))
+                    if i & (1 << j)]
+            self.messages.append(
+                Message(body=u'', length=0,
+                        tags=[self.tags[t] for t in tags]))
+        meta.Session.add_all(self.messages)
+        meta.Session.commit()
+
+        self.ids = dict((name, t.id) for name, t in self.tags.items())
+
+    def check(self, query):
+        expected = sorted(m.id for m in self.messages
+                          if Mailbox.matchQuery(query,
+                                                set(t.name for t in m.tags),
+                                                set(t.id for t in m.tags)))
+        n.eq_(Mailbox.parseQuery(query), expected)
+
+    def test_parseQuery(self):
+        for query in ['*', u'foo', u'missing', self.ids[u'bar'],
+                      (u'foo', '&', u'bar'),
+                      (u'foo', '|', u'bar', '-', u'baz'),
+                      ('*', '-', u'foo'),
+                      ('*', '-', (u'foo', '|', u'bar')),
+                      (u'foo', '-', (u'bar', '&', u'baz')),
+                      (u'missing', '|', u'baz'),
+                      (u'foo', '&', u'missing')]:
+            self.check(query)
+
+    def test_normalize(self):
+        foo, bar, baz = self.ids[u'foo'], self.ids[u'bar'], self.ids[u'baz']
+
+        n.eq_(compiler.normalize(u'foo'), ('tag', foo))
+        n.eq_(compiler.normalize(u'missing'), compiler.NONE)
+        n.eq_(compiler.normalize(((u'foo', '&', u'bar'), '&', u'baz')),
+              ('and', [('tag', foo), ('tag', bar), ('tag', baz)]))
+        n.eq_(compiler.normalize(('*', '-', u'foo')), ('not', ('tag', foo)))
+        n.eq_(compiler.normalize((u'foo', '|', '*')), compiler.ALL)
+        n.eq_(compiler.normalize((u'foo', '&', u'missing')), compiler.NONE)
+
+    def test_plan(self):
+        # Make baz the rarest tag
+        store.remove_tags([m.id for m in self.messages][:4],
+                          [self.ids[u'baz']])
+        meta.Session.commit()
+
+        node, counts, total = compiler.plan((u'foo', '&', u'bar', '&', u'baz'))
+        n.eq_(node[1][0], ('tag', self.ids[u'baz']))
+        n.eq_(total, 8)
+
+    def test_explain(self):
+        explanation = compiler.explain((u'foo', '-', u'bar'))
+        n.ok_('GROUP BY' in explanation)
+        n.ok_('HAVING' in explanation)
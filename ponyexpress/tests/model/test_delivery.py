@@ -0,0 +1,106 @@
+"""
+Tests for the local delivery service
+"""
+
+import json
+import socket
+
+from twisted.internet import task
+from twisted.test import proto_helpers
+
+from ponyexpress.model import *
+from ponyexpress import delivery
+from ponyexpress.scripts import deliver
+from ponyexpress.tests.model import ModelTest
+from nose import tools as n
+
+def message(subject, extra=''):
+    return 'Subject: %s\r\n%s\r\nHello\r\n' % (subject, extra)
+
+class DeliveryTest(ModelTest):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.committer = delivery.GroupCommitter(
+            max_batch=3, max_delay=0.05, clock=self.clock,
+            rules=[delivery.Rule.parse('List-Id:dev\\.example:Lists/dev')])
+
+    def deliver(self, data, tags=()):
+        results = []
+        self.committer.deliver(data, tags).addBoth(results.append)
+        return results
+
+    def tag(self, name):
+        return meta.Session.query(Tag).filter_by(name=name).one()
+
+class TestGroupCommitter(DeliveryTest):
+    def test_delay(self):
+        first = self.deliver(message('First'))
+        self.clock.advance(0.02)
+        second = self.deliver(message('Second'))
+        n.eq_((first, second), ([], []))
+        n.eq_(meta.Session.query(Message).count(), 0)
+
+        self.clock.advance(0.03)
+        n.eq_(len(first + second), 2)
+        n.eq_(self.tag(u'INBOX').getMessageCount(), 2)
+
+        metrics = self.committer.metrics.snapshot()
+        n.eq_(metrics['batches'], 1)
+        n.eq_(metrics['deliveries'], 2)
+        n.eq_(metrics['max_latency'], 0.05)
+
+    def test_size(self):
+        results = [self.deliver(message(str(i))) for i in xrange(4)]
+        # The first three fill a batch, and go straight away
+        n.eq_([len(r) for r in results], [1, 1, 1, 0])
+        n.eq_(self.clock.getDelayedCalls()[0].getTime(), 0.05)
+        self.clock.advance(0.05)
+        n.eq_(self.committer.metrics.snapshot()['max_batch'], 3)
+        n.eq_(self.committer.metrics.snapshot()['batches'], 2)
+        n.eq_(self.clock.getDelayedCalls(), [])
+
+    def test_tags(self):
+        plain = self.deliver(message('Plain'), [u'Archive'])
+        listed = self.deliver(message('Listed', 'List-Id: <dev.example>\r\n'))
+        self.committer.flush()
+
+        plain = meta.Session.query(Message).get(plain[0])
+        listed = meta.Session.query(Message).get(listed[0])
+        n.eq_(set(t.name for t in plain.tags), set([u'Archive']))
+        n.eq_(set(t.name for t in listed.tags), set([u'INBOX', u'Lists/dev']))
+
+class TestProtocol(DeliveryTest):
+    def setUp(self):
+        DeliveryTest.setUp(self)
+        self.protocol = delivery.DeliveryFactory(self.committer).buildProtocol(
+            None)
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def test_deliver(self):
+        data = message('Over the wire')
+        self.protocol.dataReceived('DELIVER %d Lists%%2Fother\r\n' % len(data))
+        self.protocol.dataReceived(data[:5])
+        self.protocol.dataReceived(data[5:] + 'STATS\r\n')
+        self.clock.advance(0.05)
+
+        lines = self.transport.value().splitlines()
+        n.eq_(json.loads(lines[0][len('STATS '):])['deliveries'], 0)
+        n.ok_(lines[1].startswith('OK '))
+        m = meta.Session.query(Message).get(int(lines[1][3:]))
+        n.eq_([t.name for t in m.tags], [u'Lists/other'])
+        n.eq_(m.body, 'Hello\r\n')
+
+    def test_unknown(self):
+        self.protocol.dataReceived('HELLO\r\n')
+        n.eq_(self.transport.value(), 'NO unknown command\r\n')
+
+    def test_client(self):
+        # Hand the client one end of a socket pair, and pretend to be
+        # the service on the other
+        client, server = socket.socketpair()
+        server.sendall('OK 1\r\n')
+        n.eq_(deliver.deliver(client, 'Subject: x\r\n\r\n', [u'A b']), 'OK 1')
+        n.eq_(server.recv(4096), 'DELIVER 14 A%20b\r\nSubject: x\r\n\r\n')
+        client.close()
+        server.close()
@@ -0,0 +1,69 @@
+"""
+Tests for precomputed envelopes
+"""
+
+from datetime import datetime
+
+from ponyexpress.model import *
+from ponyexpress.model import envelopes
+from ponyexpress.tests.model import ModelTest
+from ponyexpress.util.mpart import MPart
+from twisted.mail import imap4
+from nose import tools as n
+
+RAW = '\r\n'.join([
+        'Date: Sat, 10 Jan 2009 12:00:00 -0500',
+        'From: Alice Smith <alice@example.com>',
+        'To: bob@example.com, "Carol" <carol@example.com>',
+        'Subject: Lunch?',
+        'Message-ID: <1234@example.com>',
+        '',
+        'Sandwiches?',
+        ''])
+
+class TestEnvelopes(ModelTest):
+    def setUp(self):
+        self.folder = Tag(name=u'foo')
+        meta.Session.add(self.folder)
+        self.m = Message.fromString(RAW, created_at=datetime(2009, 1, 10),
+                                    tags=[self.folder])
+        meta.Session.add(self.m)
+        meta.Session.commit()
+
+    def test_format(self):
+        e = meta.Session.query(Envelope).get(self.m.id)
+        n.eq_(e.subject, u'Lunch?')
+        n.eq_(e.reply_to, e.from_)
+        n.eq_(e.cc, None)
+        # Exactly what Twisted would have sent, working from the
+        # parsed message
+        items = [(h.field, h.value) for h in self.m.headers]
+        n.eq_(envelopes.format(envelopes.fields(items)),
+              imap4.collapseNestedLists([imap4.getEnvelope(MPart(RAW))]))
+
+    def test_summaries(self):
+        summary, = self.folder.fetchSummaries(imap4.MessageSet(1), False)
+        n.eq_(summary.message_id, self.m.id)
+        n.eq_(summary.size, len(RAW))
+        n.eq_(summary.internal_date, datetime(2009, 1, 10))
+        n.eq_(summary.envelope,
+              imap4.collapseNestedLists([imap4.getEnvelope(MPart(RAW))]))
+        n.eq_(list(self.folder.fetchSummaries(imap4.MessageSet(2), False)),
+              [])
+
+    def test_update(self):
+        self.m.headers.append(Header(field=u'Cc', value=u'dave@example.com'))
+        meta.Session.commit()
+        e = meta.Session.query(Envelope).get(self.m.id)
+        n.eq_(e.cc, u'((NIL NIL "dave" "example.com"))')
+
+        message_id = self.m.id
+        meta.Session.delete(self.m)
+        meta.Session.commit()
+        n.eq_(meta.Session.query(Envelope).get(message_id), None)
+
+    def test_rebuild(self):
+        meta.Session.execute(Envelope.__table__.delete())
+        n.eq_(envelopes.summaries([self.m.id])[self.m.id].envelope, None)
+        envelopes.rebuild()
+        n.ok_(envelopes.summaries([self.m.id])[self.m.id].envelope)
@@ -0,0 +1,123 @@
+"""
+Tests for expunging and garbage collection
+"""
+
+import os
+import shutil
+import tempfile
+
+import sqlalchemy
+
+from ponyexpress import model
+from ponyexpress.model import *
+from ponyexpress.model import counters, expunge
+from ponyexpress.tests.model import ModelTest
+from twisted.mail import imap4
+from twisted.mail.imap4 import MessageSet
+from nose import tools as n
+
+class TestExpunge(ModelTest):
+    def setUp(self):
+        self.inbox = Tag(name=u'INBOX')
+        self.archive = Tag(name=u'Archive')
+        self.messages = [Message(body=u'm%d' % i, length=0,
+                                 tags=[self.inbox])
+                         for i in xrange(5)]
+        self.messages[1].tags.add(self.archive)
+        meta.Session.add_all([self.inbox, self.archive] + self.messages)
+        meta.Session.commit()
+        self.archived = self.messages[1].id
+        # Message ids in sequence order
+        self.ids = [r[0] for r in meta.Session.query(MessageTag.message_id).\
+                        filter_by(tag_id=self.inbox.id).order_by(MessageTag.id)]
+
+    def test_tag(self):
+        inbox = self.inbox
+        inbox.store(MessageSet(2), [r'\Deleted'], 1, False)
+        inbox.store(MessageSet(4, 5), [r'\Deleted'], 1, False)
+        n.eq_(inbox.expunge(), [5, 4, 2])
+        n.eq_(inbox.getMessageCount(), 2)
+        n.eq_(inbox.requestStatus(['MESSAGES'])['MESSAGES'], 2)
+        n.eq_(counters.get(inbox.id)['messages'], 2)
+
+        # The message that's still in Archive survives; the others
+        # are gone for good
+        expunged = set([self.ids[1], self.ids[3], self.ids[4]])
+        remaining = set(r[0] for r in meta.Session.query(Message.id))
+        n.eq_(remaining, set(self.ids) - expunged | set([self.archived]))
+        n.eq_(meta.Session.query(Envelope).filter(
+                Envelope.message_id.in_(expunged - remaining)).count(), 0)
+        n.eq_(len(inbox.vanishedSince(0)), 3)
+
+        n.eq_(inbox.expunge(), [])
+
+    def test_tag_removed(self):
+        # Taking a message out of the folder with STORE doesn't
+        # renumber the rest until the next EXPUNGE
+        inbox = self.inbox
+        uids = [inbox.getUID(i) for i in xrange(1, 6)]
+        inbox.store(MessageSet(2), [u'INBOX'], -1, False)
+        inbox.store(MessageSet(4), [r'\Deleted'], 1, False)
+        n.eq_(inbox.getMessageCount(), 5)
+        n.eq_(inbox.getUID(3), uids[2])
+        n.eq_(inbox.expunge(), [4, 2])
+        n.eq_([inbox.getUID(i) for i in xrange(1, 4)],
+              [uids[0], uids[2], uids[4]])
+
+    def test_mailbox_removed(self):
+        mb = Mailbox(path=u'inbox', query=u'INBOX')
+        meta.Session.add(mb)
+        meta.Session.commit()
+        meta.Session.expunge_all()
+        mb = meta.Session.query(Mailbox).one()
+
+        mb.store(MessageSet(2), [u'INBOX'], -1, False)
+        n.eq_(mb.getMessageCount(), 5)
+        n.eq_(mb.getUID(3), self.ids[2])
+        n.eq_(mb.expunge(), [2])
+        n.eq_(mb.messages, self.ids[:1] + self.ids[2:])
+
+    def test_mailbox(self):
+        mb = Mailbox(path=u'inbox', query=u'INBOX')
+        meta.Session.add(mb)
+        meta.Session.commit()
+        meta.Session.expunge_all()
+        mb = meta.Session.query(Mailbox).one()
+
+        mb.store(MessageSet(1, 2), [r'\Deleted'], 1, False)
+        n.eq_(mb.expunge(), [2, 1])
+        n.eq_(mb.messages, self.ids[2:])
+
+        everything = Mailbox(path=u'all', query='*')
+        n.assert_raises(imap4.ReadOnlyMailbox, everything.expunge)
+
+class TestCompact(object):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = meta.engine
+        engine = sqlalchemy.create_engine(
+            'sqlite:///' + os.path.join(self.directory, 'mail.db'))
+        model.init_model(engine)
+        model.Base.metadata.create_all(bind=engine)
+
+    def tearDown(self):
+        meta.Session.remove()
+        model.init_model(self.engine)
+        shutil.rmtree(self.directory)
+
+    def test_compact(self):
+        n.eq_(expunge.compact(), None)
+        n.eq_(expunge.compact(full=True), 0)
+
+        inbox = Tag(name=u'INBOX')
+        meta.Session.add_all([inbox] +
+                             [Message(body=u'x' * 4096, length=4096,
+                                      tags=[inbox])
+                              for i in xrange(50)])
+        meta.Session.commit()
+        inbox.store(MessageSet(1, None), [r'\Deleted'], 1, False)
+        n.eq_(len(inbox.expunge()), 50)
+        meta.Session.close()
+
+        n.ok_(expunge.compact(pages=10) > 0)
+        n.eq_(expunge.compact(), 0)
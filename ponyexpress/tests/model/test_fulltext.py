@@ -0,0 +1,132 @@
+"""
+Tests for the full-text index
+"""
+
+import shutil
+import tempfile
+
+from ponyexpress.model import *
+from ponyexpress.model import fulltext, bodies, blobs, segments
+from ponyexpress.tests.model import ModelTest
+from twisted.mail import imap4
+from nose import tools as n
+
+class FullTextTest(ModelTest):
+    def setUp(self):
+        self.saved = meta.fulltext
+        meta.fulltext = self.makeIndex()
+
+        self.folder = Tag(name=u'foo')
+        meta.Session.add(self.folder)
+        specs = [(u'The quick brown fox', u'Animals'),
+                 (u'jumps over the lazy dog', u'More animals'),
+                 (u'Nothing to see here', u'Quick question')]
+        for body, subject in specs:
+            m = Message(body=body, length=0, tags=[self.folder])
+            m.headers.append(Header(field=u'Subject', value=subject))
+            meta.Session.add(m)
+            meta.Session.commit()
+
+    def tearDown(self):
+        meta.fulltext = self.saved
+        ModelTest.tearDown(self)
+
+    def search(self, query):
+        return self.folder.search(imap4.parseNestedParens(query), False)
+
+    def test_body(self):
+        n.eq_(self.search('BODY quick'), [1])
+        n.eq_(self.search('BODY "LAZY DOG"'), [2])
+        n.eq_(self.search('BODY "dog lazy"'), [])
+        # Too short to use the index
+        n.eq_(self.search('BODY he'), [1, 2, 3])
+
+    def test_subject_and_text(self):
+        n.eq_(self.search('SUBJECT quick'), [3])
+        n.eq_(self.search('SUBJECT animals'), [1, 2])
+        n.eq_(self.search('TEXT quick'), [1, 3])
+        n.eq_(self.search('NOT TEXT animals'), [3])
+
+    def test_update(self):
+        m = self.folder.fetch(imap4.MessageSet(1), False).next()
+        m.body = u'A slow green turtle'
+        meta.Session.commit()
+        n.eq_(self.search('BODY quick'), [])
+        n.eq_(self.search('BODY turtle'), [1])
+
+        meta.Session.delete(m)
+        meta.Session.commit()
+        n.eq_(self.search('BODY turtle'), [])
+
+    def test_rebuild(self):
+        meta.fulltext.remove(r[0] for r in meta.Session.query(Message.id))
+        meta.fulltext.rebuild()
+        n.eq_(self.search('BODY quick'), [1])
+
+    def test_stored_bodies(self):
+        # None of these bodies are in messages.body, where LIKE can see
+        # them
+        directory = tempfile.mkdtemp()
+        try:
+            meta.compression = bodies.Zlib()
+            m = Message(body=u'A compressed pony', length=0,
+                        tags=[self.folder])
+            meta.Session.add(m)
+            meta.Session.commit()
+            meta.compression = None
+
+            meta.blobs = blobs.BlobStore(directory, threshold=0)
+            m = Message(body=u'A pony in a blob', length=0,
+                        tags=[self.folder])
+            meta.Session.add(m)
+            meta.Session.commit()
+
+            meta.segments = segments.SegmentStore(directory)
+            m = Message.fromString('Subject: Raw\r\n\r\nA pony in a segment',
+                                   tags=[self.folder])
+            meta.Session.add(m)
+            meta.Session.commit()
+
+            n.eq_(self.search('BODY pony'), [4, 5, 6])
+            n.eq_(self.search('BODY PONY'), [4, 5, 6])
+            n.eq_(self.search('BODY "pony in"'), [5, 6])
+            n.eq_(self.search('BODY "in a pony"'), [])
+            n.eq_(self.search('TEXT pony'), [4, 5, 6])
+            n.eq_(self.search('NOT BODY pony'), [1, 2, 3])
+            # Too short for any index
+            n.eq_(self.search('BODY "a "'), [4, 5, 6])
+            n.eq_(self.search('TEXT po'), [4, 5, 6])
+        finally:
+            # Drop the messages while their bodies can still be found
+            meta.Session.rollback()
+            for m in meta.Session.query(Message):
+                meta.Session.delete(m)
+            meta.Session.commit()
+            meta.compression = None
+            meta.blobs = None
+            if meta.segments is not None:
+                meta.segments.close()
+                meta.segments = None
+            shutil.rmtree(directory)
+
+class TestNoIndex(FullTextTest):
+    def makeIndex(self):
+        return None
+
+    def test_rebuild(self):
+        # There's nothing to rebuild
+        pass
+
+class TestFTS5Index(FullTextTest):
+    def makeIndex(self):
+        return fulltext.FTS5Index(meta.engine)
+
+class TestTrigramIndex(FullTextTest):
+    def makeIndex(self):
+        return fulltext.TrigramIndex()
+
+    def test_rows(self):
+        m1_id = meta.Session.query(Message.id).order_by(Message.id).first()[0]
+        rows = meta.Session.query(FullTextTrigram.trigram).\
+            filter_by(message_id=m1_id, field=fulltext.FIELDS.index('body'))
+        n.ok_(u'qui' in [r[0] for r in rows])
@@ -0,0 +1,71 @@
+"""
+Tests for set arguments
+"""
+
+import sqlalchemy as sa
+
+from ponyexpress.model import *
+from ponyexpress.model import idsets, store
+from ponyexpress.tests.model import ModelTest
+from nose import tools as n
+
+class TestIdSets(ModelTest):
+    def setUp(self):
+        # Every third id, so that no two are adjacent
+        self.ids = range(1, 3 * 2000, 3)
+        tag = Tag(name=u'foo')
+        meta.Session.add(tag)
+        meta.Session.flush()
+        meta.Session.execute(Message.__table__.insert(),
+                             [{'id': i, 'body': u'm', 'length': 0}
+                              for i in self.ids])
+        meta.Session.commit()
+
+    def tearDown(self):
+        # There are far too many messages to delete through the ORM
+        meta.Session.execute(MessageTag.__table__.delete())
+        meta.Session.execute(Message.__table__.delete())
+        meta.Session.commit()
+        ModelTest.tearDown(self)
+
+    def select(self, ids):
+        messages = Message.__table__
+        return sorted(r[0] for r in meta.Session.execute(
+                sa.select([messages.c.id], idsets.match(messages.c.id, ids))))
+
+    def test_ranges(self):
+        n.eq_(idsets.ranges([1, 2, 3, 5, 7, 8]), [(1, 3), (5, 5), (7, 8)])
+        n.eq_(idsets.ranges([]), [])
+
+    def test_small(self):
+        n.eq_(self.select([4, 10, 11]), [4, 10])
+        n.eq_(self.select([]), [])
+
+    def test_ranges_match(self):
+        clause = idsets.match(Message.__table__.c.id, range(1, 1001))
+        n.ok_('BETWEEN' in str(clause))
+        n.eq_(self.select(range(1, 1001)), self.ids[:334])
+
+    def test_temporary(self):
+        wanted = self.ids[::2] + [2, 5]
+        n.eq_(self.select(wanted), self.ids[::2])
+        n.ok_(meta.Session.execute(
+                sa.select([sa.func.count()], from_obj=[idsets.id_sets])).scalar())
+        meta.Session.commit()
+        n.eq_(meta.Session.execute(
+                sa.select([sa.func.count()], from_obj=[idsets.id_sets])).scalar(),
+              0)
+
+    def test_store(self):
+        # More messages than SQLite allows bind parameters in one
+        # statement, none of them adjacent
+        foo = meta.Session.query(Tag).one()
+        ids = range(10 ** 6, 10 ** 6 + 3 * 35000, 3)
+        meta.Session.execute(Message.__table__.insert(),
+                             [{'id': i, 'body': u'm', 'length': 0}
+                              for i in ids])
+        n.eq_(store.add_tags(ids, [foo.id]), len(ids))
+        store.set_deleted(ids, foo.id, True)
+        meta.Session.commit()
+        n.eq_(meta.Session.query(MessageTag).filter_by(deleted=True).count(),
+              len(ids))
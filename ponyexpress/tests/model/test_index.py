@@ -0,0 +1,212 @@
+"""
+Tests for the PonyExpress in-memory tag index
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+
+import sqlalchemy
+
+from ponyexpress import model
+from ponyexpress.model import *
+from ponyexpress.model import compiler, store
+from ponyexpress.model.index import TagIndex
+from ponyexpress.tests.model import ModelTest
+from nose import tools as n
+
+class TestTagIndex(ModelTest):
+    def setUp(self):
+        meta.index = TagIndex()
+
+    def tearDown(self):
+        meta.index = None
+        super(TestTagIndex, self).tearDown()
+
+    def test_load(self):
+        t1 = Tag(name=u'foo')
+        t2 = Tag(name=u'bar')
+
+        m1 = Message(body=u'm1', length=0, tags=[t1])
+        m2 = Message(body=u'm2', length=0, tags=[t1, t2])
+
+        meta.Session.add_all([t1, t2, m1, m2])
+        meta.Session.commit()
+
+        n.eq_(list(meta.index.get(t1.id)), sorted([m1.id, m2.id]))
+        n.eq_(list(meta.index.get(t2.id)), [m2.id])
+        n.eq_(list(meta.index.all()), sorted([m1.id, m2.id]))
+        n.ok_(meta.index.memory_usage() > 0)
+
+    def test_updates(self):
+        t1 = Tag(name=u'foo')
+        t2 = Tag(name=u'bar')
+
+        m1 = Message(body=u'm1', length=0, tags=[t1])
+        m2 = Message(body=u'm2', length=0, tags=[t2])
+
+        meta.Session.add_all([t1, t2, m1, m2])
+        meta.Session.commit()
+        meta.index.load()
+
+        # Through the ORM
+        m3 = Message(body=u'm3', length=0, tags=[t2])
+        meta.Session.add(m3)
+        t1.copy(m2)
+        n.eq_(list(meta.index.get(t1.id)), sorted([m1.id, m2.id]))
+        n.ok_(m3.id in meta.index.all())
+
+        # Through bulk statements
+        store.add_tags([m3.id], [t1.id])
+        store.remove_tags([m1.id], [t1.id])
+        meta.Session.commit()
+        n.eq_(list(meta.index.get(t1.id)), sorted([m2.id, m3.id]))
+
+        # Changes that are rolled back shouldn't show up
+        store.add_tags([m1.id], [t1.id])
+        meta.Session.rollback()
+        n.eq_(list(meta.index.get(t1.id)), sorted([m2.id, m3.id]))
+
+        # Deleted messages
+        meta.Session.delete(m2)
+        meta.Session.commit()
+        n.eq_(list(meta.index.get(t1.id)), [m3.id])
+        n.ok_(m2.id not in meta.index.all())
+
+    def test_snapshot(self):
+        t1 = Tag(name=u'foo')
+        m1 = Message(body=u'm1', length=0, tags=[t1])
+        meta.Session.add_all([t1, m1])
+        meta.Session.commit()
+
+        # A Bitmap that's been handed out doesn't change under its
+        # reader when changes are committed
+        before = meta.index.get(t1.id)
+        everything = meta.index.all()
+        m2 = Message(body=u'm2', length=0, tags=[t1])
+        meta.Session.add(m2)
+        meta.Session.commit()
+        store.remove_tags([m1.id], [t1.id])
+        meta.Session.commit()
+        n.eq_(list(before), [m1.id])
+        n.eq_(list(everything), [m1.id])
+        n.eq_(list(meta.index.get(t1.id)), [m2.id])
+
+    def test_uncommitted(self):
+        inbox = Tag(name=u'INBOX')
+        seen = Tag(name=ur'\Seen')
+        messages = [Message(body=u'm', length=0, tags=[inbox])
+                    for i in xrange(3)]
+        meta.Session.add_all([inbox, seen] + messages)
+        meta.Session.commit()
+
+        # The session sees its own changes, but they aren't kept
+        meta.index.invalidate()
+        store.add_tags([m.id for m in messages], [seen.id])
+        n.eq_(inbox.getUnseenCount(), 0)
+        meta.Session.rollback()
+        n.eq_(inbox.getUnseenCount(), 3)
+
+    def test_threads(self):
+        meta.index.load()
+        errors = []
+        def record(start):
+            # Each thread has its own session, whose changes are
+            # applied when it commits
+            try:
+                for i in xrange(start, start + 1000, 10):
+                    meta.index.add_tags((m, 1) for m in xrange(i, i + 10))
+                    meta.index.add_messages(xrange(i, i + 10))
+                    meta.index.commit(meta.Session())
+                    len(meta.index.get(1))
+            except Exception, e:
+                errors.append(e)
+            meta.Session.remove()
+        threads = [threading.Thread(target=record, args=(i * 1000 + 1,))
+                   for i in xrange(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        n.eq_(errors, [])
+        n.eq_(list(meta.index.get(1)), range(1, 4001))
+        n.eq_(list(meta.index.all()), range(1, 4001))
+
+    def test_evaluate(self):
+        t1 = Tag(name=u'foo')
+        t2 = Tag(name=u'bar')
+
+        m1 = Message(body=u'm1', length=0, tags=[t1])
+        m2 = Message(body=u'm2', length=0, tags=[t1, t2])
+        m3 = Message(body=u'm3', length=0, tags=[])
+
+        meta.Session.add_all([t1, t2, m1, m2, m3])
+        meta.Session.commit()
+
+        for query in [u'foo', (u'foo', '-', u'bar'), ('*', '-', u'foo'),
+                      (u'foo', '&', u'bar'), (u'bar', '|', ('*', '-', u'foo'))]:
+            node = compiler.normalize(query)
+            n.eq_(list(compiler.evaluate(node, meta.index)),
+                  sorted(r[0] for r in meta.Session.execute(
+                        compiler.compile_tree(node))))
+
+    def test_getUnseenCount(self):
+        seen = Tag(name=ur'\Seen')
+        t1 = Tag(name=u'foo')
+
+        m1 = Message(body=u"m1", length=0, tags=[seen, t1])
+        m2 = Message(body=u"m2", length=0, tags=[t1])
+
+        meta.Session.add_all([seen, t1, m1, m2])
+        meta.Session.commit()
+
+        n.eq_(t1.getUnseenCount(), 1)
+        store.add_tags([m2.id], [seen.id])
+        meta.Session.commit()
+        n.eq_(t1.getUnseenCount(), 0)
+
+class TestLoad(object):
+    """
+    Loading the index from a database that can have more than one
+    connection.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = meta.engine
+        engine = sqlalchemy.create_engine(
+            'sqlite:///' + os.path.join(self.directory, 'mail.db'))
+        model.init_model(engine, index=True)
+        model.Base.metadata.create_all(bind=engine)
+
+        self.inbox = Tag(name=u'INBOX')
+        self.seen = Tag(name=ur'\Seen')
+        self.messages = [Message(body=u'm', length=0, tags=[self.inbox])
+                         for i in xrange(3)]
+        meta.Session.add_all([self.inbox, self.seen] + self.messages)
+        meta.Session.commit()
+        self.ids = [m.id for m in self.messages]
+
+    def tearDown(self):
+        meta.Session.remove()
+        model.init_model(self.engine)
+        shutil.rmtree(self.directory)
+
+    def test_uncommitted(self):
+        # Only what's committed is loaded
+        meta.index.invalidate()
+        store.add_tags(self.ids, [self.seen.id])
+        n.eq_(list(meta.index.get(self.seen.id)), [])
+        meta.Session.rollback()
+        n.eq_(self.inbox.getUnseenCount(), 3)
+
+    def test_load_during(self):
+        # A load that happens while a change is being made (by another
+        # thread, say) doesn't lose it
+        meta.index.invalidate()
+        store.add_tags(self.ids, [self.seen.id])
+        meta.index.load()
+        n.eq_(list(meta.index.get(self.seen.id)), [])
+        meta.Session.commit()
+        n.eq_(list(meta.index.get(self.seen.id)), self.ids)
@@ -0,0 +1,165 @@
+"""
+Tests for bulk imports
+"""
+
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+import sqlalchemy
+
+from ponyexpress import model
+from ponyexpress.model import *
+from ponyexpress.model import ingest
+from ponyexpress.tests.model import ModelTest
+from twisted.mail import imap4
+from nose import tools as n
+
+def mbox_message(subject, body):
+    return ('From alice@example.com Sat Jan  3 01:05:34 2009\n'
+            'From: alice@example.com\n'
+            'Subject: %s\n'
+            '\n'
+            '%s\n'
+            '\n' % (subject, body))
+
+class IngestTest(ModelTest):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        ModelTest.tearDown(self)
+
+    def inbox(self):
+        return meta.Session.query(Tag).filter_by(name=u'INBOX').one()
+
+class TestMbox(IngestTest):
+    def setUp(self):
+        IngestTest.setUp(self)
+        self.path = os.path.join(self.directory, 'mbox')
+        self.write([('First', 'Hello'),
+                    ('Second', 'From the top\nof the mbox'),
+                    ('Third', 'Goodbye')])
+
+    def write(self, messages, mode='wb'):
+        f = open(self.path, mode)
+        for subject, body in messages:
+            f.write(mbox_message(subject, body))
+        f.close()
+
+    def test_import(self):
+        importer = ingest.Importer(processes=0, batch_size=2)
+        n.eq_(importer.run(ingest.Mbox(self.path)), 3)
+
+        inbox = self.inbox()
+        n.eq_(inbox.getMessageCount(), 3)
+        second = list(inbox.fetch(imap4.MessageSet(2), False))[0]
+        n.eq_(second.body, u'From the top\nof the mbox\n')
+        n.eq_(second.created_at, datetime(2009, 1, 3, 1, 5, 34))
+        n.eq_([(h.field, h.value) for h in second.headers],
+              [(u'From', u'alice@example.com'), (u'Subject', u'Second')])
+        n.eq_(len(second.mime_parts), 1)
+
+        n.eq_(inbox.requestStatus(['MESSAGES', 'UIDNEXT']),
+              {'MESSAGES': 3, 'UIDNEXT': inbox.getUID(3) + 1})
+        n.eq_(inbox.search(['SUBJECT', 'third'], False), [3])
+        n.eq_(inbox.search(['BODY', 'goodbye'], False), [3])
+        summary, = inbox.fetchSummaries(imap4.MessageSet(1), False)
+        n.ok_('"First"' in summary.envelope)
+
+    def test_resume(self):
+        ingest.Importer(processes=0).run(ingest.Mbox(self.path))
+        self.write([('Fourth', 'Late arrival')], 'ab')
+        n.eq_(ingest.Importer(processes=0).run(ingest.Mbox(self.path)), 1)
+
+        inbox = self.inbox()
+        n.eq_(inbox.getMessageCount(), 4)
+        n.eq_(inbox.search(['SUBJECT', 'fourth'], False), [4])
+        checkpoint = meta.Session.query(ImportCheckpoint).one()
+        n.eq_(checkpoint.count, 4)
+        n.eq_(int(checkpoint.position), os.path.getsize(self.path))
+
+    def test_flags(self):
+        # mbox files don't have flags, so there are no tags for them
+        ingest.Importer(processes=0).run(ingest.Mbox(self.path))
+        n.eq_([t.name for t in meta.Session.query(Tag)], [u'INBOX'])
+
+    def test_pool(self):
+        importer = ingest.Importer(processes=2, batch_size=2)
+        n.eq_(importer.run(ingest.Mbox(self.path)), 3)
+        n.eq_(self.inbox().search(['SUBJECT', 'second'], False), [2])
+        n.ok_(importer.rate > 0)
+
+class TestMaildir(IngestTest):
+    def deliver(self, name, data):
+        f = open(os.path.join(self.directory, name), 'wb')
+        f.write(data)
+        f.close()
+
+    def test_import(self):
+        for sub in ('cur', 'new', 'tmp'):
+            os.mkdir(os.path.join(self.directory, sub))
+        self.deliver('cur/1000.1.host:2,S', 'Subject: Read\n\nOld news\n')
+        self.deliver('new/1001.1.host', 'Subject: Unread\n\nNew news\n')
+        self.deliver('cur/1002.1.host:2,FT', 'Subject: Gone\n\nTrash\n')
+
+        source = ingest.source(self.directory)
+        n.ok_(isinstance(source, ingest.Maildir))
+        n.eq_(ingest.Importer(processes=0).run(source), 3)
+
+        inbox = self.inbox()
+        n.eq_(inbox.search(['SEEN'], False), [1])
+        n.eq_(inbox.search(['FLAGGED'], False), [3])
+        n.eq_(inbox.search(['DELETED'], False), [3])
+        n.eq_(inbox.search(['SUBJECT', 'unread'], False), [2])
+
+        # Nothing new, nothing imported
+        n.eq_(ingest.Importer(processes=0).run(source), 0)
+        self.deliver('new/1003.1.host', 'Subject: Later\n\nMore\n')
+        n.eq_(ingest.Importer(processes=0).run(source), 1)
+
+class TestLock(object):
+    """
+    Importing into a database that something else can write to.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = meta.engine
+        self.url = 'sqlite:///' + os.path.join(self.directory, 'mail.db')
+        engine = sqlalchemy.create_engine(self.url)
+        model.init_model(engine)
+        model.Base.metadata.create_all(bind=engine)
+
+    def tearDown(self):
+        meta.Session.remove()
+        model.init_model(self.engine)
+        shutil.rmtree(self.directory)
+
+    def test_delivery(self):
+        path = os.path.join(self.directory, 'mbox')
+        f = open(path, 'wb')
+        f.write(mbox_message('First', 'Hello'))
+        f.close()
+
+        # A delivery that doesn't wait for locks
+        other = sqlalchemy.create_engine(self.url,
+                                         connect_args={'timeout': 0})
+        delivered = []
+        class Importer(ingest.Importer):
+            def _ids(self, count):
+                try:
+                    other.execute(Message.__table__.insert(),
+                                  {'length': 0, 'deleted': False})
+                except sqlalchemy.exc.OperationalError:
+                    delivered.append(False)
+                else:
+                    delivered.append(True)
+                return ingest.Importer._ids(self, count)
+
+        n.eq_(Importer(processes=0).run(ingest.Mbox(path)), 1)
+        # The delivery had to wait until the batch was in
+        n.eq_(delivered, [False])
+        other.dispose()
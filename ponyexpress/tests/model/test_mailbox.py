@@ -0,0 +1,174 @@
+"""
+Tests for the PonyExpress Mailbox model
+"""
+
+from ponyexpress.model import *
+from ponyexpress.model import store
+from ponyexpress.tests.model import ModelTest
+from twisted.mail import imap4
+from twisted.mail.imap4 import MessageSet
+from nose import tools as n
+
+class TestMailbox(ModelTest):
+    def getMailbox(self, path):
+        # Mailbox contents are loaded when the object is loaded from
+        # the database, so make sure that actually happens
+        meta.Session.expunge_all()
+        return meta.Session.query(Mailbox).filter_by(path=path).one()
+
+    def test_fetch(self):
+        t1 = Tag(name=u'foo')
+        t2 = Tag(name=u'bar')
+
+        m1 = Message(body=u'm1', length=0, tags=[t1])
+        m2 = Message(body=u'm2', length=0, tags=[t2])
+        m3 = Message(body=u'm3', length=0, tags=[t1, t2])
+
+        mb = Mailbox(path=u'foo', query=u'foo')
+
+        meta.Session.add_all([t1, t2, m1, m2, m3, mb])
+        meta.Session.commit()
+        ids = sorted([m1.id, m3.id])
+
+        mb = self.getMailbox(u'foo')
+        mb.fetch_chunk_size = 1
+        n.eq_([m.id for m in mb.fetch(MessageSet(1, None), False)], ids)
+        n.eq_([m.id for m in mb.fetch(MessageSet(1, None), True)], ids)
+
+    def test_fetch_sparse(self):
+        # Ids spread across a huge range: resolving a UID set has to
+        # work from the mailbox's contents, not from the numbers in
+        # the range
+        t1 = Tag(name=u'foo')
+        ids = [3, 70000, 10 ** 9, 2 * 10 ** 9]
+        meta.Session.add_all([t1] + [Message(id=i, body=u'm', length=0,
+                                             tags=[t1])
+                                     for i in ids])
+        meta.Session.add(Message(id=500000, body=u'other', length=0))
+        meta.Session.add(Mailbox(path=u'foo', query=u'foo'))
+        meta.Session.commit()
+
+        mb = self.getMailbox(u'foo')
+        n.eq_([m.id for m in mb.fetch(MessageSet(1, None), True)], ids)
+        n.eq_([m.id for m in mb.fetch(MessageSet(4, 10 ** 9), True)],
+              [70000, 10 ** 9])
+        n.eq_([m.id for m in mb.fetch(MessageSet(70001, 999999), True)], [])
+        n.eq_([m.id for m in mb.fetch(MessageSet(2, 3), False)],
+              [70000, 10 ** 9])
+
+        s = MessageSet(1, 3)
+        s.add(2 * 10 ** 9, None)
+        n.eq_([m.id for m in mb.fetch(s, True)], [3, 2 * 10 ** 9])
+
+    def test_fetch_empty(self):
+        meta.Session.add(Mailbox(path=u'empty', query=u'nothing'))
+        meta.Session.commit()
+        mb = self.getMailbox(u'empty')
+        n.eq_(list(mb.fetch(MessageSet(1, None), True)), [])
+        n.eq_(list(mb.fetch(MessageSet(1, None), False)), [])
+
+    def test_store(self):
+        seen = Tag(name=ur'\Seen')
+        t1 = Tag(name=u'foo')
+
+        m1 = Message(body=u'm1', length=0, tags=[t1])
+        m2 = Message(body=u'm2', length=0, tags=[t1, seen])
+        m3 = Message(body=u'm3', length=0, tags=[])
+
+        mb = Mailbox(path=u'foo', query=u'foo')
+
+        meta.Session.add_all([seen, t1, m1, m2, m3, mb])
+        meta.Session.commit()
+        seen_id = seen.id
+
+        # Storing over the whole UID range should only touch messages
+        # that are actually in the mailbox
+        mb = self.getMailbox(u'foo')
+        mb.store(MessageSet(1, None), [ur'\Seen'], 1, True)
+        n.eq_(sorted(r[0] for r in meta.Session.query(MessageTag.message_id).\
+                         filter_by(tag_id=seen_id)),
+              mb.messages)
+
+    def test_store_readonly(self):
+        mb = Mailbox(path=u'all', query='*')
+        meta.Session.add(mb)
+        meta.Session.commit()
+
+        mb = self.getMailbox(u'all')
+        n.assert_raises(imap4.ReadOnlyMailbox,
+                        mb.store, MessageSet(1), [ur'\Seen'], 1, False)
+
+    def test_contents(self):
+        t1 = Tag(name=u'foo')
+        t2 = Tag(name=u'bar')
+
+        m1 = Message(body=u'm1', length=0, tags=[t1])
+        m2 = Message(body=u'm2', length=0, tags=[t1, t2])
+        m3 = Message(body=u'm3', length=0, tags=[t2])
+
+        mb = Mailbox(path=u'foo-bar', query=(u'foo', '-', u'bar'))
+
+        meta.Session.add_all([t1, t2, m1, m2, m3, mb])
+        meta.Session.commit()
+        t1_id, t2_id = t1.id, t2.id
+        m1_id, m2_id, m3_id = m1.id, m2.id, m3.id
+
+        n.eq_(self.getMailbox(u'foo-bar').messages, [m1_id])
+
+        # New messages
+        m4 = Message(body=u'm4', length=0,
+                     tags=[meta.Session.query(Tag).get(t1_id)])
+        meta.Session.add(m4)
+        meta.Session.commit()
+        m4_id = m4.id
+        n.eq_(self.getMailbox(u'foo-bar').messages,
+              sorted([m1_id, m4_id]))
+
+        # Tags changed with bulk statements
+        store.remove_tags([m2_id], [t2_id])
+        store.add_tags([m3_id], [t1_id])
+        meta.Session.commit()
+        n.eq_(self.getMailbox(u'foo-bar').messages,
+              sorted([m1_id, m2_id, m4_id]))
+
+        # Tags changed through the ORM
+        meta.Session.query(Tag).get(t2_id).copy(
+            meta.Session.query(Message).get(m4_id))
+        n.eq_(self.getMailbox(u'foo-bar').messages,
+              sorted([m1_id, m2_id]))
+
+        # Deleted messages
+        meta.Session.delete(meta.Session.query(Message).get(m1_id))
+        meta.Session.commit()
+        n.eq_(self.getMailbox(u'foo-bar').messages, [m2_id])
+
+        # Changing the query
+        mb = self.getMailbox(u'foo-bar')
+        mb.query = (u'foo', '&', u'bar')
+        meta.Session.commit()
+        n.eq_(self.getMailbox(u'foo-bar').messages,
+              sorted([m3_id, m4_id]))
+
+    def test_matchQuery(self):
+        q = (u'foo', '&', u'bar', '|', (u'baz', '-', 3))
+
+        n.ok_(Mailbox.matchQuery(q, set([u'foo', u'bar']), set([1, 2])))
+        n.ok_(Mailbox.matchQuery(q, set([u'baz']), set([1])))
+        n.ok_(not Mailbox.matchQuery(q, set([u'baz']), set([3])))
+        n.ok_(not Mailbox.matchQuery(q, set([u'foo']), set([1])))
+        n.ok_(Mailbox.matchQuery('*', set(), set()))
+
+    def test_getUnseenCount(self):
+        seen = Tag(name=ur'\Seen')
+        t1 = Tag(name=u'foo')
+
+        m1 = Message(body=u'm1', length=0, tags=[seen, t1])
+        m2 = Message(body=u'm2', length=0, tags=[t1])
+        m3 = Message(body=u'm3', length=0, tags=[seen])
+
+        mb = Mailbox(path=u'foo', query=u'foo')
+
+        meta.Session.add_all([seen, t1, m1, m2, m3, mb])
+        meta.Session.commit()
+
+        n.eq_(self.getMailbox(u'foo').getUnseenCount(), 1)
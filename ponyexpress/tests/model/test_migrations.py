@@ -0,0 +1,168 @@
+"""
+Tests for schema migrations
+"""
+
+import sqlalchemy as sa
+
+from ponyexpress import model
+from ponyexpress.model import *
+from ponyexpress.model import migrations, counters
+from twisted.mail.imap4 import MessageSet
+from nose import tools as n
+
+# The schema that create_all() made before there were any migrations
+BASELINE = ["""
+CREATE TABLE messages (
+	id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+	body TEXT,
+	length INTEGER NOT NULL,
+	deleted BOOLEAN NOT NULL,
+	created_at TIMESTAMP,
+	updated_at TIMESTAMP
+)""", """
+CREATE INDEX ix_messages_body ON messages (body)""", """
+CREATE TABLE headers (
+	id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+	position INTEGER,
+	message_id INTEGER NOT NULL,
+	field VARCHAR(255) NOT NULL,
+	value TEXT NOT NULL,
+	FOREIGN KEY(message_id) REFERENCES messages (id) ON DELETE CASCADE ON UPDATE CASCADE
+)""", """
+CREATE TABLE mailboxes (
+	id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+	path TEXT NOT NULL,
+	"query" BLOB NOT NULL,
+	UNIQUE (path)
+)""", """
+CREATE TABLE tags (
+	id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+	name VARCHAR(255) NOT NULL
+)""", """
+CREATE UNIQUE INDEX ix_tags_name ON tags (name)""", """
+CREATE TABLE messages_tags (
+	id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+	message_id INTEGER,
+	tag_id INTEGER,
+	deleted BOOLEAN NOT NULL,
+	FOREIGN KEY(message_id) REFERENCES messages (id) ON DELETE CASCADE ON UPDATE CASCADE,
+	FOREIGN KEY(tag_id) REFERENCES tags (id) ON DELETE CASCADE ON UPDATE CASCADE
+)"""]
+
+INDEXES = ['ix_headers_field_lower_value', 'ix_headers_message_id',
+           'ix_messages_tags_message_id_tag_id', 'ix_messages_tags_tag_id_id']
+
+class TestMigrations(object):
+    def setUp(self):
+        # Each test gets a database of its own, made the way an old
+        # one gets upgraded: the old schema, then create_all() for the
+        # new tables
+        self.saved = dict(vars(meta))
+        self.connect(BASELINE)
+
+    def tearDown(self):
+        meta.Session.remove()
+        vars(meta).update(self.saved)
+
+    def connect(self, schema):
+        engine = sa.create_engine('sqlite://')
+        for statement in schema:
+            engine.execute(statement)
+        model.init_model(engine)
+        Base.metadata.create_all(bind=engine)
+
+    def insert(self, table, *rows):
+        meta.Session.execute('INSERT INTO %s (%s) VALUES (%s)' % (
+                table, ', '.join(rows[0]),
+                ', '.join(':' + k for k in rows[0])), list(rows))
+
+    def test_upgrade(self):
+        self.insert('messages', {'id': 1, 'body': u'm1', 'length': 2,
+                                 'deleted': False})
+        self.insert('tags', {'id': 1, 'name': u'INBOX'})
+        self.insert('messages_tags', {'message_id': 1, 'tag_id': 1,
+                                      'deleted': False})
+        meta.Session.commit()
+
+        n.eq_(migrations.version(), 0)
+        n.ok_(not any(migrations.has_index(name) for name in INDEXES))
+        n.eq_(migrations.upgrade(target=1), [1])
+        n.eq_(migrations.upgrade(), range(2, 11))
+        n.eq_(migrations.version(), 10)
+        n.eq_(migrations.upgrade(), [])
+
+        # Everything in the model is there now, and the old indexes
+        # are gone
+        for table in (Message.__table__, Header.__table__, Tag.__table__,
+                      MessageTag.__table__):
+            for column in table.c:
+                n.ok_(migrations.has_column(table, column.name),
+                      '%s.%s' % (table.name, column.name))
+        n.ok_(all(migrations.has_index(name) for name in INDEXES))
+        n.ok_(not migrations.has_index('ix_messages_body'))
+        n.ok_(not migrations.has_index('ix_headers_field_value'))
+
+        # And the old rows work with it
+        inbox = meta.Session.query(Tag).one()
+        n.eq_(meta.Session.query(MessageTag).one().modseq, 0)
+        n.eq_([m.body for m in inbox.fetch(MessageSet(1, None), False)],
+              [u'm1'])
+        n.eq_(inbox.requestStatus(['MESSAGES', 'UNSEEN']),
+              {'MESSAGES': 1, 'UNSEEN': 1})
+
+    def test_fresh(self):
+        # Straight after create_all, everything is already there
+        self.connect([])
+        n.eq_(migrations.upgrade(), range(1, 11))
+
+    @n.raises(ValueError)
+    def test_unsupported(self):
+        class Engine(object):
+            name = 'oracle'
+        meta.engine = Engine()
+        migrations.has_index(INDEXES[0])
+
+    def test_dedup(self):
+        self.insert('messages',
+                    {'id': 1, 'body': u'm1', 'length': 2, 'deleted': False},
+                    {'id': 2, 'body': u'm2', 'length': 2, 'deleted': False})
+        self.insert('tags', {'id': 1, 'name': u'INBOX'})
+        # UIDs 3 and 4 are copies of UID 1
+        self.insert('messages_tags',
+                    *[{'message_id': m, 'tag_id': 1, 'deleted': False}
+                      for m in (1, 2, 1, 1)])
+        meta.Session.commit()
+
+        migrations.upgrade()
+        inbox = meta.Session.query(Tag).one()
+        n.eq_(inbox.getMessageCount(), 2)
+        n.eq_([inbox.getUID(1), inbox.getUID(2)], [1, 2])
+        n.eq_(inbox.vanishedSince(0), [3, 4])
+        n.eq_(counters.get(inbox.id)['messages'], 2)
+        n.ok_(inbox.getHighestModSeq() > 0)
+
+    def test_lower_header_fields(self):
+        self.insert('messages', {'id': 1, 'body': u'm1', 'length': 2,
+                                 'deleted': False})
+        self.insert('headers',
+                    {'message_id': 1, 'position': 0, 'field': u'Subject',
+                     'value': u'Hello'},
+                    {'message_id': 1, 'position': 1, 'field': u'X-Mailer',
+                     'value': u'Pony'})
+        meta.Session.commit()
+
+        migrations.upgrade()
+        n.eq_(sorted(h.field_lower for h in meta.Session.query(Header).\
+                         filter_by(message_id=1)),
+              [u'subject', u'x-mailer'])
+
+    def test_mime_part_headers(self):
+        # mime_parts came from create_all, so take the column back out
+        meta.Session.execute('ALTER TABLE mime_parts DROP COLUMN headers')
+        meta.Session.commit()
+        n.ok_(not migrations.has_column(MimePart.__table__, 'headers'))
+
+        migrations.upgrade()
+        n.ok_(migrations.has_column(MimePart.__table__, 'headers'))
+        # Already there, so it's left alone
+        migrations.add_column(MimePart.__table__.c.headers)
@@ -0,0 +1,139 @@
+"""
+Tests for the MIME structure index
+"""
+
+from ponyexpress.model import *
+from ponyexpress.model import mime, monkeypatch
+from ponyexpress.tests.model import ModelTest
+from ponyexpress.util.mpart import MPart
+from twisted.mail import imap4
+from nose import tools as n
+
+RAW = '\r\n'.join([
+        'From: alice@example.com',
+        'Subject: Attachments',
+        'Content-Type: multipart/mixed; boundary="outer"',
+        '',
+        'Preamble',
+        '--outer',
+        'Content-Type: text/plain; charset=utf-8',
+        '',
+        'Hello there',
+        '--outer',
+        'Content-Type: multipart/alternative; boundary=inner',
+        '',
+        '--inner',
+        '',
+        'Plain',
+        '--inner',
+        'Content-Type: text/html',
+        'Content-Transfer-Encoding: quoted-printable',
+        '',
+        '<p>HTML</p>',
+        'second line',
+        '--inner--',
+        '--outer',
+        'Content-Type: message/rfc822',
+        '',
+        'Subject: Forwarded',
+        '',
+        'Inside',
+        '--outer--',
+        ''])
+
+class TestMime(ModelTest):
+    def add(self, data):
+        m = Message.fromString(data)
+        meta.Session.add(m)
+        meta.Session.commit()
+        return m
+
+    def test_scan(self):
+        m = self.add(RAW)
+        n.eq_([(p.path, p.content_type) for p in m.mime_parts],
+              [('', 'multipart/mixed'),
+               ('1', 'text/plain'),
+               ('2', 'multipart/alternative'),
+               ('2.1', 'text/plain'),
+               ('2.2', 'text/html'),
+               ('3', 'message/rfc822'),
+               ('3.1', 'text/plain')])
+        parts = dict((p.path, p) for p in m.mime_parts)
+        n.eq_(parts['1'].charset, 'utf-8')
+        n.eq_(parts['2.2'].encoding, 'quoted-printable')
+        n.eq_(parts['2.1'].encoding, '7bit')
+        # The last line doesn't end in a line break, since that
+        # belongs to the boundary, but it still counts
+        n.eq_(parts['2.2'].lines, 2)
+        n.eq_(str(parts['2.2'].headers), 'Content-Type: text/html\r\n'
+              'Content-Transfer-Encoding: quoted-printable\r\n\r\n')
+        n.eq_(parts[''].headers, None)
+        n.eq_(parts['2.2'].size, len('<p>HTML</p>\r\nsecond line'))
+
+    def test_parts(self):
+        m = self.add(RAW)
+        n.ok_(m.isMultipart())
+        part = m.getSubPart(0)
+        n.ok_(not part.isMultipart())
+        n.eq_(part.getBodyFile().read(), 'Hello there')
+        n.eq_(part.getSize(), 11)
+        n.eq_(part.getHeaders(False, 'content-type').items(),
+              [('Content-Type', 'text/plain; charset=utf-8')])
+
+        html = m.getSubPart(1).getSubPart(1)
+        f = html.getBodyFile()
+        n.eq_(f.readline(), '<p>HTML</p>\r\n')
+        n.eq_(f.readline(), 'second line')
+        n.eq_(f.readline(), '')
+        n.eq_(html.getHeaders(True, 'Content-Type').keys(),
+              ['Content-Transfer-Encoding'])
+
+        forwarded = m.getSubPart(2).getSubPart(0)
+        n.eq_(forwarded.getHeaders(True)['subject'], 'Forwarded')
+        n.eq_(forwarded.getBodyFile().read(), 'Inside')
+        n.assert_raises(IndexError, m.getSubPart, 3)
+
+    def test_body_structure(self):
+        m_id = self.add(RAW).id
+        meta.Session.expunge_all()
+        m = meta.Session.query(Message).get(m_id)
+        # The same answer twisted would work out by reading every part
+        expected = [monkeypatch._getBodyStructure(m._getStructure(), extended)
+                    for extended in (False, True)]
+        # Except that the size of the message is all of it, headers
+        # included
+        expected[0][6] = expected[1][0][6] = str(len(RAW))
+
+        # But without reading the body
+        def unreadable():
+            raise AssertionError('read the body')
+        m.getBodyFile = unreadable
+        n.eq_([imap4.getBodyStructure(m, extended)
+               for extended in (False, True)], expected)
+        n.eq_(m.getSubPart(1).getSubPart(1).getHeaders(True).keys(),
+              ['Content-Type', 'Content-Transfer-Encoding'])
+
+        # Messages that haven't been indexed are still parsed
+        m = self.add(RAW)
+        m.mime_parts = []
+        meta.Session.commit()
+        n.eq_(imap4.getBodyStructure(m, True),
+              imap4.getBodyStructure(MPart(RAW), True))
+
+    def test_single(self):
+        m = self.add('Subject: Plain\r\n\r\nJust text\r\n')
+        n.eq_([(p.path, p.content_type) for p in m.mime_parts],
+              [('', 'text/plain')])
+        n.ok_(not m.isMultipart())
+
+    def test_unindexed(self):
+        m = self.add(RAW)
+        m.mime_parts = []
+        meta.Session.commit()
+        # Falls back on parsing the message
+        n.ok_(m.isMultipart())
+        n.eq_(m.getSubPart(0).getBodyFile().read(), 'Hello there')
+
+        mime.index(m)
+        meta.Session.commit()
+        n.eq_(len(m.mime_parts), 7)
@@ -0,0 +1,87 @@
+"""
+Tests for per-message modseqs (CONDSTORE and QRESYNC)
+"""
+
+from ponyexpress.model import *
+from ponyexpress.tests.model import ModelTest
+from twisted.mail.imap4 import MessageSet
+from nose import tools as n
+
+class TestModSeq(ModelTest):
+    def setUp(self):
+        self.inbox = Tag(name=u'INBOX')
+        self.seen = Tag(name=ur'\Seen')
+        self.messages = [Message(body=u'm%d' % i, length=0,
+                                 tags=[self.inbox])
+                         for i in xrange(4)]
+        meta.Session.add_all([self.inbox, self.seen] + self.messages)
+        meta.Session.commit()
+
+    def test_store(self):
+        inbox = self.inbox
+        since = inbox.getHighestModSeq()
+        n.eq_(inbox.fetchChanged(MessageSet(1, None), False, since), [])
+
+        inbox.store(MessageSet(2), [ur'\Seen'], 1, False)
+        inbox.store(MessageSet(3), [r'\Deleted'], 1, False)
+        highest = inbox.getHighestModSeq()
+        n.ok_(highest > since)
+
+        changed = inbox.fetchChanged(MessageSet(1, None), False, since)
+        n.eq_([(uid, sorted(flags)) for uid, modseq, flags in changed],
+              [(inbox.getUID(2), [u'INBOX', ur'\Seen']),
+               (inbox.getUID(3), [u'INBOX', r'\Deleted'])])
+        n.eq_(max(modseq for uid, modseq, flags in changed), highest)
+
+        # Only the later change is newer than the first one
+        n.eq_([uid for uid, modseq, flags in
+               inbox.fetchChanged(MessageSet(1, None), False,
+                                  changed[0][1])],
+              [inbox.getUID(3)])
+
+    def test_vanished(self):
+        inbox = self.inbox
+        since = inbox.getHighestModSeq()
+        gone = inbox.getUID(1)
+        # add_all doesn't keep the messages in order, so look up which
+        # one is last
+        last = meta.Session.query(MessageTag).get(inbox.getUID(4)).message
+        inbox.store(MessageSet(1), [u'INBOX'], -1, False)
+        meta.Session.delete(last)
+        meta.Session.commit()
+        # A client resyncs when it selects the folder again
+        inbox_id = inbox.id
+        meta.Session.expunge_all()
+        inbox = meta.Session.query(Tag).get(inbox_id)
+        first = inbox.getUID(1)
+
+        n.eq_(len(inbox.vanishedSince(since)), 2)
+        n.eq_(inbox.vanishedSince(since, MessageSet(1, gone)), [gone])
+        n.eq_(inbox.vanishedSince(inbox.getHighestModSeq()), [])
+
+        inbox.store(MessageSet(1), [ur'\Seen'], 1, False)
+        vanished, changed = inbox.resync(inbox.getUIDValidity(), since)
+        n.eq_(len(vanished), 2)
+        n.eq_([uid for uid, modseq, flags in changed], [first])
+        n.eq_(inbox.resync(inbox.getUIDValidity() + 1, since), None)
+
+    def test_mailbox(self):
+        mb = Mailbox(path=u'inbox', query=u'INBOX')
+        meta.Session.add(mb)
+        meta.Session.commit()
+        meta.Session.expunge_all()
+        mb = meta.Session.query(Mailbox).one()
+
+        since = mb.getHighestModSeq()
+        first, second = mb.messages[:2]
+        mb.store(MessageSet(first), [ur'\Seen'], 1, True)
+        mb.store(MessageSet(second), [u'INBOX'], -1, True)
+
+        vanished, changed = mb.resync(mb.getUIDValidity(), since)
+        n.eq_(vanished, [second])
+        n.eq_([uid for uid, modseq, flags in changed], [first])
+
+        everything = Mailbox(path=u'all', query='*')
+        meta.Session.add(everything)
+        meta.Session.commit()
+        n.eq_(everything.getHighestModSeq(), None)
@@ -0,0 +1,197 @@
+"""
+Tests for change notifications
+"""
+
+import threading
+
+from twisted.internet import task
+
+from ponyexpress.model import *
+from ponyexpress.model import store
+from ponyexpress.tests.model import ModelTest
+from twisted.mail.imap4 import MessageSet
+from nose import tools as n
+
+class Listener(object):
+    def __init__(self):
+        self.events = []
+
+    def newMessages(self, exists, recent):
+        self.events.append(('exists', exists))
+
+    def flagsChanged(self, newFlags):
+        self.events.append(('flags', newFlags))
+
+class NotifyTest(ModelTest):
+    def setUp(self):
+        self.clock = task.Clock()
+        meta.notifier.clock = self.clock
+        self.listener = Listener()
+        self.folder = None
+
+    def tearDown(self):
+        if self.folder is not None:
+            self.folder.removeListener(self.listener)
+        n.eq_(meta.notifier.folders, {})
+        ModelTest.tearDown(self)
+
+    def listen(self, folder):
+        self.folder = folder
+        folder.addListener(self.listener)
+
+class TestTag(NotifyTest):
+    def test_new(self):
+        inbox = Tag(name=u'INBOX')
+        meta.Session.add_all([inbox, Message(body=u'm1', length=0,
+                                             tags=[inbox])])
+        meta.Session.commit()
+        self.listen(inbox)
+
+        # Two commits, one round of callbacks
+        for body in (u'm2', u'm3'):
+            meta.Session.add(Message(body=body, length=0, tags=[inbox]))
+            meta.Session.commit()
+        n.eq_(self.listener.events, [])
+        self.clock.advance(0)
+        n.eq_(self.listener.events, [('exists', 3)])
+
+    def test_flags(self):
+        inbox = Tag(name=u'INBOX')
+        seen = Tag(name=ur'\Seen')
+        meta.Session.add_all([inbox, seen] +
+                             [Message(body=u'm', length=0, tags=[inbox])
+                              for i in xrange(3)])
+        meta.Session.commit()
+        self.listen(inbox)
+
+        inbox.store(MessageSet(2), [ur'\Seen'], 1, False)
+        inbox.store(MessageSet(3), [r'\Deleted'], 1, False)
+        self.clock.advance(0)
+        events = dict(self.listener.events)
+        n.eq_(sorted(events['flags'][2]), [u'INBOX', ur'\Seen'])
+        n.eq_(sorted(events['flags'][3]), [u'INBOX', r'\Deleted'])
+        n.ok_('exists' not in events)
+
+    def test_rollback(self):
+        inbox = Tag(name=u'INBOX')
+        meta.Session.add(inbox)
+        meta.Session.commit()
+        self.listen(inbox)
+
+        meta.Session.add(Message(body=u'm1', length=0, tags=[inbox]))
+        meta.Session.flush()
+        meta.Session.rollback()
+        self.clock.advance(0)
+        n.eq_(self.listener.events, [])
+
+    def test_idle(self):
+        # Nothing is recorded with nobody listening
+        inbox = Tag(name=u'INBOX')
+        meta.Session.add_all([inbox, Message(body=u'm1', length=0,
+                                             tags=[inbox])])
+        meta.Session.commit()
+        n.eq_(self.clock.getDelayedCalls(), [])
+
+class TestMailbox(NotifyTest):
+    def test_mailbox(self):
+        foo = Tag(name=u'foo')
+        seen = Tag(name=ur'\Seen')
+        m1 = Message(body=u'm1', length=0, tags=[foo])
+        mb = Mailbox(path=u'foo', query=u'foo')
+        meta.Session.add_all([foo, seen, m1, mb])
+        meta.Session.commit()
+        # Contents are loaded when the mailbox is
+        meta.Session.expunge_all()
+        mb = meta.Session.query(Mailbox).one()
+        self.listen(mb)
+
+        mb.store(MessageSet(1), [ur'\Seen'], 1, False)
+        foo = meta.Session.query(Tag).filter_by(name=u'foo').one()
+        meta.Session.add(Message(body=u'm2', length=0, tags=[foo]))
+        meta.Session.commit()
+        self.clock.advance(0)
+        events = dict(self.listener.events)
+        n.eq_(events['exists'], 2)
+        n.eq_(sorted(events['flags'][1]), [ur'\Seen', u'foo'])
+
+    def test_removed(self):
+        inbox = Tag(name=u'INBOX')
+        meta.Session.add_all([inbox, Mailbox(path=u'INBOX', query=u'INBOX')] +
+                             [Message(body=u'm', length=0, tags=[inbox])
+                              for i in xrange(4)])
+        meta.Session.commit()
+        meta.Session.expunge_all()
+        mb = meta.Session.query(Mailbox).one()
+        ids = list(mb.messages)
+        self.listen(mb)
+
+        # Another connection takes the first message out of the
+        # folder. The client still knows it as 1, and everything
+        # after it keeps its number
+        inbox = meta.Session.query(Tag).filter_by(name=u'INBOX').one()
+        store.remove_tags([ids[0]], [inbox.id])
+        meta.Session.commit()
+        self.clock.advance(0)
+        n.eq_(self.listener.events, [('flags', {1: []})])
+        n.eq_(mb.getMessageCount(), 4)
+        n.eq_(mb.getUID(3), ids[2])
+
+        # Until this connection expunges
+        n.eq_(mb.expunge(), [1])
+        n.eq_(mb.messages, ids[1:])
+
+class ThreadClock(task.Clock):
+    """
+    A Clock that other threads can hand calls to, which are run when
+    the test says so.
+    """
+
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.from_threads = []
+
+    def callFromThread(self, f, *args):
+        self.from_threads.append((f, args))
+
+    def run(self):
+        for f, args in self.from_threads:
+            f(*args)
+        del self.from_threads[:]
+        self.advance(0)
+
+class Folder(object):
+    def __init__(self):
+        self.messages = set()
+
+    def _notify(self, listeners, changes):
+        self.messages |= changes.messages
+
+class TestThreads(NotifyTest):
+    def test_threads(self):
+        meta.notifier.clock = clock = ThreadClock()
+        folder = Folder()
+        meta.notifier.subscribe(folder, self.listener)
+        errors = []
+        def record(start):
+            # Other folders come and go while changes are recorded
+            mine = Folder()
+            try:
+                for i in xrange(start, start + 1000, 10):
+                    meta.notifier.subscribe(mine, self.listener)
+                    meta.notifier.tags_changed(xrange(i, i + 10))
+                    meta.notifier.commit(meta.Session())
+                    meta.notifier.unsubscribe(mine, self.listener)
+            except Exception, e:
+                errors.append(e)
+            meta.Session.remove()
+        threads = [threading.Thread(target=record, args=(i * 1000 + 1,))
+                   for i in xrange(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        n.eq_(errors, [])
+
+        clock.run()
+        meta.notifier.unsubscribe(folder, self.listener)
+        n.eq_(folder.messages, set(xrange(1, 4001)))
@@ -0,0 +1,120 @@
+"""
+Tests for IMAP SEARCH support
+"""
+
+from datetime import datetime
+
+from ponyexpress.model import *
+from ponyexpress.tests.model import ModelTest
+from twisted.mail import imap4
+from nose import tools as n
+
+class TestSearch(ModelTest):
+    def setUp(self):
+        self.seen = Tag(name=ur'\Seen')
+        self.folder = Tag(name=u'foo')
+        self.other = Tag(name=u'bar')
+        meta.Session.add_all([self.seen, self.folder, self.other])
+
+        # Commit the messages one at a time so that their sequence
+        # numbers are predictable
+        specs = [(u'hello world', 100, datetime(2009, 1, 10),
+                  [(u'From', u'Alice <alice@example.com>'),
+                   (u'Subject', u'Lunch?')],
+                  [self.seen]),
+                 (u'100% done', 2000, datetime(2009, 2, 10),
+                  [(u'From', u'bob@example.com'),
+                   (u'To', u'alice@example.com'),
+                   (u'Subject', u'Re: lunch')],
+                  [self.other]),
+                 (u'nothing to see', 50, datetime(2009, 3, 10),
+                  [(u'From', u'carol@example.com'),
+                   (u'X-Spam', u'yes')],
+                  [self.seen, self.other])]
+        for body, length, date, headers, tags in specs:
+            m = Message(body=body, length=length, created_at=date,
+                        tags=[self.folder] + tags)
+            for field, value in headers:
+                m.headers.append(Header(field=field, value=value))
+            meta.Session.add(m)
+            meta.Session.commit()
+
+    def search(self, query):
+        return self.folder.search(imap4.parseNestedParens(query), False)
+
+    def test_headers(self):
+        n.eq_(self.search('FROM alice'), [1])
+        n.eq_(self.search('FROM EXAMPLE.COM'), [1, 2, 3])
+        n.eq_(self.search('TO alice'), [2])
+        n.eq_(self.search('SUBJECT lunch'), [1, 2])
+        n.eq_(self.search('HEADER x-spam yes'), [3])
+        n.eq_(self.search('HEADER X-Spam ""'), [3])
+        n.eq_(self.search('CC alice'), [])
+
+    def test_body(self):
+        n.eq_(self.search('BODY world'), [1])
+        n.eq_(self.search('BODY "100%"'), [2])
+        # The % shouldn't be treated as a wildcard
+        n.eq_(self.search('BODY "o%d"'), [])
+        n.eq_(self.search('TEXT carol'), [3])
+        n.eq_(self.search('TEXT see'), [3])
+
+    def test_dates_and_sizes(self):
+        n.eq_(self.search('SINCE 10-Feb-2009'), [2, 3])
+        n.eq_(self.search('BEFORE 10-Feb-2009'), [1])
+        n.eq_(self.search('ON 10-Feb-2009'), [2])
+        n.eq_(self.search('LARGER 99'), [1, 2])
+        n.eq_(self.search('SMALLER 100'), [3])
+
+    def test_flags(self):
+        n.eq_(self.search('SEEN'), [1, 3])
+        n.eq_(self.search('UNSEEN'), [2])
+        n.eq_(self.search('KEYWORD bar'), [2, 3])
+        n.eq_(self.search('UNKEYWORD bar'), [1])
+        n.eq_(self.search('KEYWORD nonexistent'), [])
+        n.eq_(self.search('FLAGGED'), [])
+        n.eq_(self.search('UNDELETED'), [1, 2, 3])
+
+        self.folder.store(imap4.MessageSet(2), [r'\Deleted'], 1, False)
+        n.eq_(self.search('DELETED'), [2])
+        n.eq_(self.search('UNDELETED'), [1, 3])
+
+    def test_sets(self):
+        n.eq_(self.search('2:*'), [2, 3])
+        n.eq_(self.search('1,3'), [1, 3])
+        n.eq_(self.search('5'), [])
+        uid = self.folder.getUID(2)
+        n.eq_(self.search('UID %d' % uid), [2])
+        n.eq_(self.search('UID %d:*' % uid), [2, 3])
+
+    def test_combinations(self):
+        n.eq_(self.search('SEEN FROM alice'), [1])
+        n.eq_(self.search('NOT SEEN'), [2])
+        n.eq_(self.search('OR FROM bob FROM carol'), [2, 3])
+        n.eq_(self.search('NOT (SEEN KEYWORD bar)'), [1, 2])
+        n.eq_(self.search('OR SUBJECT lunch NOT BODY world'), [1, 2, 3])
+        n.eq_(self.search('ALL'), [1, 2, 3])
+
+    def test_invalid(self):
+        n.assert_raises(imap4.IllegalQueryError, self.search, 'BOGUS')
+        n.assert_raises(imap4.IllegalQueryError, self.search, 'FROM')
+        n.assert_raises(imap4.IllegalQueryError, self.search, 'LARGER x')
+
+    def test_mailbox(self):
+        mb = Mailbox(path=u'INBOX', query=(u'foo', '-', u'bar'))
+        mb2 = Mailbox(path=u'Everything', query='*')
+        meta.Session.add_all([mb, mb2])
+        meta.Session.commit()
+        # Mailbox contents are loaded when the object is loaded from
+        # the database
+        meta.Session.expunge_all()
+        mb = meta.Session.query(Mailbox).filter_by(path=u'INBOX').one()
+        mb2 = meta.Session.query(Mailbox).filter_by(path=u'Everything').one()
+
+        # Sequence numbers are positions within the mailbox, not the
+        # tag
+        n.eq_(mb.search(['FROM', 'alice'], False), [1])
+        n.eq_(mb.search(['ALL'], False), [1])
+        n.eq_(mb2.search(['OR', 'FROM', 'bob', 'FROM', 'carol'], False),
+              [2, 3])
+        n.eq_(mb2.search(['DELETED'], False), [])
@@ -0,0 +1,139 @@
+"""
+Tests for raw messages in segment files
+"""
+
+import os
+import shutil
+import tempfile
+
+from ponyexpress.model import *
+from ponyexpress.model import segments, expunge
+from ponyexpress.tests.model import ModelTest
+from ponyexpress.util.rfc822 import header_length
+from twisted.mail import imap4
+from twisted.test.proto_helpers import StringTransport
+from nose import tools as n
+
+RAW = ('From: alice@example.com\r\n'
+       'Subject: Segments\r\n'
+       '\r\n'
+       'First line\r\n'
+       'Second line\r\n')
+
+class TestSegments(ModelTest):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        meta.segments = segments.SegmentStore(self.directory, segment_size=100)
+
+    def tearDown(self):
+        ModelTest.tearDown(self)
+        meta.segments.close()
+        meta.segments = None
+        shutil.rmtree(self.directory)
+
+    def add(self, data):
+        m = Message.fromString(data)
+        meta.Session.add(m)
+        meta.Session.commit()
+        return m
+
+    def test_header_length(self):
+        n.eq_(header_length('A: b\r\n\r\nbody'), 8)
+        n.eq_(header_length('A: b\n\nbody\r\n\r\n'), 6)
+        n.eq_(header_length('A: b\r\n'), 6)
+
+    def test_fromString(self):
+        m = self.add(RAW)
+        n.eq_(m.getSize(), len(RAW))
+        n.eq_([(h.field, h.value) for h in m.headers],
+              [(u'From', u'alice@example.com'), (u'Subject', u'Segments')])
+        n.eq_(m._body, None)
+        n.eq_(m.body, u'First line\r\nSecond line\r\n')
+        n.eq_(m.getRawFile().read(), RAW)
+
+    def test_files(self):
+        m = self.add(RAW)
+        f = m.getBodyFile()
+        n.eq_(f.readline(), 'First line\r\n')
+        n.eq_(f.tell(), 12)
+        n.eq_(f.read(6), 'Second')
+        n.eq_(f.read(), ' line\r\n')
+        n.eq_(f.read(), '')
+
+        # Partial fetches only read the part they want
+        raw = m.getRawFile()
+        raw.seek(6)
+        n.eq_(raw.read(5), 'alice')
+        raw.seek(-7, 2)
+        n.eq_(raw.read(100), ' line\r\n')
+        n.eq_(str(raw.buffer()), RAW)
+
+    def fetch(self, m, query):
+        server = imap4.IMAP4Server()
+        server.transport = StringTransport()
+        parser = imap4._FetchParser()
+        parser.parseString(query)
+        server.spew_body(parser.result[0], 1, m, server.transport.write,
+                         lambda: None)
+        while server.transport.producer is not None:
+            server.transport.producer.resumeProducing()
+        return server.transport.value()
+
+    def test_fetch(self):
+        m = self.add(RAW)
+        # Anything but BODY[] is left to twisted
+        n.eq_(self.fetch(m, 'BODY[TEXT]'),
+              'BODY[TEXT] {25}\r\nFirst line\r\nSecond line\r\n')
+
+        def unreadable():
+            raise AssertionError('put the message back together')
+        m.getBodyFile = unreadable
+        n.eq_(self.fetch(m, 'BODY[]'),
+              'BODY[] {%d}\r\n%s' % (len(RAW), RAW))
+        n.eq_(self.fetch(m, 'BODY[]<6.5>'), 'BODY[]<6> {5}\r\nalice')
+        n.eq_(self.fetch(m, 'BODY[]<60.100>'),
+              'BODY[]<60> {11}\r\ncond line\r\n')
+
+    def test_rollover(self):
+        m1 = self.add(RAW)
+        m2 = self.add(RAW)
+        # Each message is more than half a segment
+        n.eq_((m1.segment, m1.segment_offset), (0, 0))
+        n.eq_((m2.segment, m2.segment_offset), (1, 0))
+        n.eq_(m2.getRawFile().read(), RAW)
+
+    def test_set_body(self):
+        m = self.add(RAW)
+        m.body = u'Replaced'
+        meta.Session.commit()
+        n.eq_(m.segment, None)
+        n.eq_(m.body, u'Replaced')
+
+    def test_search(self):
+        t = Tag(name=u'foo')
+        m = self.add(RAW)
+        m.tags.add(t)
+        meta.Session.commit()
+        n.eq_(t.search(['BODY', 'second'], False), [1])
+        n.eq_(t.search(['SUBJECT', 'segments'], False), [1])
+
+    def test_compact(self):
+        # Three messages to a segment
+        meta.segments.segment_size = 250
+        ids = [self.add(RAW).id for i in xrange(4)]
+        expunge.collect(ids[:2])
+        meta.Session.commit()
+
+        # The third message is all that's left of segment 0
+        n.eq_(expunge.compact_segments(), 0)
+        m3 = meta.Session.query(Message).get(ids[2])
+        n.eq_((m3.segment, m3.segment_offset), (1, len(RAW)))
+        n.eq_(m3.getRawFile().read(), RAW)
+        n.ok_(os.path.exists(meta.segments.filename(0)))
+
+        # Which isn't deleted until it's been empty for a while
+        n.eq_(expunge.compact_segments(), 0)
+        n.eq_(expunge.compact_segments(min_age=0), 1)
+        n.eq_(meta.segments.segments(), [1])
+        n.eq_(meta.Session.query(Message).get(ids[3]).getRawFile().read(),
+              RAW)
@@ -3,6 +3,7 @@ Tests for the PonyExpress Tag model
 """
 
 from ponyexpress.model import *
+from ponyexpress.model import counters
 from ponyexpress.tests.model import ModelTest
 from twisted.mail.imap4 import MessageSet
 from nose import tools as n
@@ -122,6 +123,180 @@ class TestTag(ModelTest):
         m.add(t1.getUID(2))
         n.eq_(list(t1.fetch(m, True)), [m1, m2])
 
+    def test_fetch_chunked(self):
+        t1 = Tag(name=u'foo')
+        meta.Session.add(t1)
+
+        msgs = []
+        for i in xrange(5):
+            msgs.append(Message(body=u'm%d' % i, length=0, tags=[t1]))
+            meta.Session.add(msgs[-1])
+            meta.Session.commit()
+
+        # Messages should come back in order even when they span
+        # several queries
+        t1.fetch_chunk_size = 2
+        n.eq_(list(t1.fetch(MessageSet(1, None), False)), msgs)
+        n.eq_(list(t1.fetch(MessageSet(2, 4), False)), msgs[1:4])
+
+    def test_sequence(self):
+        t1 = Tag(name=u'foo')
+        t2 = Tag(name=u'bar')
+
+        m1 = Message(body=u'm1', length=0, tags=[t1])
+        m2 = Message(body=u'm2', length=0, tags=[t2])
+        m3 = Message(body=u'm3', length=0, tags=[t1])
+
+        meta.Session.add_all([t1, t2, m1, m2, m3])
+        meta.Session.commit()
+
+        n.eq_(t1.getMessageCount(), 2)
+        n.eq_(list(t1.fetch(MessageSet(2, None), False)), [m3])
+
+        # Messages tagged after the folder was first used should show
+        # up at the end
+        m4 = Message(body=u'm4', length=0, tags=[t1])
+        meta.Session.add(m4)
+        meta.Session.commit()
+
+        n.eq_(t1.getMessageCount(), 3)
+        n.eq_(list(t1.fetch(MessageSet(2, None), False)), [m3, m4])
+        n.eq_(list(t1.fetch(MessageSet(1, None), True)), [m1, m3, m4])
+
+    def test_store(self):
+        seen = Tag(name=ur'\Seen')
+        flagged = Tag(name=ur'\Flagged')
+        t1 = Tag(name=u'foo')
+
+        m1 = Message(body=u'm1', length=0, tags=[t1])
+        meta.Session.add_all([seen, flagged, t1, m1])
+        meta.Session.commit()
+
+        m2 = Message(body=u'm2', length=0, tags=[t1, seen])
+        meta.Session.add(m2)
+        meta.Session.commit()
+        seen_id, t1_id, m1_id = seen.id, t1.id, m1.id
+
+        t1.store(MessageSet(1, None), [ur'\Seen'], 1, False)
+        n.eq_(meta.Session.query(MessageTag).\
+                  filter_by(tag_id=seen_id).count(), 2)
+
+        t1.store(MessageSet(1), [ur'\Flagged', r'\Deleted'], 0, False)
+        m1 = meta.Session.query(Message).get(m1_id)
+        n.eq_(sorted(t.name for t in m1.tags), [ur'\Flagged', u'foo'])
+        n.ok_(meta.Session.query(MessageTag).\
+                  filter_by(message_id=m1_id, tag_id=t1_id).one().deleted)
+
+        t1.store(MessageSet(1, 2), [ur'\Seen', r'\Deleted'], -1, False)
+        n.eq_(meta.Session.query(MessageTag).\
+                  filter_by(tag_id=seen_id).count(), 0)
+        n.eq_(meta.Session.query(MessageTag).\
+                  filter_by(tag_id=t1_id, deleted=True).count(), 0)
+
+    def test_requestStatus(self):
+        seen = Tag(name=ur'\Seen')
+        t1 = Tag(name=u'foo')
+        t2 = Tag(name=u'bar')
+
+        m1 = Message(body=u'm1', length=0, tags=[t1])
+        meta.Session.add_all([seen, t1, t2, m1])
+        meta.Session.commit()
+        t1_id = t1.id
+
+        names = ['MESSAGES', 'UIDNEXT', 'UNSEEN', 'HIGHESTMODSEQ']
+        def check():
+            status = t1.requestStatus(names)
+            expected = counters.compute(t1_id)
+            n.eq_(status['MESSAGES'], expected['messages'])
+            n.eq_(status['UNSEEN'], expected['unseen'])
+            n.eq_(status['UIDNEXT'], expected['uidnext'])
+            n.eq_(status['UIDNEXT'], t1.getUIDNext())
+            return status['HIGHESTMODSEQ']
+
+        modseq = check()
+
+        # The counters should follow changes made through the ORM...
+        m2 = Message(body=u'm2', length=0, tags=[t1, seen])
+        meta.Session.add(m2)
+        meta.Session.commit()
+        n.ok_(check() > modseq)
+
+        t1.copy(Message(body=u'm3', length=0, tags=[t2]))
+        meta.Session.commit()
+        modseq = check()
+
+        # ...and through STORE
+        t1.store(MessageSet(1, None), [ur'\Seen'], 1, False)
+        n.ok_(check() > modseq)
+        n.eq_(t1.requestStatus(['UNSEEN'])['UNSEEN'], 0)
+
+        modseq = check()
+        t1.store(MessageSet(1), [r'\Deleted'], 1, False)
+        n.ok_(check() > modseq)
+
+        t1.store(MessageSet(1, 2), [ur'\Seen'], -1, False)
+        n.eq_(t1.requestStatus(['UNSEEN'])['UNSEEN'], 2)
+        check()
+
+        t1.store(MessageSet(1), [u'bar'], 0, False)
+        check()
+
+    def test_requestStatus_read_only(self):
+        flagged = Tag(name=ur'\Flagged')
+        t1 = Tag(name=u'foo')
+        m1 = Message(body=u'm1', length=0)
+        meta.Session.add_all([flagged, t1, m1])
+        meta.Session.commit()
+        # Tag the message behind the counters' back, like a database
+        # from before there were any
+        meta.Session.execute(MessageTag.__table__.insert(),
+                             [{'message_id': m1.id, 'tag_id': t1.id,
+                               'deleted': False}])
+        meta.Session.execute(counters.tag_counters.delete())
+        meta.Session.commit()
+
+        # Answering STATUS mustn't write anything
+        status = t1.requestStatus(['MESSAGES', 'HIGHESTMODSEQ'])
+        n.eq_(status['MESSAGES'], 1)
+        n.eq_(meta.Session.execute(
+                counters.tag_counters.count()).scalar(), 0)
+
+        # The first change creates the counters, after whatever modseq
+        # the client has already seen
+        t1.store(MessageSet(1), [ur'\Flagged'], 1, False)
+        meta.Session.commit()
+        n.eq_(meta.Session.execute(
+                counters.tag_counters.count()).scalar(), 2)
+        n.ok_(t1.getHighestModSeq() > status['HIGHESTMODSEQ'])
+        n.eq_(len(t1.fetchChanged(MessageSet(1), False,
+                                  status['HIGHESTMODSEQ'])), 1)
+
+    def test_requestStatus_race(self):
+        t1 = Tag(name=u'foo')
+        meta.Session.add(t1)
+        meta.Session.commit()
+
+        # Another transaction creates the counters, from before this
+        # one's change, just as this one goes to create them
+        create = counters.create
+        def racing(tag_id, bump=0):
+            meta.Session.execute(counters.tag_counters.insert(),
+                                 [{'tag_id': tag_id, 'messages': 0,
+                                   'unseen': 0, 'uidnext': 1,
+                                   'modseq': 1}])
+            return create(tag_id, bump)
+        counters.create = racing
+        try:
+            meta.Session.add(Message(body=u'm1', length=0, tags=[t1]))
+            meta.Session.commit()
+        finally:
+            counters.create = create
+
+        status = t1.requestStatus(['MESSAGES', 'UNSEEN', 'UIDNEXT',
+                                   'HIGHESTMODSEQ'])
+        n.eq_(status, {'MESSAGES': 1, 'UNSEEN': 1,
+                       'UIDNEXT': t1.getUIDNext(), 'HIGHESTMODSEQ': 2})
+
     def test_copy(self):
         t1 = Tag(name=u'foo')
         t2 = Tag(name=u'bar')
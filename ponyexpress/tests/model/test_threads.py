@@ -0,0 +1,215 @@
+"""
+Tests for running the model on a thread pool
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import Queue
+
+import sqlalchemy
+from twisted.internet import task
+from twisted.mail.imap4 import MessageSet
+
+from ponyexpress import model
+from ponyexpress.model import *
+from ponyexpress.model import threads
+from ponyexpress.model.notify import Notifier
+from ponyexpress.tests.model import ModelTest
+from nose import tools as n
+
+# Every thread gets its own connection to an in-memory database, which
+# means a database of its own, so these tests need a file that they
+# can all share
+_engine = None
+_directory = None
+
+def setup():
+    global _engine, _directory
+    _engine = meta.engine
+    _directory = tempfile.mkdtemp()
+    e = sqlalchemy.create_engine('sqlite:///' +
+                                 os.path.join(_directory, 'test.db'))
+    model.init_model(e)
+    model.Base.metadata.create_all(bind=e)
+
+def teardown():
+    meta.Session.remove()
+    model.init_model(_engine)
+    shutil.rmtree(_directory)
+
+class FakeReactor(task.Clock):
+    """
+    A Clock that also takes calls from other threads, and runs them
+    when asked.
+    """
+
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.threadCalls = Queue.Queue()
+
+    def callFromThread(self, f, *args, **kwargs):
+        self.threadCalls.put((f, args, kwargs))
+
+    def wait(self, d):
+        """
+        Run calls from other threads until d has fired, and return its
+        result.
+        """
+        results = []
+        d.addBoth(results.append)
+        while not results:
+            f, args, kwargs = self.threadCalls.get(timeout=10)
+            f(*args, **kwargs)
+        return results[0]
+
+class ThreadTest(ModelTest):
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.pool = threads.DatabasePool(size=2, max_queue=3,
+                                         reactor=self.reactor)
+        self.pool.start()
+
+    def tearDown(self):
+        self.pool.stop()
+        ModelTest.tearDown(self)
+
+class TestPool(ThreadTest):
+    def test_ordered(self):
+        worker = self.pool.worker()
+        seen = []
+        def job(i):
+            seen.append((i, threading.currentThread().getName()))
+            return i
+        ds = [worker.run(job, i) for i in xrange(3)]
+        n.eq_([self.reactor.wait(d) for d in ds], [0, 1, 2])
+        n.eq_([i for i, name in seen], [0, 1, 2])
+        # All on the same thread, which isn't this one
+        n.eq_(len(set(name for i, name in seen)), 1)
+        n.ok_(seen[0][1] != threading.currentThread().getName())
+
+    def test_spread(self):
+        n.ok_(self.pool.worker() is not self.pool.worker())
+
+    def test_error(self):
+        def job():
+            meta.Session.add(Tag(name=u'INBOX'))
+            meta.Session.flush()
+            raise ValueError
+        result = self.reactor.wait(self.pool.run(job))
+        n.ok_(result.check(ValueError))
+        # The tag was rolled back along with the job
+        n.eq_(meta.Session.query(Tag).count(), 0)
+        n.eq_(self.pool.metrics.snapshot()['failures'], 1)
+
+    def test_full(self):
+        worker = self.pool.worker()
+        blocked = threading.Event()
+        ds = [worker.run(blocked.wait)]
+        # Make sure the first job has started before filling the
+        # queue behind it
+        while self.pool.metrics.snapshot()['busy'] == 0:
+            blocked.wait(0.01)
+        ds.extend(worker.run(lambda: None) for i in xrange(3))
+        full = worker.run(lambda: None)
+        n.ok_(self.reactor.wait(full).check(threads.PoolFull))
+
+        metrics = self.pool.metrics.snapshot()
+        n.eq_((metrics['queued'], metrics['busy'], metrics['rejected']),
+              (3, 1, 1))
+        blocked.set()
+        for d in ds:
+            self.reactor.wait(d)
+        metrics = self.pool.metrics.snapshot()
+        n.eq_((metrics['queued'], metrics['busy'], metrics['jobs']),
+              (0, 0, 4))
+        n.eq_(worker.pending, 0)
+
+    def test_lag(self):
+        monitor = threads.LagMonitor(self.pool.metrics, interval=1.0,
+                                     clock=self.reactor)
+        monitor.start()
+        self.reactor.advance(1.0)
+        n.eq_(self.pool.metrics.lag, 0.0)
+        self.reactor.advance(3.5)
+        n.eq_(self.pool.metrics.snapshot()['lag'], 2.5)
+        monitor.stop()
+        n.eq_(self.reactor.getDelayedCalls(), [])
+
+class Listener(object):
+    def __init__(self):
+        self.events = []
+
+    def newMessages(self, exists, recent):
+        self.events.append(('exists', exists,
+                            threading.currentThread().getName()))
+
+    def flagsChanged(self, newFlags):
+        self.events.append(('flags', newFlags,
+                            threading.currentThread().getName()))
+
+class TestThreadedFolder(ThreadTest):
+    def setUp(self):
+        ThreadTest.setUp(self)
+        inbox = Tag(name=u'INBOX')
+        meta.Session.add_all([inbox, Tag(name=ur'\Seen')])
+        # One at a time, so that they're numbered in order
+        for i in xrange(3):
+            meta.Session.add(Message.fromString(
+                    'Subject: m%d\r\n\r\nHi\r\n' % i, tags=[inbox]))
+            meta.Session.flush()
+        meta.Session.commit()
+        self.folder = threads.ThreadedFolder(inbox, self.pool.worker())
+
+    def tearDown(self):
+        meta.notifier = Notifier()
+        ThreadTest.tearDown(self)
+
+    def test_fetch(self):
+        wait = self.reactor.wait
+        n.eq_(wait(self.folder.getMessageCount()), 3)
+        messages = wait(self.folder.fetch(MessageSet(2, 3), False))
+        n.eq_([m.headers[0].value for m in messages], [u'm1', u'm2'])
+        # Detached, but with everything a FETCH needs
+        n.eq_(messages[0].body, u'Hi\r\n')
+        n.ok_(messages[0] not in meta.Session)
+
+        n.eq_(wait(self.folder.search(['SUBJECT', 'm1'], False)), [2])
+        seen = threads.ThreadedFolder(
+            meta.Session.query(Tag).filter_by(name=ur'\Seen').one(),
+            self.folder.worker)
+        wait(seen.copy(messages[0]))
+        n.eq_(wait(seen.getMessageCount()), 1)
+
+    def test_store(self):
+        wait = self.reactor.wait
+        wait(self.folder.store(MessageSet(1), [ur'\Seen'], 1, False))
+        n.eq_(wait(self.folder.getUnseenCount()), 2)
+        n.eq_(wait(self.folder.requestStatus(['UNSEEN']))['UNSEEN'], 2)
+
+    def test_notify(self):
+        wait = self.reactor.wait
+        meta.notifier = Notifier(clock=self.reactor)
+        listener = Listener()
+        wait(self.folder.addListener(listener))
+        n.eq_(meta.notifier.folders, {self.folder: set([listener])})
+
+        # A change committed by another worker gets back to the
+        # listener, in this thread
+        other = threads.ThreadedFolder(
+            meta.Session.query(Tag).filter_by(name=u'INBOX').one(),
+            self.pool.worker())
+        n.ok_(other.worker is not self.folder.worker)
+        wait(other.store(MessageSet(2), [ur'\Seen'], 1, False))
+        self.reactor.advance(0)
+        while not listener.events:
+            f, args, kwargs = self.reactor.threadCalls.get(timeout=10)
+            f(*args, **kwargs)
+        event, flags, name = listener.events[0]
+        n.eq_(event, 'flags')
+        n.eq_(sorted(flags[2]), [u'INBOX', ur'\Seen'])
+        n.eq_(name, threading.currentThread().getName())
+
+        wait(self.folder.removeListener(listener))
+        n.eq_(meta.notifier.folders, {})
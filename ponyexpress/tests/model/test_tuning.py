@@ -0,0 +1,53 @@
+"""
+Tests for the database settings for serving mail
+"""
+
+import os
+import shutil
+import tempfile
+
+import sqlalchemy
+
+from ponyexpress.model import tuning
+from nose import tools as n
+
+class TestTuning(object):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.url = 'sqlite:///' + os.path.join(self.directory, 'test.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_pragmas(self):
+        engine = tuning.create_engine(self.url)
+        tuning.tune(engine)
+        settings = tuning.settings(engine)
+        n.eq_(settings['journal_mode'], 'wal')
+        # NORMAL
+        n.eq_(settings['synchronous'], 1)
+        n.eq_(settings['busy_timeout'], 5000)
+        n.eq_(settings['cache_size'], -65536)
+
+        # Tuning twice doesn't add another listener
+        tuning.tune(engine)
+        n.eq_(len([l for l in engine.pool.listeners
+                   if isinstance(l, tuning.TuningListener)]), 1)
+
+    def test_read_only(self):
+        engine = tuning.create_engine(self.url)
+        tuning.tune(engine)
+        engine.execute('CREATE TABLE t (x INTEGER)')
+        reader = tuning.read_engine(engine)
+        tuning.tune(reader, read_only=True)
+        engine.execute('INSERT INTO t VALUES (1)')
+
+        n.eq_(reader.execute('SELECT x FROM t').fetchall(), [(1,)])
+        n.assert_raises(sqlalchemy.exc.OperationalError,
+                        reader.execute, 'INSERT INTO t VALUES (2)')
+
+    def test_memory(self):
+        n.ok_(tuning.is_memory('sqlite://'))
+        n.ok_(tuning.is_memory('sqlite:///:memory:'))
+        n.ok_(not tuning.is_memory(self.url))
+        n.eq_(tuning.read_engine(sqlalchemy.create_engine('sqlite://')), None)
@@ -0,0 +1,66 @@
+"""
+Tests for the PonyExpress Bitmap
+"""
+
+import random
+
+from ponyexpress.util.bitmap import Bitmap
+from nose import tools as n
+
+class TestBitmap(object):
+    def setUp(self):
+        r = random.Random(42)
+        # A sparse set, a dense set, and one that's a bit of both,
+        # spread across a few chunks
+        self.sets = [
+            set(r.randrange(0, 300000) for i in xrange(1000)),
+            set(xrange(60000, 140000)),
+            set(r.randrange(0, 200000) for i in xrange(40000)),
+            ]
+        self.bitmaps = [Bitmap(s) for s in self.sets]
+
+    def test_contents(self):
+        for s, b in zip(self.sets, self.bitmaps):
+            n.eq_(len(b), len(s))
+            n.eq_(list(b), sorted(s))
+
+    def test_operations(self):
+        for s1, b1 in zip(self.sets, self.bitmaps):
+            for s2, b2 in zip(self.sets, self.bitmaps):
+                n.eq_(list(b1 & b2), sorted(s1 & s2))
+                n.eq_(list(b1 | b2), sorted(s1 | s2))
+                n.eq_(list(b1 - b2), sorted(s1 - s2))
+
+    def test_add_discard(self):
+        b = Bitmap()
+        for i in xrange(0, 10000, 2):
+            b.add(i)
+        n.eq_(len(b), 5000)
+        n.ok_(4 in b)
+        n.ok_(5 not in b)
+
+        for i in xrange(0, 10000, 4):
+            b.discard(i)
+        n.eq_(list(b), range(2, 10000, 4))
+
+        b.discard(3)
+        b.add(2)
+        n.eq_(len(b), 2500)
+        n.ok_(not Bitmap())
+
+    def test_update(self):
+        b = Bitmap([1, 2, 3])
+        b.update([3, 4, 70000])
+        b.difference_update([1, 70000])
+        n.eq_(list(b), [2, 3, 4])
+
+    def test_union(self):
+        b = Bitmap([1, 2, 70000])
+        c = b.union([3, 70001])
+        n.eq_(list(b), [1, 2, 70000])
+        n.eq_(list(c), [1, 2, 3, 70000, 70001])
+
+    def test_memory_usage(self):
+        # Dense chunks cost a fixed 8 KiB, no matter how full they are
+        n.ok_(Bitmap(xrange(65536)).memory_usage() < 9 * 1024)
+        n.ok_(Bitmap(xrange(100)).memory_usage() < 1024)
@@ -0,0 +1,52 @@
+"""
+Tests for the PonyExpress Headers class
+"""
+
+from ponyexpress.util.headers import Headers
+from nose import tools as n
+
+class TestHeaders(object):
+    def setUp(self):
+        self.h = Headers([('Received', 'one'),
+                          ('From', 'alice@example.com'),
+                          ('received', 'two'),
+                          ('Subject', 'Hi')])
+
+    def test_lookup(self):
+        n.eq_(self.h['RECEIVED'], 'one')
+        n.eq_(self.h.get_all('Received'), ['one', 'two'])
+        n.ok_('subject' in self.h)
+        n.ok_('To' not in self.h)
+        n.assert_raises(KeyError, self.h.__getitem__, 'To')
+        n.eq_(self.h.get('To', 'nobody'), 'nobody')
+
+    def test_setitem(self):
+        # Look something up first so that the index is built
+        n.eq_(self.h['From'], 'alice@example.com')
+        self.h['RECEIVED'] = 'three'
+        self.h['To'] = 'bob@example.com'
+        n.eq_(self.h.get_all('received'), ['one', 'two', 'three'])
+        n.eq_(self.h['to'], 'bob@example.com')
+        n.eq_(self.h.setdefault('Subject', 'ignored'), 'Hi')
+        n.eq_(self.h.setdefault('Cc', 'carol'), 'carol')
+        n.eq_(len(self.h), 7)
+
+    def test_delitem(self):
+        n.eq_(self.h['Received'], 'one')
+        del self.h['RECEIVED']
+        n.eq_(self.h.keys(), ['From', 'Subject'])
+        n.ok_('received' not in self.h)
+        del self.h['Nonexistent']
+        self.h.clear()
+        n.eq_(len(self.h), 0)
+        n.ok_('from' not in self.h)
+
+    def test_select(self):
+        n.eq_(self.h.select(['subject', 'RECEIVED']).items(),
+              [('Received', 'one'), ('received', 'two'), ('Subject', 'Hi')])
+        n.eq_(self.h.select(['received'], True).items(),
+              [('From', 'alice@example.com'), ('Subject', 'Hi')])
+        n.eq_(len(self.h.select([])), 0)
+
+    def test_slots(self):
+        n.assert_raises(AttributeError, setattr, self.h, 'foo', 1)
@@ -0,0 +1,66 @@
+"""
+Tests for the PonyExpress SequenceMap
+"""
+
+from ponyexpress.util.seqmap import SequenceMap, covers
+from twisted.mail.imap4 import MessageSet
+from nose import tools as n
+
+class TestSequenceMap(object):
+    def test_getUID(self):
+        s = SequenceMap([7, 3, 12])
+
+        n.eq_(len(s), 3)
+        n.eq_(s.getUID(1), 3)
+        n.eq_(s.getUID(3), 12)
+        n.assert_raises(IndexError, s.getUID, 0)
+        n.assert_raises(IndexError, s.getUID, 4)
+
+    def test_getSequence(self):
+        s = SequenceMap([3, 7, 12])
+
+        n.eq_(s.getSequence(7), 2)
+        n.assert_raises(KeyError, s.getSequence, 8)
+
+    def test_append(self):
+        s = SequenceMap([3, 7])
+        s.append(12)
+        s.append(5)
+        s.append(7)
+
+        n.eq_(list(s), [3, 5, 7, 12])
+        n.eq_(s.last(), 12)
+
+    def test_remove(self):
+        s = SequenceMap([3, 5, 7, 12])
+
+        # Sequence numbers come back highest first, and UIDs that
+        # aren't there are ignored
+        n.eq_(s.remove([3, 7, 8]), [3, 1])
+        n.eq_(list(s), [5, 12])
+
+    def test_resolve_sequence(self):
+        s = SequenceMap([3, 5, 7, 12])
+
+        n.eq_(s.resolve(MessageSet(2, 3), False), [5, 7])
+        n.eq_(s.resolve(MessageSet(3, None), False), [7, 12])
+
+        m = MessageSet(1)
+        m.add(4)
+        n.eq_(s.resolve(m, False), [3, 12])
+
+    def test_resolve_uid(self):
+        s = SequenceMap([3, 5, 7, 12])
+
+        n.eq_(s.resolve(MessageSet(4, 7), True), [5, 7])
+        n.eq_(s.resolve(MessageSet(8, None), True), [12])
+        n.eq_(s.resolve(MessageSet(8, 11), True), [])
+
+    def test_resolve_empty(self):
+        n.eq_(SequenceMap().resolve(MessageSet(1, None), False), [])
+
+    def test_covers(self):
+        n.ok_(covers(MessageSet(4, 7), 5))
+        n.ok_(not covers(MessageSet(4, 7), 8))
+        n.ok_(covers(MessageSet(8, None), 1000))
+        n.ok_(not covers(MessageSet(8, None), 7))
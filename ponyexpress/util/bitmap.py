@@ -0,0 +1,286 @@
+"""
+ponyexpress utility modules: a compressed bitmap of integers
+
+This is a pure-Python take on a roaring bitmap. Values are split into
+chunks of 65536 by their high bits, and each chunk is stored in
+whichever form is smaller:
+
+ - a sorted array('H') of the low 16 bits, for chunks with at most
+   4096 values, costing 2 bytes per value
+
+ - a bitmap, stored as a Python long so that AND, OR and AND NOT run
+   in C, costing 8 KiB per chunk regardless of how many values it has
+
+So a Bitmap never needs more than 2 bytes per value, or 1 bit per
+possible value in the range it covers, whichever is less, plus
+roughly 100 bytes of bookkeeping per non-empty chunk.
+"""
+
+from array import array
+from bisect import bisect_left
+from binascii import hexlify, unhexlify
+
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+LOW_MASK = CHUNK_SIZE - 1
+# Past this many values, a bitmap is smaller than an array
+ARRAY_MAX = 4096
+# Rough per-chunk overhead of the dict entry and container object
+CHUNK_OVERHEAD = 100
+
+# The positions of the set bits in every possible byte
+_BITS = [tuple(i for i in xrange(8) if b & (1 << i)) for b in xrange(256)]
+
+def _popcount(x):
+    return bin(x).count('1')
+
+def _to_long(c):
+    """
+    Convert a container to bitmap form.
+    """
+    if not isinstance(c, array):
+        return c
+    bits = bytearray(CHUNK_SIZE >> 3)
+    for v in c:
+        bits[v >> 3] |= 1 << (v & 7)
+    # long() wants the most significant byte first
+    bits.reverse()
+    return long(hexlify(str(bits)), 16)
+
+def _to_array(c):
+    """
+    Convert a container to array form.
+    """
+    if isinstance(c, array):
+        return c
+    h = '%x' % c
+    if len(h) & 1:
+        h = '0' + h
+    result = array('H')
+    for i, b in enumerate(reversed(bytearray(unhexlify(h)))):
+        if b:
+            base = i << 3
+            result.extend(base + bit for bit in _BITS[b])
+    return result
+
+def _normalize(c):
+    """
+    Put a container in the right form for its size, or return None if
+    it's empty.
+    """
+    if isinstance(c, array):
+        if not c:
+            return None
+        if len(c) > ARRAY_MAX:
+            return _to_long(c)
+        return c
+    count = _popcount(c)
+    if count == 0:
+        return None
+    elif count <= ARRAY_MAX:
+        return _to_array(c)
+    return c
+
+def _len(c):
+    if isinstance(c, array):
+        return len(c)
+    return _popcount(c)
+
+class Bitmap(object):
+    """
+    A set of non-negative integers, optimized for dense runs of
+    values and fast set operations.
+    """
+
+    __slots__ = ('_chunks',)
+
+    def __init__(self, values=()):
+        """
+        Create a new Bitmap containing values, which can be any
+        iterable of non-negative integers.
+        """
+        self._chunks = {}
+        self.update(values)
+
+    def update(self, values):
+        """
+        Add all of values to the Bitmap.
+        """
+        new = {}
+        for v in values:
+            new.setdefault(v >> CHUNK_BITS, []).append(v & LOW_MASK)
+        for key, lows in new.iteritems():
+            c = array('H', sorted(set(lows)))
+            if key in self._chunks:
+                c = self._or(self._chunks[key], c)
+            self._chunks[key] = _normalize(c)
+
+    def union(self, values):
+        """
+        Return a new Bitmap with all of values added to this one's.
+
+        Unlike update() on a copy(), only the chunks that values fall
+        in are copied, and the rest are shared by the two Bitmaps, so
+        neither should be changed with add() or discard() afterwards.
+        """
+        result = Bitmap()
+        result._chunks = dict(self._chunks)
+        result.update(values)
+        return result
+
+    def difference_update(self, values):
+        """
+        Remove all of values from the Bitmap, if present.
+        """
+        self -= Bitmap(values)
+
+    def add(self, value):
+        """
+        Add a single value to the Bitmap.
+        """
+        key, low = value >> CHUNK_BITS, value & LOW_MASK
+        c = self._chunks.get(key)
+        if c is None:
+            self._chunks[key] = array('H', [low])
+        elif isinstance(c, array):
+            i = bisect_left(c, low)
+            if i == len(c) or c[i] != low:
+                c.insert(i, low)
+                self._chunks[key] = _normalize(c)
+        else:
+            self._chunks[key] = c | (1 << low)
+
+    def discard(self, value):
+        """
+        Remove a single value from the Bitmap, if present.
+        """
+        key, low = value >> CHUNK_BITS, value & LOW_MASK
+        c = self._chunks.get(key)
+        if c is None:
+            return
+        elif isinstance(c, array):
+            i = bisect_left(c, low)
+            if i < len(c) and c[i] == low:
+                del c[i]
+        else:
+            c = c & ~(1 << low)
+        c = _normalize(c)
+        if c is None:
+            del self._chunks[key]
+        else:
+            self._chunks[key] = c
+
+    def __contains__(self, value):
+        c = self._chunks.get(value >> CHUNK_BITS)
+        if c is None:
+            return False
+        low = value & LOW_MASK
+        if isinstance(c, array):
+            i = bisect_left(c, low)
+            return i < len(c) and c[i] == low
+        return bool((c >> low) & 1)
+
+    def __len__(self):
+        return sum(_len(c) for c in self._chunks.itervalues())
+
+    def __nonzero__(self):
+        return bool(self._chunks)
+
+    def __iter__(self):
+        """
+        Iterate over the values in ascending order.
+        """
+        for key in sorted(self._chunks):
+            base = key << CHUNK_BITS
+            for low in _to_array(self._chunks[key]):
+                yield base + low
+
+    def __eq__(self, other):
+        return isinstance(other, Bitmap) and self._chunks == other._chunks
+
+    def __ne__(self, other):
+        return not self == other
+
+    def copy(self):
+        result = Bitmap()
+        for key, c in self._chunks.iteritems():
+            if isinstance(c, array):
+                c = array('H', c)
+            result._chunks[key] = c
+        return result
+
+    @staticmethod
+    def _and(a, b):
+        if isinstance(a, array) and isinstance(b, array):
+            return array('H', sorted(set(a) & set(b)))
+        return _to_long(a) & _to_long(b)
+
+    @staticmethod
+    def _or(a, b):
+        if isinstance(a, array) and isinstance(b, array) and \
+                len(a) + len(b) <= ARRAY_MAX:
+            return array('H', sorted(set(a) | set(b)))
+        return _to_long(a) | _to_long(b)
+
+    @staticmethod
+    def _andnot(a, b):
+        if isinstance(a, array):
+            if isinstance(b, array):
+                b = set(b)
+                return array('H', [v for v in a if v not in b])
+            return array('H', [v for v in a if not (b >> v) & 1])
+        return a & ~_to_long(b)
+
+    def __and__(self, other):
+        result = Bitmap()
+        for key in set(self._chunks) & set(other._chunks):
+            c = _normalize(self._and(self._chunks[key], other._chunks[key]))
+            if c is not None:
+                result._chunks[key] = c
+        return result
+
+    def __or__(self, other):
+        result = self.copy()
+        for key, c in other._chunks.iteritems():
+            if key in result._chunks:
+                c = _normalize(self._or(result._chunks[key], c))
+            elif isinstance(c, array):
+                c = array('H', c)
+            result._chunks[key] = c
+        return result
+
+    def __sub__(self, other):
+        result = Bitmap()
+        for key, c in self._chunks.iteritems():
+            if key in other._chunks:
+                c = _normalize(self._andnot(c, other._chunks[key]))
+            elif isinstance(c, array):
+                c = array('H', c)
+            if c is not None:
+                result._chunks[key] = c
+        return result
+
+    def __iand__(self, other):
+        self._chunks = (self & other)._chunks
+        return self
+
+    def __ior__(self, other):
+        self._chunks = (self | other)._chunks
+        return self
+
+    def __isub__(self, other):
+        self._chunks = (self - other)._chunks
+        return self
+
+    def memory_usage(self):
+        """
+        Return an estimate of the number of bytes used by the Bitmap.
+        """
+        total = 0
+        for c in self._chunks.itervalues():
+            if isinstance(c, array):
+                total += c.itemsize * len(c)
+            else:
+                total += CHUNK_SIZE >> 3
+            total += CHUNK_OVERHEAD
+        return total
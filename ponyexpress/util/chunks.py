@@ -0,0 +1,20 @@
+"""
+ponyexpress utility modules: splitting work into batches
+"""
+
+from itertools import islice
+
+def chunked(iterable, size):
+    """
+    Split an iterable into lists of at most size items each.
+
+    This is mostly useful for turning one enormous query into a
+    series of bounded ones, e.g. keeping the number of values in an
+    IN (...) clause reasonable.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
@@ -6,8 +6,16 @@ class Headers(object):
     """
     An ordered dictionary look-alike that allows multiple values with
     the same key
+
+    Lookups are case-insensitive. Rather than lowercasing every key on
+    every lookup, the first lookup builds an index from lowercased
+    keys to their positions, which is kept up to date as headers are
+    added and thrown away if any are removed.
     """
 
+    # There are a lot of these around during a big FETCH
+    __slots__ = ('_headers', '_index')
+
     def __init__(self, headers=[]):
         """
         Create a new Headers object.
@@ -20,6 +28,19 @@ class Headers(object):
             self._headers = list(headers.items())
         else:
             self._headers = list(headers)
+        self._index = None
+
+    def _getIndex(self):
+        """
+        Return a dict mapping each lowercased header name to a list of
+        the positions it appears at, in order.
+        """
+        if self._index is None:
+            index = {}
+            for i, (k, v) in enumerate(self._headers):
+                index.setdefault(k.lower(), []).append(i)
+            self._index = index
+        return self._index
 
     def keys(self):
         """
@@ -37,7 +58,7 @@ class Headers(object):
         """
         Return a list of two-tuples of header fields and values.
         """
-        return list(self.iteritems())
+        return list(self._headers)
 
     def iterkeys(self):
         """
@@ -56,30 +77,26 @@ class Headers(object):
         Return an iterator over all two-tuples of header fields and
         values.
         """
-        return ((k, v) for k, v in self._headers)
+        return iter(self._headers)
 
     def __contains__(self, header):
         """
         Return True if header is in self, else False
         """
-        header = header.lower()
-        # Use any to avoid iterating over the whole list if it can be
-        # helped
-        return any((header == k.lower()) for k in self.iterkeys())
+        return header.lower() in self._getIndex()
     has_key = __contains__
 
-    def ___delitem__(self, item):
+    def __delitem__(self, name):
         """
         Delete all occurrences of a header, if present.
 
         Does not raise an exception if the header is missing
         """
         name = name.lower()
-        newheaders = []
-        for k, v in self._headers:
-            if k.lower() != name:
-                newheaders.append((k, v))
-        self._headers = newheaders
+        if name in self._getIndex():
+            self._headers = [(k, v) for k, v in self._headers
+                             if k.lower() != name]
+            self._index = None
 
     def __getitem__(self, name):
         """
@@ -90,12 +107,10 @@ class Headers(object):
         If the header name appears multiple times, the first
         occurrence will be returned.
         """
-        name = name.lower()
-        for k, v in self._headers:
-            if k.lower() == name:
-                return v
-        else:
+        positions = self._getIndex().get(name.lower())
+        if not positions:
             raise KeyError, name
+        return self._headers[positions[0]][1]
 
     def __setitem__(self, name, val):
         """
@@ -103,6 +118,8 @@ class Headers(object):
 
         This does not overwrite existing headers with the same name.
         """
+        if self._index is not None:
+            self._index.setdefault(name.lower(), []).append(len(self._headers))
         self._headers.append((name, val))
 
     def __len__(self):
@@ -116,6 +133,7 @@ class Headers(object):
         Remove all headers.
         """
         self._headers = []
+        self._index = None
 
     def get(self, k, x=None):
         """
@@ -139,5 +157,24 @@ class Headers(object):
             return x
 
     def get_all(self, name):
-        name = name.lower()
-        return [v for k, v in self._headers if k.lower() == name]
+        """
+        Return a list of all the values of a header, in order.
+        """
+        return [self._headers[i][1]
+                for i in self._getIndex().get(name.lower(), [])]
+
+    def select(self, names, negate=False):
+        """
+        Return a new Headers with just the headers named in names (or,
+        if negate is True, all the others), in their original order.
+        """
+        if negate:
+            names = set(n.lower() for n in names)
+            return Headers((k, v) for k, v in self._headers
+                           if k.lower() not in names)
+        index = self._getIndex()
+        positions = []
+        for name in set(n.lower() for n in names):
+            positions.extend(index.get(name, []))
+        positions.sort()
+        return Headers(self._headers[i] for i in positions)
@@ -26,31 +26,28 @@ class MPart(object):
 
     def _set_message(self, msg):
         self._message = msg
-        self.length = len(str(msg))
+        self._length = None
 
     message = property(_get_message, _set_message)
 
+    @property
+    def length(self):
+        # Working out the length means serializing the whole message,
+        # so don't do it unless somebody asks
+        if self._length is None:
+            self._length = len(str(self.message))
+        return self._length
+
     def getHeaders(self, negate, *names):
-        if len(names) == 0:
-            # No names specified and negate is True means return
-            # nothing
-            if negate: return {}
-            # No names specified and negate is False means return
-            # everything, or exclude nothing. The logic behind an
-            # empty names list makes sense if we just switch the
-            # negate flag
-            else: negate = True
-
-        headers = Headers()
-        for k, v in self.message.items():
-            # Use an exclusive or to simplify the logic
-            if k in names is not negate:
-                headers[k] = v
-
-        return headers
+        # No names and negate means leave nothing out, which is how
+        # BODY[HEADER] and ENVELOPE ask for every header
+        return Headers(self.message.items()).select(names, negate)
 
     def getBodyFile(self):
-        return StringIO(str(self.message.get_payload()))
+        payload = self.message.get_payload()
+        if not isinstance(payload, str):
+            payload = str(payload)
+        return StringIO(payload)
 
     def getSize(self):
         return self.length
@@ -0,0 +1,34 @@
+"""
+ponyexpress utility modules: splitting raw messages into headers and
+body
+"""
+
+import email.parser
+
+def header_length(data):
+    """
+    Return the length of the headers of a raw message, including the
+    blank line that ends them.
+    """
+    crlf = data.find('\r\n\r\n')
+    lf = data.find('\n\n')
+    if crlf >= 0 and (lf < 0 or crlf < lf):
+        return crlf + 4
+    elif lf >= 0:
+        return lf + 2
+    # No body at all
+    return len(data)
+
+def parse_headers(data):
+    """
+    Parse the headers of a raw message.
+
+    Returns the length of the headers (see header_length()) and a list
+    of (field, value) pairs, decoded as UTF-8. The body isn't looked
+    at.
+    """
+    length = header_length(data)
+    parsed = email.parser.HeaderParser().parsestr(data[:length], True)
+    return length, [(field.decode('utf-8', 'replace'),
+                     value.decode('utf-8', 'replace'))
+                    for field, value in parsed.items()]
@@ -0,0 +1,173 @@
+"""
+ponyexpress utility modules: a class for mapping message sequence
+numbers to UIDs
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+
+class SequenceMap(object):
+    """
+    An ordered array of the UIDs in a folder.
+
+    IMAP message sequence numbers are just the (1-based) positions of
+    UIDs in that array, so translating a sequence number or a range of
+    sequence numbers into UIDs is an index or a slice instead of a
+    database query.
+    """
+
+    def __init__(self, uids=[]):
+        """
+        Create a new SequenceMap.
+
+        uids can be any iterable of UIDs; it doesn't have to be sorted
+        """
+        self._uids = array('l', sorted(uids))
+
+    def __len__(self):
+        """
+        Return the number of messages in the folder.
+        """
+        return len(self._uids)
+
+    def __iter__(self):
+        """
+        Return an iterator over all UIDs in sequence order.
+        """
+        return iter(self._uids)
+
+    def __contains__(self, uid):
+        """
+        Return True if uid is in the folder, else False
+        """
+        i = bisect_left(self._uids, uid)
+        return i < len(self._uids) and self._uids[i] == uid
+
+    def last(self):
+        """
+        Return the highest UID in the folder, or None if it's empty.
+        """
+        if self._uids:
+            return self._uids[-1]
+
+    def append(self, uid):
+        """
+        Add a single UID to the folder.
+
+        New UIDs are almost always higher than anything already in the
+        folder, which makes this an append; anything else falls back
+        to an insertion.
+        """
+        if not self._uids or uid > self._uids[-1]:
+            self._uids.append(uid)
+        elif uid not in self:
+            self._uids.insert(bisect_left(self._uids, uid), uid)
+
+    def extend(self, uids):
+        """
+        Add several UIDs to the folder.
+        """
+        for uid in uids:
+            self.append(uid)
+
+    def remove(self, uids):
+        """
+        Remove UIDs from the folder.
+
+        Returns the sequence numbers that the removed UIDs had, in
+        descending order - that's the order that EXPUNGE responses
+        need to be sent in so that each one is still valid when the
+        client sees it. UIDs not in the folder are ignored.
+        """
+        positions = []
+        for uid in set(uids):
+            i = bisect_left(self._uids, uid)
+            if i < len(self._uids) and self._uids[i] == uid:
+                positions.append(i)
+        positions.sort()
+        if len(positions) == 1:
+            del self._uids[positions[0]]
+        elif positions:
+            # Deleting one at a time shifts the rest of the array every
+            # time, so copy what's left across in one pass instead
+            kept = array('l')
+            start = 0
+            for i in positions:
+                kept.extend(self._uids[start:i])
+                start = i + 1
+            kept.extend(self._uids[start:])
+            self._uids = kept
+        return [i + 1 for i in reversed(positions)]
+
+    def getUID(self, seq):
+        """
+        Translate a sequence number into a UID.
+
+        Raises IndexError if there's no message with that sequence
+        number.
+        """
+        if seq < 1:
+            raise IndexError, seq
+        return self._uids[seq - 1]
+
+    def getSequence(self, uid):
+        """
+        Translate a UID into a sequence number.
+
+        Raises KeyError if the UID isn't in the folder.
+        """
+        i = bisect_left(self._uids, uid)
+        if i < len(self._uids) and self._uids[i] == uid:
+            return i + 1
+        raise KeyError, uid
+
+    def resolve(self, messages, uid):
+        """
+        Convert a MessageSet into a list of the UIDs it refers to.
+
+        @type C{twisted.mail.imap4.MessageSet}
+        @param messages: The set of identifiers to resolve. Its last
+        attribute will be set to match this folder.
+
+        @type C{bool}
+        @param uid: Whether the IDs in messages are UIDs or message
+        sequence IDs.
+
+        @rtype: A list of UIDs, in sequence order
+        """
+        if not self._uids:
+            return []
+
+        result = []
+        if uid:
+            messages.last = self._uids[-1]
+            for low, high in messages.ranges:
+                # UIDs can be sparse, so find the slice of the folder
+                # that falls within the range instead of checking
+                # every number in it
+                result.extend(self._uids[bisect_left(self._uids, low):
+                                         bisect_right(self._uids, high)])
+        else:
+            messages.last = len(self._uids)
+            for low, high in messages.ranges:
+                result.extend(self._uids[max(low, 1) - 1:high])
+        return result
+
+def covers(messages, uid):
+    """
+    Return whether a MessageSet of UIDs includes uid.
+
+    Unlike checking with in, this doesn't need the set's last value,
+    so it works for UIDs that aren't in any folder any more.
+    """
+    for low, high in messages.ranges:
+        # twisted keeps * as None, which sorts first, so it can be at
+        # either end. It stands for the highest UID, so a range with
+        # it covers everything from the other end up
+        ends = [e for e in (low, high) if e is not None]
+        if len(ends) < 2:
+            if not ends or ends[0] <= uid:
+                return True
+        elif low <= uid <= high:
+            return True
+    return False